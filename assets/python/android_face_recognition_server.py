@@ -7,19 +7,40 @@ This lightweight server is designed to run on Android devices using Termux.
 import asyncio
 import json
 import base64
+import hashlib
+import zlib
 import io
+import gc
 import os
+import uuid
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import OrderedDict, deque
 import sys
 import time
 import logging
-import traceback
 import signal
 import platform
+import threading
+import tracemalloc
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
+from stat import S_ISSOCK
+from urllib.parse import parse_qsl, urlsplit
 import numpy as np
 import cv2
 
+# Modules shared with the python/ service. installServer() copies them next to
+# this script; run from a checkout, they are imported from the repository's python/
+_SHARED_MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "python")
+if os.path.isdir(_SHARED_MODULE_DIR):
+    sys.path.append(os.path.normpath(_SHARED_MODULE_DIR))
+
+from cpu_governor import available_cpus, limit_blas_threads
+from persistence_writer import PersistenceWriter
+from request_tracing import RequestTracer, activate_trace, current_trace, deactivate_trace, record_exception, trace_span
+from session_capture import SessionRecorder, replay_capture
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -31,24 +52,1844 @@ logger = logging.getLogger("EnhancedAndroidFaceRecognitionServer")
 # Server version
 SERVER_VERSION = "2.0.0"
 
+# Gallery snapshot/delta exchange format
+GALLERY_FORMAT = "nafacial-gallery"
+# Version 2 adds multi-template entries ("templates": count, vector holding every row)
+GALLERY_FORMAT_VERSION = 2
+
+# Detection models: the Haar cascade is the accurate default, LBP the fast mode
+DETECTION_MODELS = {"haar": "enhanced_haar", "lbp": "enhanced_lbp"}
+MODEL_ALIASES = {"haar": "haar", "enhanced_haar": "haar", "lbp": "lbp", "enhanced_lbp": "lbp", "fast": "lbp"}
+LBP_CASCADE_FILES = ["lbpcascade_frontalface_improved.xml", "lbpcascade_frontalface.xml"]
+
+def process_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, where /proc is available (Linux, Android)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first
+
+    np.argpartition selects the k candidates in linear time; only those k are
+    sorted, so asking for candidates costs about the same as a plain argmax.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    candidates = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def find_lbp_cascade() -> Optional[str]:
+    """Locate OpenCV's bundled LBP frontal-face cascade, if installed"""
+    prefixes = [sys.prefix, os.environ.get("PREFIX", ""), "/usr", "/usr/local"]
+    directories = [os.path.join(os.path.dirname(os.path.normpath(cv2.data.haarcascades)), "lbpcascades")]
+    for prefix in filter(None, prefixes):
+        for share in ("opencv4", "opencv"):
+            directories.append(os.path.join(prefix, "share", share, "lbpcascades"))
+
+    for directory in directories:
+        for name in LBP_CASCADE_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                return path
+    return None
+
+# Frame quality gate: thresholds apply to a QUALITY_SAMPLE_WIDTH-wide grayscale downsample
+QUALITY_SAMPLE_WIDTH = 96
+DEFAULT_QUALITY_THRESHOLDS = {
+    "min_brightness": 40.0,    # mean gray level
+    "max_brightness": 215.0,
+    "min_contrast": 15.0,      # gray level standard deviation
+    "min_sharpness": 20.0      # variance of the Laplacian
+}
+
+# ROI hints are expanded by this fraction of the box size on every side
+ROI_EXPAND = 0.5
+
+# Largest WebSocket message accepted (gallery snapshots can be several MB)
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# Verification sessions idle for longer than this are dropped, in seconds
+VERIFICATION_SESSION_TTL = 60
+
+# Scoped sub-indexes kept per gallery index
+MAX_CACHED_PARTITIONS = 64
+
+# The on-disk gallery index is only rewritten once this fraction of its rows is dead
+DISK_INDEX_COMPACT_RATIO = 0.25
+
+# Shortest push interval a metrics subscriber may ask for, in seconds
+MIN_METRICS_INTERVAL = 0.5
+
+# Bounds on memory_snapshot requests: traceback depth recorded per allocation, sites reported
+MAX_TRACEMALLOC_FRAMES = 25
+MAX_MEMORY_SNAPSHOT_SITES = 200
+
+def _vector_checksum(vector: np.ndarray) -> str:
+    """SHA-256 of a face vector's little-endian float32 bytes"""
+    return hashlib.sha256(np.ascontiguousarray(vector, dtype="<f4").tobytes()).hexdigest()
+
+def _encode_vector(vector: np.ndarray) -> str:
+    """Encode a face vector as base64 float32 bytes"""
+    return base64.b64encode(np.ascontiguousarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+def _decode_vector(data: str) -> np.ndarray:
+    """Decode a face vector encoded by _encode_vector"""
+    return np.frombuffer(base64.b64decode(data), dtype="<f4").astype(np.float32)
+
+def _payload_checksum(entries: List[Dict[str, Any]]) -> str:
+    """Checksum over every entry of a snapshot or delta, in order"""
+    digest = hashlib.sha256()
+    for entry in entries:
+        line = f"{entry['op']}:{entry['person_id']}:{entry.get('checksum', '')}"
+        # Only entries with tags hash them, so untagged payloads match older nodes
+        if entry.get("tags"):
+            line += ":" + json.dumps(entry["tags"], sort_keys=True)
+        digest.update(f"{line}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def _valid_person_id(person_id: Any) -> bool:
+    """Whether a person id is safe to use as a face_db file name"""
+    return (isinstance(person_id, str) and bool(person_id) and ".." not in person_id
+            and not any(sep in person_id for sep in ("/", "\\", "\0")))
+
+# Scheduling class of each message type; anything unlisted is admin traffic
+MESSAGE_PRIORITIES = {
+    "detect_faces": "interactive",
+    "identify_face": "interactive",
+    "identify_all_faces": "interactive",
+    "verify_frame": "interactive",
+    "register_face": "enrollment",
+    "update_face": "enrollment",
+    "delete_face": "enrollment",
+    "compare_faces": "enrollment",
+    "apply_gallery_delta": "enrollment"
+}
+DEFAULT_PRIORITY_WEIGHTS = {"interactive": 8, "enrollment": 2, "admin": 1, "batch": 1}
+
+# Message types accepted by the HTTP batch endpoint
+BATCH_MESSAGE_TYPES = ("identify_face", "identify_all_faces", "detect_faces")
+
+class _WorkerStats:
+    """Busy and CPU time of one worker thread"""
+
+    def __init__(self, index: int, cpus: List[int]):
+        self.index = index
+        self.cpus = cpus
+        self.jobs = 0
+        self.busy = 0.0
+        self.cpu = 0.0
+
+class CPUGovernor:
+    """
+    Sizes the worker pool and the native thread pools beneath it together
+
+    Every worker is budgeted threads_per_worker cores, and OpenCV and BLAS
+    are capped to the same count, so workers x native threads stays within
+    the CPUs this process may use instead of each worker fanning out over
+    all of them. cv2.setNumThreads is process-wide; OpenCV runs a parallel
+    region serially when its pool is already busy, so concurrent workers do
+    not multiply it. With pin, each worker thread is bound to its own block
+    of CPUs (Linux only), which keeps caches warm on large hosts.
+
+    The native caps are process-wide, so they are only set by apply(),
+    which the server calls when it starts.
+    """
+
+    def __init__(self, workers: Optional[int] = None, threads_per_worker: Optional[int] = None,
+                 pin: bool = False):
+        """
+        Args:
+            workers: Worker threads (default: min(4, CPUs / threads_per_worker))
+            threads_per_worker: OpenCV/BLAS threads per worker (default: CPUs / workers)
+            pin: Bind each worker thread to its own block of CPUs
+        """
+        self.cpus = available_cpus()
+        if workers is None:
+            workers = min(4, len(self.cpus) // max(1, threads_per_worker or 1))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(self.cpus) // max(1, workers))
+        self.workers = max(1, workers)
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+        if pin and not self.pin:
+            logger.warning("CPU pinning is not supported on this platform")
+
+        # Set by apply()
+        self.blas_limit: Optional[str] = None
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._workers: List[_WorkerStats] = []
+        logger.info(f"{self.workers} workers x {self.threads_per_worker} threads on {len(self.cpus)} CPUs"
+                    f"{' (pinned)' if self.pin else ''}")
+
+    def apply(self):
+        """Cap the process-wide OpenCV and BLAS pools to the per-worker budget"""
+        cv2.setNumThreads(self.threads_per_worker)
+        self.blas_limit = limit_blas_threads(self.threads_per_worker)
+
+    def worker_cpus(self, index: int) -> List[int]:
+        """CPU block of worker `index`; blocks wrap round when workers x threads exceeds the CPUs"""
+        count = min(self.threads_per_worker, len(self.cpus))
+        start = index * self.threads_per_worker
+        return [self.cpus[(start + offset) % len(self.cpus)] for offset in range(count)]
+
+    def initialize_worker(self):
+        """ThreadPoolExecutor initializer: register the thread and pin it if enabled"""
+        with self._lock:
+            stats = _WorkerStats(len(self._workers), self.worker_cpus(len(self._workers)))
+            self._workers.append(stats)
+        self._local.stats = stats
+        if self.pin:
+            try:
+                # pid 0 is the calling thread on Linux
+                os.sched_setaffinity(0, stats.cpus)
+            except OSError as e:
+                logger.warning(f"Could not pin worker {stats.index} to CPUs {stats.cpus}: {e}")
+
+    def executor(self) -> ThreadPoolExecutor:
+        """Worker pool whose threads report to this governor"""
+        return ThreadPoolExecutor(self.workers, thread_name_prefix="face-worker",
+                                  initializer=self.initialize_worker)
+
+    def run(self, func, *args) -> Any:
+        """Run func(*args) on a worker thread, charging its wall and CPU time to that worker"""
+        stats = getattr(self._local, "stats", None)
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            if stats is not None:
+                stats.jobs += 1
+                stats.busy += time.perf_counter() - started
+                stats.cpu += time.thread_time() - cpu_started
+
+    def get_metrics(self) -> Dict[str, Any]:
+        uptime = max(time.perf_counter() - self.start_time, 1e-9)
+        with self._lock:
+            workers = list(self._workers)
+        return {
+            "cpus": len(self.cpus),
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "opencv_threads": cv2.getNumThreads(),
+            "blas_limit": self.blas_limit,
+            "pinned": self.pin,
+            "utilisation": sum(stats.busy for stats in workers) / (uptime * self.workers),
+            # cpu_ratio below 1 means a busy worker spent time waiting (GIL, I/O) rather than computing
+            "per_worker": [{
+                "worker": stats.index,
+                "cpus": stats.cpus,
+                "jobs": stats.jobs,
+                "busy_seconds": stats.busy,
+                "utilisation": stats.busy / uptime,
+                "cpu_ratio": stats.cpu / stats.busy if stats.busy else 0.0
+            } for stats in workers]
+        }
+
+class _ClassStats:
+    """Latency samples for one scheduling class"""
+
+    def __init__(self, window: int = 1000):
+        self.completed = 0
+        self.wait = deque(maxlen=window)
+        self.service = deque(maxlen=window)
+
+    def summary(self) -> Dict[str, Any]:
+        def percentiles(samples):
+            if not samples:
+                return {"avg": 0.0, "p50": 0.0, "p95": 0.0}
+            values = np.fromiter(samples, dtype=np.float64)
+            return {
+                "avg": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95))
+            }
+        return {
+            "completed": self.completed,
+            "queue_wait": percentiles(self.wait),
+            "service_time": percentiles(self.service)
+        }
+
+class PriorityScheduler:
+    """
+    Weighted fair sharing of the worker pool between message classes
+
+    Each class has its own FIFO queue. Whenever a worker is free the class
+    with the lowest virtual time runs next, and running a job advances that
+    class's virtual time by 1/weight, so under contention the classes get
+    worker slots in proportion to their weights and none can starve another.
+    An idle class rejoins at the current virtual time rather than spending
+    credit saved up while it was idle. The pool itself is sized and
+    instrumented by a CPUGovernor.
+    """
+
+    def __init__(self, workers: Optional[int] = None, weights: Optional[Dict[str, float]] = None,
+                 governor: Optional[CPUGovernor] = None):
+        self.governor = governor or CPUGovernor(workers)
+        self.workers = self.governor.workers
+        self.weights = dict(weights or DEFAULT_PRIORITY_WEIGHTS)
+        self.executor = self.governor.executor()
+        self.queues: Dict[str, deque] = {name: deque() for name in self.weights}
+        self.virtual_time: Dict[str, float] = {name: 0.0 for name in self.weights}
+        self.stats: Dict[str, _ClassStats] = {name: _ClassStats() for name in self.weights}
+        self.running = 0
+
+    async def run(self, priority: str, func, *args) -> Any:
+        """Queue func(*args) under a priority class and wait for its result"""
+        if priority not in self.queues:
+            priority = "admin" if "admin" in self.queues else next(iter(self.queues))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self.queues[priority]
+        if not queue:
+            # Rejoin at the current virtual time instead of banking idle credit
+            busy = [self.virtual_time[name] for name, q in self.queues.items() if q]
+            if busy:
+                self.virtual_time[priority] = max(self.virtual_time[priority], min(busy))
+        queue.append((future, contextvars.copy_context(), func, args, time.perf_counter()))
+        self._dispatch(loop)
+        return await future
+
+    def _dispatch(self, loop: asyncio.AbstractEventLoop):
+        """Start queued jobs while workers are free"""
+        while self.running < self.workers:
+            ready = [name for name, queue in self.queues.items() if queue]
+            if not ready:
+                return
+            priority = min(ready, key=lambda name: self.virtual_time[name])
+            future, context, func, args, enqueued = self.queues[priority].popleft()
+            self.virtual_time[priority] += 1.0 / self.weights[priority]
+            if future.cancelled():
+                continue
+
+            started = time.perf_counter()
+            wait = started - enqueued
+            trace = context.run(current_trace)
+            if trace is not None:
+                trace.spans["queue"] = trace.spans.get("queue", 0.0) + wait
+
+            self.running += 1
+            job = loop.run_in_executor(self.executor, context.run, self.governor.run, func, *args)
+            job.add_done_callback(
+                lambda job, future=future, priority=priority, wait=wait, started=started:
+                    self._finished(loop, job, future, priority, wait, started))
+
+    def _finished(self, loop, job, future, priority: str, wait: float, started: float):
+        self.running -= 1
+        stats = self.stats[priority]
+        stats.completed += 1
+        stats.wait.append(wait)
+        stats.service.append(time.perf_counter() - started)
+
+        if not future.cancelled():
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self._dispatch(loop)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "weights": dict(self.weights),
+            "queued": {name: len(queue) for name, queue in self.queues.items()},
+            "classes": {name: stats.summary() for name, stats in self.stats.items()},
+            "cpu": self.governor.get_metrics()
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class GalleryIndex:
+    """
+    Immutable search structure over the gallery
+
+    Identify reads whichever index is current when it starts; writers build a
+    new index and swap the reference, so a reload never blocks or tears an
+    in-flight search.
+
+    A person may have several templates. All templates live in one matrix,
+    grouped by person, with `owner` giving each row's person index, so a
+    probe is scored against every template in one product and the scores are
+    reduced per person with a segment max or mean over `starts`.
+
+    Deleting a person only tombstones them here: their score is masked to
+    -inf and lookups miss them, which is the one in-place change an index
+    allows. FaceGalleryStore.compact() later swaps in an index without the
+    dead rows.
+    """
+
+    def __init__(self, faces: Dict[str, np.ndarray], tags: Optional[Dict[str, Dict[str, str]]] = None,
+                 matrix: Optional[np.ndarray] = None):
+        self.ids = list(faces)
+        counts = [len(np.atleast_2d(faces[person_id])) for person_id in self.ids]
+        if matrix is not None:
+            # Prebuilt template rows in faces order, e.g. memory-mapped from disk
+            self.matrix = matrix
+        elif self.ids:
+            self.matrix = np.concatenate([np.atleast_2d(faces[person_id]) for person_id in self.ids]
+                                         ).astype(np.float32, copy=False)
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        tags = tags or {}
+        self.tags = [tags.get(person_id) or {} for person_id in self.ids]
+        self._set_counts(np.asarray(counts, dtype=np.intp))
+
+        # Sub-indexes per scope, built on first use; they die with this index
+        self._partitions: "OrderedDict[str, GalleryIndex]" = OrderedDict()
+        self._partition_lock = threading.Lock()
+
+    def _set_counts(self, counts: np.ndarray):
+        """Derive the person-index column and segment starts from templates per person"""
+        self.counts = counts
+        self.starts = np.zeros(len(counts), dtype=np.intp)
+        if len(counts):
+            np.cumsum(counts[:-1], out=self.starts[1:])
+        self.owner = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        # One template each: row scores already are person scores
+        self.single_template = len(self.owner) == len(counts)
+        self.deleted = np.zeros(len(counts), dtype=bool)
+        self.tombstones = 0
+
+    def __len__(self) -> int:
+        """Searchable people, tombstones excluded"""
+        return len(self.ids) - self.tombstones
+
+    @property
+    def template_count(self) -> int:
+        """Searchable template rows, dead rows excluded"""
+        return len(self.owner) - self.dead_rows
+
+    @property
+    def dead_rows(self) -> int:
+        return int(self.counts[self.deleted].sum()) if self.tombstones else 0
+
+    def reduce(self, scores: np.ndarray, method: str = "max") -> np.ndarray:
+        """
+        Per-person scores from per-template scores along the last axis
+
+        Args:
+            scores: (templates,) or (probes, templates) similarities
+            method: "max" (best template) or "mean" (all templates)
+        """
+        if len(self.ids) == 0:
+            return scores
+        if not self.single_template:
+            if method == "mean":
+                scores = np.add.reduceat(scores, self.starts, axis=-1) / self.counts
+            else:
+                scores = np.maximum.reduceat(scores, self.starts, axis=-1)
+        if self.tombstones:
+            scores = np.where(self.deleted, np.float32(-np.inf), scores)
+        return scores
+
+    def tombstone(self, person_id: str) -> bool:
+        """Hide a person from every search on this index and its cached partitions"""
+        person = self.row(person_id)
+        if person is None:
+            return False
+        with self._partition_lock:
+            self.deleted[person] = True
+            self.tombstones += 1
+            partitions = list(self._partitions.values())
+        for partition in partitions:
+            partition.tombstone(person_id)
+        return True
+
+    def similarities(self, probes: np.ndarray, method: str = "max") -> np.ndarray:
+        """Per-person similarity of one probe (dim,) or several (probes, dim)"""
+        return self.reduce(probes @ self.matrix.T, method)
+
+    def top_k(self, probes: np.ndarray, k: int, method: str = "max") -> List[List[Tuple[str, float]]]:
+        """Up to k (person_id, similarity) pairs per probe, best first; tombstones never rank"""
+        if len(self) == 0:
+            return [[] for _ in probes]
+        results = []
+        for scores in self.similarities(probes, method):
+            ranked = top_k_indices(scores, min(k, len(self)))
+            results.append([(self.ids[row], float(scores[row])) for row in ranked])
+        return results
+
+    def person_similarity(self, person_id: str, probe: np.ndarray, method: str = "max") -> Optional[float]:
+        """Similarity of a probe to one person's templates, or None if not in this index"""
+        person = self.row(person_id)
+        if person is None:
+            return None
+        start = self.starts[person]
+        scores = self.matrix[start:start + self.counts[person]] @ probe
+        return float(scores.mean() if method == "mean" else scores.max())
+
+    @staticmethod
+    def in_scope(tags: Dict[str, str], scope: Dict[str, Any]) -> bool:
+        """Whether partition tags match every key of a scope; a list value matches any of its items"""
+        for key, wanted in scope.items():
+            value = tags.get(key)
+            if isinstance(wanted, list):
+                if value not in [str(item) for item in wanted]:
+                    return False
+            elif value != str(wanted):
+                return False
+        return True
+
+    def partition(self, scope: Dict[str, Any]) -> "GalleryIndex":
+        """
+        Sub-index of the entries whose tags match scope, e.g. {"unit": "A"}
+
+        The rows are copied into their own contiguous matrix, so a scoped
+        search costs in proportion to the partition size. Recently used
+        scopes (one per checkpoint, typically) stay cached.
+        """
+        key = json.dumps(scope, sort_keys=True)
+        with self._partition_lock:
+            partition = self._partitions.get(key)
+            if partition is not None:
+                self._partitions.move_to_end(key)
+                return partition
+
+        people = [person for person, tags in enumerate(self.tags)
+                  if not self.deleted[person] and self.in_scope(tags, scope)]
+        partition = GalleryIndex({})
+        partition.ids = [self.ids[person] for person in people]
+        partition.tags = [self.tags[person] for person in people]
+        partition._set_counts(self.counts[people])
+        if people:
+            rows = np.isin(self.owner, people)
+            partition.matrix = np.ascontiguousarray(self.matrix[rows])
+
+        with self._partition_lock:
+            # Tombstoned while the rows were being copied
+            stale = self.deleted[people] if people else np.zeros(0, dtype=bool)
+            if stale.any():
+                partition.deleted |= stale
+                partition.tombstones = int(stale.sum())
+            self._partitions[key] = partition
+            while len(self._partitions) > MAX_CACHED_PARTITIONS:
+                self._partitions.popitem(last=False)
+        return partition
+
+    def partition_count(self) -> int:
+        return len(self._partitions)
+
+    def partition_bytes(self) -> int:
+        with self._partition_lock:
+            return sum(partition.matrix.nbytes for partition in self._partitions.values())
+
+    def clear_partitions(self) -> int:
+        """Drop cached sub-indexes; returns the bytes released"""
+        released = self.partition_bytes()
+        with self._partition_lock:
+            self._partitions.clear()
+        return released
+
+    def row(self, person_id: str) -> Optional[int]:
+        """Person index of a person (its position in ids), or None if not in this index or tombstoned"""
+        rows = getattr(self, "_rows", None)
+        if rows is None:
+            rows = self._rows = {pid: row for row, pid in enumerate(self.ids)}
+        row = rows.get(person_id)
+        if row is None or self.deleted[row]:
+            return None
+        return row
+
+class FaceGalleryStore:
+    """
+    On-disk face gallery with a versioned delta log
+
+    Every enrollment and deletion bumps the gallery version and is appended to
+    face_db/gallery_log.jsonl. Other nodes ask for the delta since the last
+    version they saw and merge it with last-writer-wins, so replicas converge
+    without re-enrolling and without copying the whole gallery each time.
+    """
+
+    def __init__(self, db_dir: str = "face_db", durability: str = "batch"):
+        """
+        Load the gallery vectors and the delta log from db_dir
+
+        Args:
+            db_dir: Face database directory
+            durability: PersistenceWriter mode for vector files and the log
+        """
+        self.db_dir = db_dir
+        self.writer = PersistenceWriter(durability)
+        self.meta_path = os.path.join(db_dir, "gallery_meta.json")
+        self.log_path = os.path.join(db_dir, "gallery_log.jsonl")
+        # Not .npy, so the vector scans never mistake it for a person
+        self.index_path = os.path.join(db_dir, "gallery_index.mmap")
+        self.disk_index = False
+        # Rows of the on-disk index: person_id -> (first row, templates), rows in the file,
+        # and people whose templates changed since they were written there
+        self._disk_rows: Dict[str, Tuple[int, int]] = {}
+        self._disk_stale: set = set()
+        self._disk_length = 0
+        self._disk_dimension = 0
+        os.makedirs(db_dir, exist_ok=True)
+
+        self.faces: Dict[str, np.ndarray] = {}
+        self.node_id = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.base_version = 0    # deltas older than this need a full snapshot
+        self.seen: Dict[str, int] = {}    # origin node -> highest origin version applied
+        self.peers: Dict[str, int] = {}   # peer address -> last peer version synced
+        self.entries: Dict[str, Dict[str, Any]] = {}  # person_id -> last log record
+        self.log: List[Dict[str, Any]] = []
+        self.index = GalleryIndex({})
+
+        # Hot reload state: file (mtime, size) per person and how far the log was read.
+        # Reentrant: with durability "sync" the writer runs its callbacks inline, under the lock
+        self._lock = threading.RLock()
+        self._file_stats: Dict[str, Tuple[int, int]] = {}
+        self._log_offset = 0
+        self.reloads = 0
+        self.last_reload: Optional[Dict[str, Any]] = None
+        self.compactions = 0
+        self.last_compaction: Optional[Dict[str, Any]] = None
+
+        self._load_meta()
+        self._load_log()
+        self._load_vectors()
+        self._publish()
+
+    def _load_meta(self):
+        """Load node id and sync cursors"""
+        if not os.path.exists(self.meta_path):
+            self._save_meta()
+            return
+        try:
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            self.node_id = meta.get("node_id", self.node_id)
+            self.base_version = int(meta.get("base_version", 0))
+            self.version = self.base_version
+            self.peers = meta.get("peers", {})
+        except Exception as e:
+            logger.error(f"Error loading gallery metadata: {e}")
+
+    def _save_meta(self):
+        """Persist node id and sync cursors"""
+        meta = {
+            "node_id": self.node_id,
+            "base_version": self.base_version,
+            "peers": self.peers
+        }
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+    def _read_log(self, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Read complete log records from byte offset onward"""
+        records = []
+        if not os.path.exists(self.log_path):
+            return records, offset
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                # Leave a partially appended line for the next read
+                if not line.endswith(b"\n"):
+                    break
+                offset = f.tell()
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("Skipping corrupt gallery log line")
+        return records, offset
+
+    def _load_log(self):
+        """Replay the delta log to restore version, cursors and per-person state"""
+        records, self._log_offset = self._read_log(0)
+        for record in records:
+            self._track(record)
+
+    def _load_vectors(self):
+        """Load face vectors from disk"""
+        try:
+            for face_file in os.listdir(self.db_dir):
+                if face_file.endswith(".npy"):
+                    person_id = face_file.split(".")[0]
+                    face_path = os.path.join(self.db_dir, face_file)
+                    stat = self._stat(face_path)
+                    # Probably left behind by a deletion interrupted before the file was
+                    # removed; mtimes can mislead, so the file is kept but not served
+                    if self._deleted_since(person_id, stat):
+                        logger.warning(f"Not loading {face_file}: the gallery log deletes {person_id} "
+                                       f"after the file was written")
+                        self._file_stats[person_id] = stat
+                        continue
+                    self.faces[person_id] = np.load(face_path)
+                    self._file_stats[person_id] = stat
+
+                    # Adopt vectors enrolled before the log existed or copied in by hand
+                    record = self.entries.get(person_id)
+                    if record is None or record["op"] != "enroll":
+                        self._append("enroll", person_id, _vector_checksum(self.faces[person_id]),
+                                     timestamp=os.path.getmtime(face_path))
+
+            logger.info(f"Loaded {len(self.faces)} faces from database (gallery version {self.version})")
+        except Exception as e:
+            logger.error(f"Error loading face database: {e}")
+
+    def _track(self, record: Dict[str, Any]):
+        """Fold one log record into the in-memory log state"""
+        # A reload can race the writer and read back a record we appended
+        if self.entries.get(record["person_id"]) == record:
+            return
+        self.log.append(record)
+        self.version = max(self.version, record["version"])
+        self.entries[record["person_id"]] = record
+        origin = record["origin"]
+        self.seen[origin] = max(self.seen.get(origin, 0), record["origin_version"])
+
+    def _append(self, op: str, person_id: str, checksum: str = "",
+                origin: Optional[str] = None, origin_version: Optional[int] = None,
+                timestamp: Optional[float] = None, tags: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Append a record to the delta log"""
+        version = self.version + 1
+        record = {
+            "version": version,
+            "op": op,
+            "person_id": person_id,
+            "checksum": checksum,
+            "timestamp": timestamp if timestamp is not None else time.time(),
+            "origin": origin or self.node_id,
+            "origin_version": origin_version if origin_version is not None else version
+        }
+        if tags:
+            record["tags"] = tags
+        self.writer.append(self.log_path, (json.dumps(record) + "\n").encode("utf-8"), self._log_written)
+        self._track(record)
+        return record
+
+    def _log_written(self, offset: int):
+        """Our own log appends are already tracked; don't re-read them on reload"""
+        with self._lock:
+            self._log_offset = max(self._log_offset, offset)
+
+    def _vector_path(self, person_id: str) -> str:
+        if not _valid_person_id(person_id):
+            raise ValueError(f"Invalid person id {person_id!r}")
+        return os.path.join(self.db_dir, f"{person_id}.npy")
+
+    @staticmethod
+    def _stat(path: str) -> Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def tags(self, person_id: str) -> Dict[str, str]:
+        """Partition tags (unit, site, shift, ...) of an enrolled person"""
+        record = self.entries.get(person_id)
+        if record is None or record["op"] != "enroll":
+            return {}
+        return record.get("tags", {})
+
+    def _publish(self, rewrite: bool = False):
+        """
+        Build a fresh search index and swap it in
+
+        Args:
+            rewrite: With the on-disk index, rewrite the whole file instead of
+                appending the changed people; compaction and the switch to disk do
+        """
+        tags = {person_id: self.tags(person_id) for person_id in self.faces}
+        if self.disk_index:
+            self.index = self._disk_gallery_index(tags, rewrite)
+        else:
+            self.index = GalleryIndex(self.faces, tags)
+
+        # Point the per-person templates at the index rows so each vector is held once
+        index = self.index
+        for person, person_id in enumerate(index.ids):
+            if index.deleted[person]:
+                continue
+            vector = self.faces[person_id]
+            if vector.dtype == index.matrix.dtype:
+                start = index.starts[person]
+                rows = index.matrix[start:start + index.counts[person]]
+                self.faces[person_id] = rows if vector.ndim == 2 else rows[0]
+
+    def _disk_gallery_index(self, tags: Dict[str, Dict[str, str]], rewrite: bool) -> GalleryIndex:
+        """
+        Index over the append-only on-disk matrix
+
+        Only people whose templates are not in the file yet (new, re-enrolled
+        or reloaded) are appended, so an enrollment costs its own rows rather
+        than a rewrite of the gallery. The rows they replace, and those of
+        removed people, stay in the file as dead rows. The file is rewritten
+        once DISK_INDEX_COMPACT_RATIO of its rows are dead.
+        """
+        for person_id in [p for p in self._disk_rows if p not in self.faces]:
+            del self._disk_rows[person_id]
+        fresh = [person_id for person_id in self.faces
+                 if person_id not in self._disk_rows or person_id in self._disk_stale]
+        appended = sum(len(np.atleast_2d(self.faces[person_id])) for person_id in fresh)
+        dead = self._disk_length - sum(count for _, count in self._disk_rows.values())
+        dead += sum(self._disk_rows[person_id][1] for person_id in fresh if person_id in self._disk_rows)
+        if dead and dead >= DISK_INDEX_COMPACT_RATIO * (self._disk_length + appended):
+            rewrite = True
+        if rewrite:
+            self._disk_rows, self._disk_length = {}, 0
+            fresh = list(self.faces)
+        self._disk_stale.clear()
+
+        if fresh or rewrite:
+            # A rewrite goes to a new file; readers of the previous mapping keep the old inode
+            path = self.index_path + ".tmp" if rewrite else self.index_path
+            with open(path, "wb" if rewrite else "ab") as f:
+                for person_id in fresh:
+                    templates = np.ascontiguousarray(np.atleast_2d(self.faces[person_id]), dtype=np.float32)
+                    f.write(templates.tobytes())
+                    self._disk_rows[person_id] = (self._disk_length, len(templates))
+                    self._disk_length += len(templates)
+                    self._disk_dimension = templates.shape[1]
+            if rewrite:
+                os.replace(path, self.index_path)
+
+        # People in file order, with a dead entry for each run of dead rows
+        ids: List[Optional[str]] = []
+        counts = []
+        gaps = []
+        position = 0
+        for person_id, (start, count) in sorted(self._disk_rows.items(), key=lambda item: item[1][0]):
+            if start > position:
+                gaps.append(len(ids))
+                ids.append(None)
+                counts.append(start - position)
+            ids.append(person_id)
+            counts.append(count)
+            position = start + count
+        if position < self._disk_length:
+            gaps.append(len(ids))
+            ids.append(None)
+            counts.append(self._disk_length - position)
+
+        index = GalleryIndex({})
+        index.ids = ids
+        index.tags = [tags.get(person_id) or {} for person_id in ids]
+        index._set_counts(np.asarray(counts, dtype=np.intp))
+        if self._disk_length:
+            index.matrix = np.memmap(self.index_path, dtype=np.float32, mode="r",
+                                     shape=(self._disk_length, self._disk_dimension))
+        if gaps:
+            index.deleted[gaps] = True
+            index.tombstones = len(gaps)
+        return index
+
+    def use_disk_index(self):
+        """Serve the gallery from a memory-mapped file instead of resident arrays"""
+        with self._lock:
+            if self.disk_index:
+                return
+            self.disk_index = True
+            self._publish(rewrite=True)
+        logger.warning(f"Gallery switched to on-disk index {self.index_path}")
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Resident bytes of the gallery; memory-mapped rows count as on disk"""
+        index = self.index
+        # Vectors that are rows of the index matrix are counted with the index
+        vectors = sum(vector.nbytes for vector in list(self.faces.values())
+                      if not isinstance(vector, np.memmap) and not np.may_share_memory(vector, index.matrix))
+        return {
+            "vectors": vectors,
+            "index": 0 if isinstance(index.matrix, np.memmap) else index.matrix.nbytes,
+            "partitions": index.partition_bytes(),
+            "on_disk": self.disk_index
+        }
+
+    def _vector_written(self, person_id: str) -> Any:
+        """Callback recording the stat of a vector file we wrote, so reload skips it"""
+        def callback(_):
+            with self._lock:
+                path = self._vector_path(person_id)
+                if person_id in self.faces and os.path.exists(path):
+                    self._file_stats[person_id] = self._stat(path)
+        return callback
+
+    def enroll(self, person_id: str, vector: np.ndarray, publish: bool = True,
+               tags: Optional[Dict[str, str]] = None, **origin) -> Dict[str, Any]:
+        """
+        Store a person's templates and log the enrollment; the disk write happens behind
+
+        `vector` replaces everything enrolled for the person: one template
+        (dim,) or several (templates, dim). Partition tags default to the
+        person's current tags when not given.
+        """
+        with self._lock:
+            return self._enroll(person_id, vector, publish, tags, **origin)
+
+    def _enroll(self, person_id: str, vector: np.ndarray, publish: bool,
+                tags: Optional[Dict[str, str]], **origin) -> Dict[str, Any]:
+        """enroll() with the lock held"""
+        # Validates the id before anything changes
+        path = self._vector_path(person_id)
+        buffer = io.BytesIO()
+        np.save(buffer, vector)
+        if tags is None:
+            tags = self.tags(person_id)
+        self.faces[person_id] = vector
+        if self.disk_index:
+            self._disk_stale.add(person_id)
+        self.writer.write(path, buffer.getvalue(), self._vector_written(person_id))
+        record = self._append("enroll", person_id, _vector_checksum(vector), tags=tags, **origin)
+        if publish:
+            self._publish()
+        return record
+
+    def add_template(self, person_id: str, vector: np.ndarray, max_templates: int = 5,
+                     eviction: str = "outlier", tags: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        Add a template to a person, evicting the weakest one beyond max_templates
+
+        The new template is always kept. With "outlier" eviction the existing
+        template least similar, on average, to the rest of the set goes
+        first, so a stray bad capture is dropped before good ones; "oldest"
+        drops in enrollment order.
+
+        Returns:
+            The log record, the person's template count and the evicted
+            template positions (in the previous set)
+        """
+        with self._lock:
+            current = self.faces.get(person_id)
+            templates = [] if current is None else list(np.atleast_2d(current))
+            positions = list(range(len(templates)))
+            evicted = []
+            while templates and len(templates) + 1 > max(1, max_templates):
+                if eviction == "oldest":
+                    weakest = 0
+                else:
+                    existing = np.stack(templates)
+                    candidates = np.vstack([existing, vector[np.newaxis]])
+                    # Mean similarity of each existing template to all the others, itself excluded
+                    support = (existing @ candidates.T).sum(axis=1) - np.einsum("ij,ij->i", existing, existing)
+                    weakest = int(np.argmin(support))
+                templates.pop(weakest)
+                evicted.append(positions.pop(weakest))
+
+            templates.append(np.asarray(vector, dtype=np.float32))
+            stored = templates[0] if len(templates) == 1 else np.stack(templates)
+            record = self._enroll(person_id, stored, True, tags)
+        return {"record": record, "templates": len(templates), "evicted": evicted}
+
+    def remove(self, person_id: str, **origin) -> Dict[str, Any]:
+        """
+        Drop a person's templates and log the deletion
+
+        The person is tombstoned in the current index, so searches stop
+        matching them at once without rebuilding it; compact() reclaims the rows.
+        """
+        path = self._vector_path(person_id)
+        with self._lock:
+            self.faces.pop(person_id, None)
+            # The file's stat stays until the writer has deleted it, so a reload
+            # in between sees it unchanged instead of as a new enrollment
+            self.writer.delete(path, self._vector_deleted(person_id))
+            record = self._append("delete", person_id, **origin)
+            self.index.tombstone(person_id)
+        return record
+
+    def _vector_deleted(self, person_id: str) -> Any:
+        """Callback forgetting the stat of a vector file we deleted, unless the person was re-enrolled"""
+        def callback(_):
+            with self._lock:
+                if person_id not in self.faces:
+                    self._file_stats.pop(person_id, None)
+        return callback
+
+    def _deleted_since(self, person_id: str, stat: Tuple[int, int]) -> bool:
+        """Whether the log deletes a person after their vector file was last written"""
+        record = self.entries.get(person_id)
+        return record is not None and record["op"] == "delete" and record["timestamp"] * 1e9 >= stat[0]
+
+    def compact(self) -> Dict[str, Any]:
+        """
+        Rebuild the index, and the on-disk index file if used, without tombstoned rows
+
+        Identify keeps searching the old index until the new one is swapped
+        in; only enrollments wait for the lock meanwhile. The on-disk file
+        costs the whole gallery to rewrite, so it waits until at least
+        DISK_INDEX_COMPACT_RATIO of its rows are dead. Safe to call from a
+        worker thread.
+
+        Returns:
+            Number of entries and template rows dropped and how long the rebuild took
+        """
+        start_time = time.time()
+        with self._lock:
+            index = self.index
+            dropped, rows = index.tombstones, index.dead_rows
+            if dropped and self.disk_index and rows < DISK_INDEX_COMPACT_RATIO * len(index.owner):
+                dropped = 0
+            if dropped:
+                self._publish(rewrite=True)
+        if not dropped:
+            return {"dropped": 0, "dropped_rows": 0, "duration": 0.0}
+
+        self.compactions += 1
+        self.last_compaction = {
+            "dropped": dropped,
+            "dropped_rows": rows,
+            "gallery_size": len(self.faces),
+            "duration": time.time() - start_time,
+            "time": datetime.now().isoformat()
+        }
+        logger.info(f"Gallery compacted: {dropped} deleted entries ({rows} rows) dropped in "
+                    f"{self.last_compaction['duration'] * 1000:.1f} ms")
+        return self.last_compaction
+
+    def refresh(self) -> Dict[str, Any]:
+        """
+        Pick up vectors and log records written by other processes
+
+        Only files whose (mtime, size) changed are loaded, and all file I/O
+        happens before the lock is taken; under the lock a file is only used
+        if its stat is unchanged and no write of ours to it is pending. The new
+        index is swapped in at the end, so identify keeps serving from the old
+        one meanwhile. Safe to call from a worker thread.
+
+        Returns:
+            Counts of added, updated and removed entries
+        """
+        start_time = time.time()
+
+        # Scan and load outside the lock
+        stats = {}
+        for face_file in os.listdir(self.db_dir):
+            if face_file.endswith(".npy"):
+                try:
+                    stats[face_file.split(".")[0]] = self._stat(os.path.join(self.db_dir, face_file))
+                except FileNotFoundError:
+                    continue
+
+        loaded = {}
+        for person_id, stat in stats.items():
+            if self._file_stats.get(person_id) != stat:
+                try:
+                    loaded[person_id] = np.load(self._vector_path(person_id))
+                except Exception as e:
+                    # Probably still being written; the next reload retries it
+                    logger.warning(f"Skipping {person_id} during reload: {e}")
+        records, offset = self._read_log(self._log_offset)
+
+        added = updated = removed = 0
+        with self._lock:
+            # Log records first, so vectors written with their record are not re-logged
+            for record in records:
+                self._track(record)
+            self._log_offset = max(self._log_offset, offset)
+
+            for person_id, vector in loaded.items():
+                # Loaded before a concurrent enroll or delete here, whose write is still
+                # queued or has replaced the file since; the next reload sees it settled
+                path = self._vector_path(person_id)
+                if self.writer.pending(path) or self._file_stats.get(person_id) == stats[person_id]:
+                    continue
+                try:
+                    if self._stat(path) != stats[person_id]:
+                        continue
+                except FileNotFoundError:
+                    continue
+                # A deletion whose file removal had not happened yet, here or in another process
+                if self._deleted_since(person_id, stats[person_id]):
+                    continue
+                if person_id in self.faces:
+                    updated += 1
+                else:
+                    added += 1
+                self.faces[person_id] = vector
+                if self.disk_index:
+                    self._disk_stale.add(person_id)
+                self._file_stats[person_id] = stats[person_id]
+                record = self.entries.get(person_id)
+                checksum = _vector_checksum(vector)
+                if record is None or record["op"] != "enroll" or record["checksum"] != checksum:
+                    self._append("enroll", person_id, checksum, tags=self.tags(person_id))
+
+            for person_id in [p for p in self._file_stats if p not in stats]:
+                # Enrolled since the scan started
+                if os.path.exists(self._vector_path(person_id)):
+                    continue
+                # Removed here; the writer has just deleted the file
+                if person_id not in self.faces:
+                    self._file_stats.pop(person_id)
+                    continue
+                self.faces.pop(person_id, None)
+                self._file_stats.pop(person_id)
+                removed += 1
+                record = self.entries.get(person_id)
+                if record is not None and record["op"] != "delete":
+                    self._append("delete", person_id)
+
+            if added or updated or removed:
+                self._publish()
+
+        self.reloads += 1
+        self.last_reload = {
+            "added": added,
+            "updated": updated,
+            "removed": removed,
+            "gallery_version": self.version,
+            "duration": time.time() - start_time,
+            "time": datetime.now().isoformat()
+        }
+        if added or updated or removed:
+            logger.info(f"Gallery reloaded: {added} added, {updated} updated, {removed} removed")
+        return self.last_reload
+
+    def _entry_payload(self, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Build a wire entry for a log record, attaching the current vector"""
+        entry = {
+            "op": record["op"],
+            "person_id": record["person_id"],
+            "timestamp": record["timestamp"],
+            "origin": record["origin"],
+            "origin_version": record["origin_version"]
+        }
+        if record["op"] == "enroll":
+            vector = self.faces.get(record["person_id"])
+            if vector is None:
+                return None
+            entry["checksum"] = _vector_checksum(vector)
+            entry["vector"] = _encode_vector(vector)
+            if vector.ndim == 2:
+                entry["templates"] = len(vector)
+            if record.get("tags"):
+                entry["tags"] = record["tags"]
+        return entry
+
+    def _payload(self, kind: str, entries: List[Dict[str, Any]], since: int = 0) -> Dict[str, Any]:
+        return {
+            "format": GALLERY_FORMAT,
+            # Version 2 only when needed, so single-template galleries still sync to older nodes
+            "format_version": GALLERY_FORMAT_VERSION if any("templates" in e for e in entries) else 1,
+            "kind": kind,
+            "node_id": self.node_id,
+            "since_version": since,
+            "gallery_version": self.version,
+            "created": datetime.now().isoformat(),
+            "entries": entries,
+            "checksum": _payload_checksum(entries)
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Full gallery snapshot with per-vector and payload checksums"""
+        entries = []
+        # Oldest first: apply() skips anything at or below an origin version it has seen
+        with self._lock:
+            person_ids = sorted(self.faces, key=lambda p: (self.entries.get(p, {}).get("version", 0), p))
+        for person_id in person_ids:
+            record = self.entries.get(person_id) or {
+                "op": "enroll", "person_id": person_id, "timestamp": 0.0,
+                "origin": self.node_id, "origin_version": 0
+            }
+            entry = self._entry_payload(dict(record, op="enroll"))
+            if entry is not None:
+                entries.append(entry)
+        return self._payload("snapshot", entries)
+
+    def delta(self, since: int) -> Dict[str, Any]:
+        """
+        Enrollments and deletions after version `since`, latest op per person
+
+        Returns a payload with "snapshot_required" set when `since` predates
+        the retained log, in which case the caller should fetch a snapshot.
+        """
+        if since < self.base_version:
+            payload = self._payload("delta", [], since)
+            payload["snapshot_required"] = True
+            return payload
+
+        latest: Dict[str, Dict[str, Any]] = {}
+        for record in self.log:
+            if record["version"] > since:
+                latest[record["person_id"]] = record
+
+        entries = []
+        for record in sorted(latest.values(), key=lambda r: r["version"]):
+            entry = self._entry_payload(record)
+            if entry is not None:
+                entries.append(entry)
+        return self._payload("delta", entries, since)
+
+    def apply(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Merge a snapshot or delta from another node
+
+        Entries already seen (by origin and origin version) or older than the
+        local state for the same person are skipped, so applying the same
+        payload twice, or payloads relayed through several nodes, is safe.
+
+        Returns:
+            Counts of applied, skipped and rejected entries
+        """
+        if payload.get("format") != GALLERY_FORMAT:
+            raise ValueError("Not a gallery snapshot or delta")
+        if payload.get("format_version", 0) > GALLERY_FORMAT_VERSION:
+            raise ValueError(f"Unsupported gallery format version {payload.get('format_version')}")
+
+        entries = payload.get("entries", [])
+        if payload.get("checksum") != _payload_checksum(entries):
+            raise ValueError("Gallery payload checksum mismatch")
+
+        applied = skipped = rejected = 0
+        for entry in entries:
+            origin = entry["origin"]
+            origin_version = int(entry["origin_version"])
+            person_id = entry["person_id"]
+            if not _valid_person_id(person_id):
+                logger.warning(f"Rejecting gallery entry {person_id!r}: not a valid person id")
+                rejected += 1
+                continue
+
+            # Already applied, directly or via another node
+            if origin_version and origin_version <= self.seen.get(origin, 0):
+                skipped += 1
+                continue
+
+            # Last writer wins; origin id breaks timestamp ties deterministically
+            local = self.entries.get(person_id)
+            if local is not None and (local["timestamp"], local["origin"]) >= (entry["timestamp"], origin):
+                skipped += 1
+                continue
+
+            stamp = {"origin": origin, "origin_version": origin_version, "timestamp": entry["timestamp"]}
+            if entry["op"] == "enroll":
+                vector = _decode_vector(entry["vector"])
+                if "templates" in entry:
+                    vector = vector.reshape(int(entry["templates"]), -1)
+                if _vector_checksum(vector) != entry.get("checksum"):
+                    logger.warning(f"Rejecting gallery entry {person_id}: vector checksum mismatch")
+                    rejected += 1
+                    continue
+                self.enroll(person_id, vector, publish=False, tags=entry.get("tags"), **stamp)
+            elif entry["op"] == "delete":
+                self.remove(person_id, **stamp)
+            else:
+                rejected += 1
+                continue
+            applied += 1
+
+        if applied:
+            with self._lock:
+                self._publish()
+
+        logger.info(f"Applied gallery {payload.get('kind')} from {payload.get('node_id')}: "
+                    f"{applied} applied, {skipped} skipped, {rejected} rejected")
+        return {
+            "applied": applied,
+            "skipped": skipped,
+            "rejected": rejected,
+            "gallery_version": self.version
+        }
+
+    def close(self):
+        """Flush pending writes"""
+        self.writer.close()
+
+    def set_peer_cursor(self, peer: str, version: int):
+        """Remember the last peer version merged from `peer`"""
+        self.peers[peer] = version
+        self._save_meta()
+
+# Sharded search: people spread over worker processes by a hash of their id
+SHARD_LOAD_BATCH = 1000          # people per message when (re)loading a shard
+SHARD_FAILURES_BEFORE_SKIP = 3   # consecutive timeouts before a shard is skipped for a while
+SHARD_SKIP_SECONDS = 5.0         # how long a failing shard is skipped, and the restart backoff
+SHARD_START_TIMEOUT = 60.0       # startup wait for every shard to load its slice
+SHARD_CHECK_INTERVAL = 1.0       # how often the supervisor thread looks for dead shards
+
+def shard_of(person_id: str, shards: int) -> int:
+    """Shard that holds a person; stable across restarts"""
+    return zlib.crc32(person_id.encode("utf-8")) % shards
+
+def _shard_main(shard_id: int, conn):
+    """
+    Shard process: holds its slice of the gallery and answers local top-k searches
+
+    Updates are applied to a plain dict and folded into a new GalleryIndex
+    before the next search, or when the shard has been idle for a moment;
+    deletions are tombstoned in the live index straight away.
+    """
+    faces: Dict[str, np.ndarray] = {}
+    tags: Dict[str, Dict[str, str]] = {}
+    index = GalleryIndex({})
+    stale = False
+    while True:
+        if not conn.poll(0.5):
+            # Idle: compact tombstones and fold in updates off the search path
+            if stale or index.tombstones:
+                index, stale = GalleryIndex(faces, tags), False
+            continue
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        kind = message[0]
+        if kind == "upsert":
+            for person_id, templates, person_tags in message[1]:
+                faces[person_id] = templates
+                tags[person_id] = person_tags
+            stale = True
+        elif kind == "delete":
+            for person_id in message[1]:
+                faces.pop(person_id, None)
+                tags.pop(person_id, None)
+                index.tombstone(person_id)
+        elif kind == "search":
+            _, request_id, probes, k, method, scope = message
+            started = time.perf_counter()
+            if stale:
+                index, stale = GalleryIndex(faces, tags), False
+            searched = index.partition(scope) if scope else index
+            results = searched.top_k(probes, k, method)
+            conn.send(("result", request_id, results, time.perf_counter() - started, len(faces)))
+        elif kind == "ping":
+            # Answered once everything sent before it is loaded
+            conn.send(("result", message[1], [], 0.0, len(faces)))
+        elif kind == "stop":
+            return
+
+class _Shard:
+    """Coordinator-side handle of one shard process"""
+
+    def __init__(self, shard_id: int):
+        self.shard_id = shard_id
+        self.process = None
+        self.conn = None
+        self.ready: Optional[Future] = None   # resolved when the process has loaded its slice
+        self.send_lock = threading.Lock()
+        self.pending: Dict[int, Any] = {}
+        # Set while a (re)start loads the slice; sync() holds back changes in backlog meanwhile
+        self.starting = False
+        self.backlog: List[tuple] = []
+        self.people = 0
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.restarts = -1       # the first start is not a restart
+        self.consecutive_failures = 0
+        self.skip_until = 0.0
+        self.last_start = 0.0
+        self.latency = deque(maxlen=1000)   # round trip seen by the coordinator
+        self.compute = deque(maxlen=1000)   # search time inside the shard
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def available(self) -> bool:
+        """Alive and loaded, so worth waiting for"""
+        return self.alive() and self.ready is not None and self.ready.done() and self.ready.exception() is None
+
+class ShardedSearch:
+    """
+    Scatter-gather identification over gallery shards in local worker processes
+
+    FaceGalleryStore stays the system of record; each shard process holds
+    the templates of the people whose id hashes to it, so no process scans,
+    or needs memory for, the whole gallery. Store changes reach the shards
+    lazily from the store's append-only log before each search. A search
+    sends the probes to every shard, each returns its local top-k, and the
+    coordinator merges them. Shards that miss the timeout or have died are
+    left out and the answer is marked partial; a shard that keeps failing is
+    skipped for a while. A supervisor thread restarts and reloads dead
+    shards, which stay out of searches until they answer their ready ping.
+    """
+
+    def __init__(self, store: FaceGalleryStore, shards: int, timeout: float = 0.5):
+        """
+        Args:
+            store: The gallery the shards mirror
+            shards: Number of shard processes
+            timeout: Seconds a search waits for each shard
+        """
+        import multiprocessing
+        # Spawned, not forked: the parent has worker and writer threads running
+        self._context = multiprocessing.get_context("spawn")
+        self.store = store
+        self.timeout = timeout
+        self.shards = [_Shard(shard_id) for shard_id in range(max(1, shards))]
+        self._log_position = 0
+        self._sync_lock = threading.Lock()
+        self._request_ids = iter(range(1, 2**62))
+        self._id_lock = threading.Lock()
+        self.searches = 0
+        self.partial_searches = 0
+        self._closed = threading.Event()
+        with self._sync_lock, store._lock:
+            self._log_position = len(store.log)
+        starters = [threading.Thread(target=self._start, args=(shard,), daemon=True) for shard in self.shards]
+        for starter in starters:
+            starter.start()
+        for starter in starters:
+            starter.join()
+        _, loading = wait([shard.ready for shard in self.shards], timeout=SHARD_START_TIMEOUT)
+        if loading:
+            logger.warning(f"{len(loading)} gallery shards still loading; searches skip them until ready")
+        self._supervisor = threading.Thread(target=self._supervise, name="gallery-shard-supervisor", daemon=True)
+        self._supervisor.start()
+        logger.info(f"Sharded search over {len(self.shards)} processes ({len(store.faces)} people)")
+
+    def _start(self, shard: _Shard):
+        """
+        Start a shard process and load its slice
+
+        Only copying the slice happens under the locks. Spawning the process
+        and piping the slice to it do not, so searches and syncs carry on;
+        changes synced meanwhile wait in the shard's backlog and are sent
+        after the slice.
+        """
+        with self._id_lock:
+            request_id = next(self._request_ids)
+        with self._sync_lock:
+            shard.starting = True
+            shard.backlog = []
+            # A fresh unresolved ready future keeps the shard out of searches
+            shard.ready = Future()
+            shard.restarts += 1
+            shard.last_start = time.time()
+            with self.store._lock:
+                members = [(person_id, np.array(vector, dtype=np.float32), self.store.tags(person_id))
+                           for person_id, vector in self.store.faces.items()
+                           if shard_of(person_id, len(self.shards)) == shard.shard_id]
+
+        try:
+            parent_conn, child_conn = self._context.Pipe()
+            process = self._context.Process(target=_shard_main, args=(shard.shard_id, child_conn),
+                                            name=f"gallery-shard-{shard.shard_id}", daemon=True)
+            process.start()
+            child_conn.close()
+        except Exception as e:
+            logger.error(f"Could not start gallery shard {shard.shard_id}: {e}")
+            with self._sync_lock:
+                shard.starting = False
+                shard.backlog = []
+            shard.ready.set_exception(e)
+            return
+        shard.process, shard.conn = process, parent_conn
+        # Requests of a previous process are failed by its own reader, not this one's
+        shard.pending = {request_id: shard.ready}
+        shard.consecutive_failures = 0
+        shard.skip_until = 0.0
+        threading.Thread(target=self._read_results, args=(shard, parent_conn, shard.pending),
+                         name=f"gallery-shard-{shard.shard_id}-reader", daemon=True).start()
+
+        for offset in range(0, len(members), SHARD_LOAD_BATCH):
+            self._send(shard, ("upsert", members[offset:offset + SHARD_LOAD_BATCH]))
+        with self._sync_lock:
+            for message in shard.backlog:
+                self._send(shard, message)
+            shard.starting = False
+            shard.backlog = []
+        self._send(shard, ("ping", request_id))
+
+    def _supervise(self):
+        """Supervisor thread: restart shards whose process has died, after a backoff"""
+        while not self._closed.wait(SHARD_CHECK_INTERVAL):
+            for shard in self.shards:
+                if (not shard.starting and not shard.alive()
+                        and time.time() - shard.last_start >= SHARD_SKIP_SECONDS):
+                    logger.warning(f"Restarting gallery shard {shard.shard_id}")
+                    self._start(shard)
+
+    def _send(self, shard: _Shard, message: tuple) -> bool:
+        """Send to a shard; False (and the shard marked failed) if its pipe is gone"""
+        try:
+            with shard.send_lock:
+                shard.conn.send(message)
+            return True
+        except (OSError, ValueError, AttributeError) as e:
+            shard.errors += 1
+            logger.warning(f"Gallery shard {shard.shard_id} unreachable: {e}")
+            return False
+
+    def _read_results(self, shard: _Shard, conn, pending: Dict[int, Future]):
+        """Reader thread: hand each shard result to the search waiting for it"""
+        while True:
+            try:
+                _, request_id, results, compute_time, people = conn.recv()
+            except (EOFError, OSError):
+                break
+            shard.people = people
+            shard.compute.append(compute_time)
+            future = pending.pop(request_id, None)
+            if future is not None:
+                future.set_result(results)
+        # Process gone: fail whatever was still waiting on it
+        for request_id in list(pending):
+            future = pending.pop(request_id, None)
+            if future is not None:
+                future.set_exception(ConnectionError(f"Gallery shard {shard.shard_id} exited"))
+
+    def sync(self):
+        """Push store changes made since the last sync to the shards"""
+        store = self.store
+        with self._sync_lock:
+            if len(store.log) == self._log_position:
+                return
+            with store._lock:
+                latest: Dict[str, Dict[str, Any]] = {}
+                for record in store.log[self._log_position:]:
+                    latest[record["person_id"]] = record
+                self._log_position = len(store.log)
+
+                upserts: Dict[int, list] = {}
+                deletes: Dict[int, list] = {}
+                for person_id in latest:
+                    owner = shard_of(person_id, len(self.shards))
+                    vector = store.faces.get(person_id)
+                    if vector is None:
+                        deletes.setdefault(owner, []).append(person_id)
+                    else:
+                        upserts.setdefault(owner, []).append(
+                            (person_id, np.array(vector, dtype=np.float32), store.tags(person_id)))
+
+            for shard in self.shards:
+                messages = []
+                if shard.shard_id in upserts:
+                    messages.append(("upsert", upserts[shard.shard_id]))
+                if shard.shard_id in deletes:
+                    messages.append(("delete", deletes[shard.shard_id]))
+                if shard.starting:
+                    # Sent once the slice being loaded is in
+                    shard.backlog.extend(messages)
+                elif shard.alive():
+                    # A dead shard gets the current slice when it is restarted
+                    for message in messages:
+                        self._send(shard, message)
+
+    def search(self, probes: np.ndarray, k: int = 1, method: str = "max",
+               scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Top-k people for each probe across all shards
+
+        Args:
+            probes: (probes, dim) normalized face vectors
+            k: Candidates per probe
+            method: Template reduction, "max" or "mean"
+            scope: Partition tags to search within
+
+        Returns:
+            Per probe, up to k (person_id, similarity) pairs best first, and
+            the shards that did not answer
+        """
+        self.sync()
+        self.searches += 1
+        probes = np.ascontiguousarray(probes, dtype=np.float32)
+        now = time.time()
+        futures: Dict[Future, Tuple[_Shard, int, float]] = {}
+        missing = []
+        for shard in self.shards:
+            if not shard.available() or now < shard.skip_until:
+                missing.append(shard.shard_id)
+                continue
+            with self._id_lock:
+                request_id = next(self._request_ids)
+            future = Future()
+            started = time.perf_counter()
+            future.add_done_callback(self._latency_recorder(shard, started))
+            shard.pending[request_id] = future
+            shard.requests += 1
+            if not self._send(shard, ("search", request_id, probes, k, method, scope)):
+                shard.pending.pop(request_id, None)
+                missing.append(shard.shard_id)
+                continue
+            futures[future] = (shard, request_id, started)
+
+        _, not_done = wait(list(futures), timeout=self.timeout)
+        merged: List[List[Tuple[str, float]]] = [[] for _ in range(len(probes))]
+        for future, (shard, request_id, started) in futures.items():
+            if future in not_done or future.exception() is not None:
+                shard.pending.pop(request_id, None)
+                if future in not_done:
+                    shard.timeouts += 1
+                    # The shard took at least this long; leaving it out would flatter the percentiles
+                    shard.latency.append(time.perf_counter() - started)
+                else:
+                    shard.errors += 1
+                shard.consecutive_failures += 1
+                if shard.consecutive_failures >= SHARD_FAILURES_BEFORE_SKIP:
+                    shard.skip_until = time.time() + SHARD_SKIP_SECONDS
+                    logger.warning(f"Gallery shard {shard.shard_id} failing; skipped for {SHARD_SKIP_SECONDS}s")
+                missing.append(shard.shard_id)
+                continue
+            shard.consecutive_failures = 0
+            for probe, candidates in enumerate(future.result()):
+                merged[probe].extend(candidates)
+
+        if missing:
+            self.partial_searches += 1
+        return {
+            "results": [sorted(candidates, key=lambda c: -c[1])[:k] for candidates in merged],
+            "missing_shards": sorted(missing)
+        }
+
+    @staticmethod
+    def _latency_recorder(shard: _Shard, started: float) -> Any:
+        """
+        Done callback recording a shard's own round trip when its answer arrives
+
+        Timed-out requests are dropped from pending and never complete; search()
+        records the time they were waited for instead.
+        """
+        def callback(future: Future):
+            if future.exception() is None:
+                shard.latency.append(time.perf_counter() - started)
+        return callback
+
+    def get_metrics(self) -> Dict[str, Any]:
+        def percentiles(samples):
+            if not samples:
+                return {"p50": 0.0, "p95": 0.0}
+            values = np.fromiter(samples, dtype=np.float64) * 1000
+            return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95))}
+
+        now = time.time()
+        return {
+            "shards": len(self.shards),
+            "timeout": self.timeout,
+            "searches": self.searches,
+            "partial_searches": self.partial_searches,
+            "per_shard": [{
+                "shard": shard.shard_id,
+                "alive": shard.alive(),
+                "ready": shard.available(),
+                "skipped": now < shard.skip_until,
+                "people": shard.people,
+                "requests": shard.requests,
+                "timeouts": shard.timeouts,
+                "errors": shard.errors,
+                "restarts": shard.restarts,
+                "latency_ms": percentiles(shard.latency),
+                "compute_ms": percentiles(shard.compute)
+            } for shard in self.shards]
+        }
+
+    def close(self):
+        self._closed.set()
+        self._supervisor.join(timeout=SHARD_CHECK_INTERVAL + 1)
+        for shard in self.shards:
+            if shard.alive():
+                self._send(shard, ("stop",))
+                shard.process.join(timeout=1)
+                if shard.process.is_alive():
+                    shard.process.terminate()
+
+class VerificationSession:
+    """
+    Evidence accumulated over the frames of one live verification
+
+    Similarities of successive frames form a running mean. The session accepts
+    once the mean minus a confidence margin clears the threshold, rejects once
+    the mean plus the margin falls below it, and otherwise decides on the mean
+    when the frame budget runs out. The margin shrinks with 1/sqrt(frames), so
+    clear-cut cases finish in a frame or two and only borderline ones use the
+    whole budget.
+    """
+
+    def __init__(self, person_id: Optional[str] = None, threshold: float = 0.4, max_frames: int = 10,
+                 min_frames: int = 2, confidence: float = 2.0, scope: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            person_id: Claimed identity; when omitted the best match of the
+                first usable frame is verified over the following frames
+            threshold: Similarity the running mean has to clear
+            max_frames: Frame budget, counting frames without a usable face
+            min_frames: Scored frames required before an early decision
+            confidence: Margin width in standard errors
+            scope: Partition tags the identity is searched in
+        """
+        self.session_id = uuid.uuid4().hex[:16]
+        self.person_id = person_id
+        self.claimed = person_id is not None
+        self.threshold = threshold
+        self.max_frames = max(1, max_frames)
+        self.min_frames = max(1, min(min_frames, self.max_frames))
+        self.confidence = confidence
+        self.scope = scope
+        self.frames = 0
+        self.scores: List[float] = []
+        self.decision: Optional[str] = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, similarity: Optional[float]) -> Optional[str]:
+        """Fold in one frame (None when it had no usable face); returns the decision once made"""
+        self.frames += 1
+        self.last_used = time.time()
+        if similarity is not None:
+            self.scores.append(float(similarity))
+
+        count = len(self.scores)
+        if count >= self.min_frames:
+            mean = float(np.mean(self.scores))
+            # Floor the spread so two identical frames don't look certain
+            spread = max(float(np.std(self.scores)), 0.02)
+            margin = self.confidence * spread / np.sqrt(count)
+            if mean - margin >= self.threshold:
+                self.decision = "accept"
+            elif mean + margin < self.threshold:
+                self.decision = "reject"
+
+        if self.decision is None and self.frames >= self.max_frames:
+            self.decision = "accept" if count and np.mean(self.scores) >= self.threshold else "reject"
+        return self.decision
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "decision": self.decision or "pending",
+            "person_id": self.person_id,
+            "score": float(np.mean(self.scores)) if self.scores else 0.0,
+            "frames_used": self.frames,
+            "frames_scored": len(self.scores),
+            "max_frames": self.max_frames,
+            "budget_exhausted": self.decision is not None and self.frames >= self.max_frames
+        }
+
 class EnhancedAndroidFaceDetector:
     """Enhanced lightweight face detector for Android"""
 
-    def __init__(self):
-        """Initialize the detector with OpenCV's Haar cascade"""
+    def __init__(self, detection_mode: str = "haar", eye_check: str = "always",
+                 eye_sample_every: int = 4, lbp_cascade_path: Optional[str] = None,
+                 quality_gate: str = "flag", quality_thresholds: Optional[Dict[str, float]] = None,
+                 durability: str = "batch", duplicate_policy: str = "warn",
+                 duplicate_threshold: float = 0.95, memory_limit: int = 0,
+                 pressure_max_frame_bytes: int = 1024 * 1024, max_templates: int = 5,
+                 template_eviction: str = "outlier", template_reduce: str = "max",
+                 shards: int = 0, shard_timeout: float = 0.5):
+        """
+        Initialize the detector with OpenCV cascades
+
+        Args:
+            detection_mode: Default model, "haar" or "lbp" (fast mode)
+            eye_check: Eye verification policy: "always", "sampled" or "off"
+            eye_sample_every: With "sampled", check eyes on every Nth detect request
+            lbp_cascade_path: LBP cascade file; searched for in OpenCV's data dirs if omitted
+            quality_gate: What to do with unusable frames: "reject", "flag" or "off"
+            quality_thresholds: Overrides for DEFAULT_QUALITY_THRESHOLDS
+            durability: Gallery persistence mode: "sync", "batch" or "none"
+            duplicate_policy: Enrolling a face that matches another person id:
+                "warn", "reject" or "off"
+            duplicate_threshold: Similarity at which two enrollments count as the same face
+            memory_limit: Resident memory ceiling in bytes (0 disables it); on reaching it
+                caches are evicted, the gallery moves to disk and large frames are refused
+            pressure_max_frame_bytes: Largest encoded frame accepted while over the ceiling
+            max_templates: Templates kept per person; registering beyond it evicts one
+            template_eviction: Which template goes: "outlier" (least like the rest) or "oldest"
+            template_reduce: Person score from template scores: "max" or "mean"
+            shards: Spread gallery searches over this many worker processes (0 searches in-process)
+            shard_timeout: Seconds a sharded search waits for each shard before answering without it
+        """
         # Use Haar cascade for face detection (lightweight)
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self._cascade_paths = {
+            "haar": cv2.data.haarcascades + 'haarcascade_frontalface_default.xml',
+            "eye": cv2.data.haarcascades + 'haarcascade_eye.xml'
+        }
+        self.face_cascade = cv2.CascadeClassifier(self._cascade_paths["haar"])
+        self.cascades = {"haar": self.face_cascade}
+
+        # Cascade classifiers are not safe to share between worker threads
+        self._local = threading.local()
+
+        # LBP cascade for the fast mode: several times cheaper per frame than Haar
+        lbp_cascade_path = lbp_cascade_path or find_lbp_cascade()
+        lbp_cascade = cv2.CascadeClassifier(lbp_cascade_path) if lbp_cascade_path else None
+        if lbp_cascade is not None and not lbp_cascade.empty():
+            self._cascade_paths["lbp"] = lbp_cascade_path
+            self.cascades["lbp"] = lbp_cascade
+            logger.info(f"LBP fast mode available: {lbp_cascade_path}")
+        elif lbp_cascade is not None:
+            # OpenCV returns an empty classifier rather than raising for a bad file
+            logger.warning(f"Could not load LBP cascade {lbp_cascade_path}, fast mode falls back to Haar")
+        elif detection_mode == "lbp":
+            logger.warning("LBP cascade not found, fast mode falls back to Haar")
+
+        self.detection_mode = MODEL_ALIASES.get(detection_mode, "haar")
+        if eye_check not in ("always", "sampled", "off"):
+            raise ValueError(f"Unknown eye check policy: {eye_check}")
+        self.eye_check = eye_check
+        self.eye_sample_every = max(1, eye_sample_every)
+        self._eye_check_counter = 0
+
+        # Requests run on several worker threads; metric counters are updated under this lock
+        self._stats_lock = threading.Lock()
+
+        # Cheap pre-filter for blurred, black or overexposed frames
+        if quality_gate not in ("reject", "flag", "off"):
+            raise ValueError(f"Unknown quality gate mode: {quality_gate}")
+        self.quality_gate = quality_gate
+        self.quality_thresholds = dict(DEFAULT_QUALITY_THRESHOLDS, **(quality_thresholds or {}))
+        self.quality_checked = 0
+        self.quality_flagged = 0
+        self.quality_rejected = 0
+        self.quality_reasons: Dict[str, int] = {}
+        self.quality_check_time = 0.0
+
+        # Near-duplicate check at enrollment
+        if duplicate_policy not in ("warn", "reject", "off"):
+            raise ValueError(f"Unknown duplicate policy: {duplicate_policy}")
+        self.duplicate_policy = duplicate_policy
+        self.duplicate_threshold = duplicate_threshold
+        self.duplicates_warned = 0
+        self.duplicates_rejected = 0
+
+        # Several templates per person, scored together
+        if template_eviction not in ("outlier", "oldest"):
+            raise ValueError(f"Unknown template eviction policy: {template_eviction}")
+        if template_reduce not in ("max", "mean"):
+            raise ValueError(f"Unknown template reduction: {template_reduce}")
+        self.max_templates = max(1, max_templates)
+        self.template_eviction = template_eviction
+        self.template_reduce = template_reduce
+        self.templates_evicted = 0
+
+        # Memory accounting and the optional ceiling
+        self.memory_limit = memory_limit
+        self.pressure_max_frame_bytes = pressure_max_frame_bytes
+        self.memory_pressure = False
+        self.pressure_events = 0
+        self.frames_refused = 0
+        self.cache_bytes_evicted = 0
+        self._last_memory_check = 0.0
+        self._frames_lock = threading.Lock()
+        self.inflight_frames = 0
+        self.inflight_frame_bytes = 0
+        self.peak_inflight_frame_bytes = 0
+
+        # ROI-hinted detection metrics
+        self.roi_requests = 0
+        self.roi_hits = 0
+        self.roi_misses = 0
+        self.roi_time_saved = 0.0    # full scans avoided by hits
+        self.roi_miss_time = 0.0     # crop scans wasted by misses
+        self._full_scan_time: Dict[str, float] = {}  # moving average per model
 
         # Also load the eye cascade for better verification
-        self.eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+        self.eye_cascade = cv2.CascadeClassifier(self._cascade_paths["eye"])
 
         # Create directories for temporary files and face database
         os.makedirs("temp", exist_ok=True)
         os.makedirs("face_db", exist_ok=True)
 
         # Initialize face database
-        self.face_database = {}
-        self._load_face_database()
+        self.gallery = FaceGalleryStore("face_db", durability)
+        self.shards = None
+        if shards > 0:
+            # The shards hold the vectors; this process keeps only the memory-mapped copy,
+            # which enrollments append to and only compaction rewrites
+            self.gallery.use_disk_index()
+            self.shards = ShardedSearch(self.gallery, shards, shard_timeout)
 
         # Performance metrics
         self.total_requests = 0
@@ -60,47 +1901,300 @@ class EnhancedAndroidFaceDetector:
         logger.info(f"OpenCV version: {cv2.__version__}")
         logger.info(f"Running on: {platform.system()} {platform.release()}")
 
-    def _load_face_database(self):
-        """Load face database from disk"""
+    def _count(self, **increments):
+        """Add to metric counters atomically"""
+        with self._stats_lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def check_memory(self, force: bool = False):
+        """Enter or leave the bounded-footprint mode; checked at most once a second"""
+        if not self.memory_limit:
+            return
+        now = time.time()
+        if not force and now - self._last_memory_check < 1.0:
+            return
+        self._last_memory_check = now
+
+        rss = process_rss()
+        if rss is None:
+            rss = self.memory_usage()["accounted"]
+        if rss >= self.memory_limit and not self.memory_pressure:
+            self.memory_pressure = True
+            self._count(pressure_events=1)
+            logger.warning(f"Memory ceiling reached ({rss / 2**20:.0f} of {self.memory_limit / 2**20:.0f} MB): "
+                           f"evicting caches and moving the gallery to disk")
+            self._count(cache_bytes_evicted=self.gallery.index.clear_partitions())
+            self.gallery.use_disk_index()
+            gc.collect()
+        elif rss < 0.9 * self.memory_limit and self.memory_pressure:
+            # The gallery stays on disk; only frame size limits are lifted
+            self.memory_pressure = False
+            logger.info("Memory back under the ceiling")
+
+    def release_frames(self):
+        """Forget the frames this worker thread decoded for the finished request"""
+        frame_bytes = getattr(self._local, "frame_bytes", 0)
+        frames = getattr(self._local, "frames", 0)
+        if frames:
+            with self._frames_lock:
+                self.inflight_frames -= frames
+                self.inflight_frame_bytes -= frame_bytes
+            self._local.frames = self._local.frame_bytes = 0
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Accounted bytes of the gallery, caches and in-flight frames"""
+        gallery = self.gallery.memory_usage()
+        accounted = gallery["vectors"] + gallery["index"] + gallery["partitions"] + self.inflight_frame_bytes
+        return {
+            "rss": process_rss(),
+            "limit": self.memory_limit,
+            "under_pressure": self.memory_pressure,
+            "accounted": accounted,
+            "gallery_vectors": gallery["vectors"],
+            "gallery_index": gallery["index"],
+            "gallery_on_disk": gallery["on_disk"],
+            "partition_cache": gallery["partitions"],
+            "inflight_frames": self.inflight_frames,
+            "inflight_frame_bytes": self.inflight_frame_bytes,
+            "peak_inflight_frame_bytes": self.peak_inflight_frame_bytes,
+            "pressure_events": self.pressure_events,
+            "frames_refused": self.frames_refused,
+            "cache_bytes_evicted": self.cache_bytes_evicted,
+            "tracemalloc": tracemalloc.is_tracing()
+        }
+
+    def resolve_model(self, model: Optional[str] = None) -> str:
+        """Map a requested model name to an available cascade, defaulting to the configured mode"""
+        model = MODEL_ALIASES.get(model or "", self.detection_mode)
+        return model if model in self.cascades else "haar"
+
+    def model_name(self, model: Optional[str] = None) -> str:
+        """Protocol name of the model that will serve a request"""
+        return DETECTION_MODELS[self.resolve_model(model)]
+
+    def _cascade(self, name: str) -> cv2.CascadeClassifier:
+        """This thread's instance of a cascade ("haar", "lbp" or "eye")"""
+        cascades = getattr(self._local, "cascades", None)
+        if cascades is None:
+            cascades = self._local.cascades = {}
+        cascade = cascades.get(name)
+        if cascade is None:
+            cascade = cascades[name] = cv2.CascadeClassifier(self._cascade_paths[name])
+        return cascade
+
+    def _detect_face_rects(self, gray: np.ndarray, model: Optional[str] = None) -> np.ndarray:
+        """Run the face cascade for model over a grayscale image"""
+        model = self.resolve_model(model)
+        with trace_span("detect"):
+            if model == "lbp":
+                # LBP tolerates a coarser pyramid; that is most of the fast mode's speedup
+                return self._cascade("lbp").detectMultiScale(
+                    gray,
+                    scaleFactor=1.2,
+                    minNeighbors=4,
+                    minSize=(30, 30)
+                )
+            return self._cascade("haar").detectMultiScale(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=5,
+                minSize=(30, 30),
+                flags=cv2.CASCADE_SCALE_IMAGE
+            )
+
+    def _locate_faces(self, gray: np.ndarray, model: Optional[str] = None,
+                      roi: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        """
+        Detect faces, searching around a previous bounding box first
+
+        Args:
+            gray: Grayscale image
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            roi: The client's previous boundingBox ({x, y, width, height}); the
+                expanded crop around it is scanned and the full frame only on a miss
+
+        Returns:
+            Face rectangles in full-frame coordinates
+        """
+        model = self.resolve_model(model)
+        crop = self._expand_roi(roi, gray.shape) if roi else None
+
+        if crop is not None:
+            self._count(roi_requests=1)
+            x0, y0, x1, y1 = crop
+            start_time = time.perf_counter()
+            faces = self._detect_face_rects(gray[y0:y1, x0:x1], model)
+            elapsed = time.perf_counter() - start_time
+            if len(faces) > 0:
+                self._count(roi_hits=1, roi_time_saved=max(0.0, self._full_scan_time.get(model, elapsed) - elapsed))
+                faces = np.array(faces)
+                faces[:, 0] += x0
+                faces[:, 1] += y0
+                return faces
+            # A miss pays for the crop scan on top of the full one
+            self._count(roi_misses=1, roi_miss_time=elapsed)
+
+        start_time = time.perf_counter()
+        faces = self._detect_face_rects(gray, model)
+        elapsed = time.perf_counter() - start_time
+        with self._stats_lock:
+            previous = self._full_scan_time.get(model)
+            self._full_scan_time[model] = elapsed if previous is None else 0.9 * previous + 0.1 * elapsed
+        return faces
+
+    @staticmethod
+    def _expand_roi(roi: Dict[str, Any], shape: Tuple[int, ...]) -> Optional[Tuple[int, int, int, int]]:
+        """Expand and clamp a bounding box hint; None if it is unusable"""
         try:
-            face_files = os.listdir("face_db")
-            for face_file in face_files:
-                if face_file.endswith(".npy"):
-                    person_id = face_file.split(".")[0]
-                    face_data = np.load(os.path.join("face_db", face_file))
-                    self.face_database[person_id] = face_data
+            x, y = float(roi["x"]), float(roi["y"])
+            w, h = float(roi["width"]), float(roi["height"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if w <= 0 or h <= 0:
+            return None
 
-            logger.info(f"Loaded {len(self.face_database)} faces from database")
-        except Exception as e:
-            logger.error(f"Error loading face database: {e}")
+        height, width = shape[:2]
+        x0 = max(0, int(x - w * ROI_EXPAND))
+        y0 = max(0, int(y - h * ROI_EXPAND))
+        x1 = min(width, int(x + w * (1 + ROI_EXPAND)))
+        y1 = min(height, int(y + h * (1 + ROI_EXPAND)))
+        # Too small to hold a face, or no smaller than the full scan it would replace
+        if x1 - x0 < 30 or y1 - y0 < 30 or (x1 - x0) * (y1 - y0) >= width * height:
+            return None
+        return x0, y0, x1, y1
+
+    def _should_check_eyes(self, check_eyes: Optional[bool]) -> bool:
+        """Apply the eye verification policy unless the request overrides it"""
+        if check_eyes is not None:
+            return bool(check_eyes)
+        if self.eye_check == "sampled":
+            with self._stats_lock:
+                self._eye_check_counter += 1
+                return (self._eye_check_counter - 1) % self.eye_sample_every == 0
+        return self.eye_check == "always"
 
-    def detect_faces(self, image: np.ndarray, min_confidence: float = 0.3) -> List[Dict[str, Any]]:
+    def check_frame_quality(self, image: np.ndarray) -> Optional[Dict[str, Any]]:
+        """
+        Score a frame for brightness, contrast and blur before detection
+
+        Works on a tiny grayscale downsample, so it costs a fraction of a
+        millisecond even for camera-sized frames.
+
+        Args:
+            image: The image as a numpy array
+
+        Returns:
+            None when the gate is off, otherwise the scores, a reason code for
+            the first failed check (or None) and whether the frame is rejected
+        """
+        if self.quality_gate == "off":
+            return None
+
+        start_time = time.perf_counter()
+
+        # Strided subsample: a view, so nothing is copied until the tiny sample
+        step = max(1, image.shape[1] // QUALITY_SAMPLE_WIDTH)
+        sample = np.ascontiguousarray(image[::step, ::step])
+        gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY) if sample.ndim == 3 else sample
+
+        mean, stddev = cv2.meanStdDev(gray)
+        brightness = float(mean[0][0])
+        contrast = float(stddev[0][0])
+        sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+        thresholds = self.quality_thresholds
+        reason = None
+        if brightness < thresholds["min_brightness"]:
+            reason = "too_dark"
+        elif brightness > thresholds["max_brightness"]:
+            reason = "overexposed"
+        elif contrast < thresholds["min_contrast"]:
+            reason = "low_contrast"
+        elif sharpness < thresholds["min_sharpness"]:
+            reason = "blurry"
+
+        elapsed = time.perf_counter() - start_time
+
+        # Update metrics
+        rejected = reason is not None and self.quality_gate == "reject"
+        with self._stats_lock:
+            self.quality_checked += 1
+            self.quality_check_time += elapsed
+            if reason is not None:
+                self.quality_reasons[reason] = self.quality_reasons.get(reason, 0) + 1
+                if rejected:
+                    self.quality_rejected += 1
+                else:
+                    self.quality_flagged += 1
+
+        return {
+            "brightness": brightness,
+            "contrast": contrast,
+            "sharpness": sharpness,
+            "reason": reason,
+            "rejected": rejected,
+            "check_time": elapsed
+        }
+
+    @staticmethod
+    def _rejected_frame_result(quality: Dict[str, Any], start_time: float) -> Dict[str, Any]:
+        """Result for a frame turned away by the quality gate"""
+        return {
+            "success": False,
+            "message": f"Frame rejected: {quality['reason']}",
+            "reason": quality["reason"],
+            "quality": quality,
+            "processing_time": time.time() - start_time
+        }
+
+    @staticmethod
+    def _with_quality(result: Dict[str, Any], quality: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Attach the quality report of a frame the gate flagged but let through"""
+        if quality is not None and quality["reason"]:
+            result["quality"] = quality
+        return result
+
+    @property
+    def face_database(self) -> Dict[str, np.ndarray]:
+        """Enrolled face vectors keyed by person id"""
+        return self.gallery.faces
+
+    def detect_faces(self, image: np.ndarray, min_confidence: float = 0.3,
+                     model: Optional[str] = None, check_eyes: Optional[bool] = None,
+                     quality: Optional[Dict[str, Any]] = None,
+                     roi: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Detect faces in an image
 
         Args:
             image: The image as a numpy array
             min_confidence: Minimum confidence threshold
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            check_eyes: Force eye verification on or off for this request
+            quality: Result of check_frame_quality if the caller already ran it
+            roi: Previous boundingBox of the subject, searched before the full frame
 
         Returns:
             List of detected faces with their bounding boxes and landmarks
         """
         # Update metrics
-        self.total_requests += 1
+        self._count(total_requests=1)
         start_time = time.time()
 
         try:
+            # Skip detection entirely for frames that cannot yield a match
+            if quality is None:
+                quality = self.check_frame_quality(image)
+            if quality is not None and quality["rejected"]:
+                return []
+
             # Convert to grayscale for face detection
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
             # Detect faces
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            faces = self._locate_faces(gray, model, roi)
+            check_eyes = self._should_check_eyes(check_eyes)
 
             # Process detected faces
             result = []
@@ -115,8 +2209,9 @@ class EnhancedAndroidFaceDetector:
                 # Extract face ROI
                 face_roi = gray[y:y+h, x:x+w]
 
-                # Detect eyes to verify this is a real face
-                eyes = self.eye_cascade.detectMultiScale(face_roi)
+                # Detect eyes to verify this is a real face (skipped when sampled out)
+                with trace_span("eyes"):
+                    eyes = self._cascade("eye").detectMultiScale(face_roi) if check_eyes else []
 
                 # Create face object
                 face = {
@@ -129,7 +2224,8 @@ class EnhancedAndroidFaceDetector:
                     },
                     "confidence": float(confidence),
                     "landmarks": {},
-                    "eyesDetected": len(eyes)
+                    "eyesDetected": len(eyes),
+                    "eyesChecked": check_eyes
                 }
 
                 # Add landmarks (eye positions) if detected
@@ -146,18 +2242,18 @@ class EnhancedAndroidFaceDetector:
 
             # Update metrics
             processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
+            self._count(total_processing_time=processing_time)
             if len(result) > 0:
-                self.successful_requests += 1
+                self._count(successful_requests=1)
 
             return result
         except Exception as e:
             logger.error(f"Error detecting faces: {e}")
-            logger.error(traceback.format_exc())
+            record_exception(e)
 
             # Update metrics
             processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
+            self._count(total_processing_time=processing_time)
 
             return []
 
@@ -170,141 +2266,324 @@ class EnhancedAndroidFaceDetector:
             face2: Second face image
 
         Returns:
-            Dictionary with similarity metrics
+            Dictionary with similarity metrics
+        """
+        try:
+            # Resize images to the same size
+            face1 = cv2.resize(face1, (128, 128))
+            face2 = cv2.resize(face2, (128, 128))
+
+            # Convert to grayscale
+            gray1 = cv2.cvtColor(face1, cv2.COLOR_BGR2GRAY)
+            gray2 = cv2.cvtColor(face2, cv2.COLOR_BGR2GRAY)
+
+            # Calculate histograms
+            hist1 = cv2.calcHist([gray1], [0], None, [256], [0, 256])
+            hist2 = cv2.calcHist([gray2], [0], None, [256], [0, 256])
+
+            # Normalize histograms
+            cv2.normalize(hist1, hist1, 0, 1, cv2.NORM_MINMAX)
+            cv2.normalize(hist2, hist2, 0, 1, cv2.NORM_MINMAX)
+
+            # Compare histograms
+            similarity = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
+            distance = 1.0 - similarity
+
+            # Determine if it's a match
+            match = similarity >= 0.7
+
+            return {
+                "similarity": float(similarity),
+                "distance": float(distance),
+                "match": match,
+                "metrics": {
+                    "histogram": {
+                        "similarity": float(similarity),
+                        "distance": float(distance)
+                    }
+                }
+            }
+        except Exception as e:
+            logger.error(f"Error comparing faces: {e}")
+            record_exception(e)
+            return {
+                "similarity": 0.0,
+                "distance": 1.0,
+                "match": False,
+                "error": str(e)
+            }
+
+    def face_vectors(self, gray: np.ndarray, rects) -> np.ndarray:
+        """
+        Normalized gallery vectors for face rectangles of a grayscale frame
+
+        Returns:
+            One unit-length row per rectangle
+        """
+        vectors = np.empty((len(rects), 100 * 100), dtype=np.float32)
+        for row, (x, y, w, h) in enumerate(rects):
+            face_roi = cv2.resize(gray[y:y+h, x:x+w], (100, 100))
+            vectors[row] = cv2.equalizeHist(face_roi).ravel()
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def _search_index(self, scope: Optional[Dict[str, Any]]) -> GalleryIndex:
+        """The gallery index, narrowed to a partition when a scope is given"""
+        index = self.gallery.index
+        if scope:
+            index = index.partition(scope)
+        return index
+
+    def _matches(self, probes: np.ndarray, k: int, scope: Optional[Dict[str, Any]] = None,
+                 method: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Top-k people per probe, from the gallery shards when sharded, else the local index
+
+        Returns:
+            "results": per probe, (person_id, similarity) pairs best first;
+            "missing_shards": shards left out of a partial answer
+        """
+        method = method or self.template_reduce
+        with trace_span("match"):
+            if self.shards is not None:
+                return self.shards.search(probes, k, method, scope)
+            return {"results": self._search_index(scope).top_k(probes, k, method), "missing_shards": []}
+
+    def score_frame(self, image: np.ndarray, person_id: Optional[str] = None, model: Optional[str] = None,
+                    roi: Optional[Dict[str, Any]] = None, scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Similarity of the largest face in a frame to one person, or to the best match
+
+        Returns:
+            Dictionary with person_id and similarity, or a message when the
+            frame had no usable face
+        """
+        self._count(total_requests=1)
+        start_time = time.time()
+
+        quality = self.check_frame_quality(image)
+        if quality is not None and quality["rejected"]:
+            return self._rejected_frame_result(quality, start_time)
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        faces = self._locate_faces(gray, model, roi)
+        if len(faces) == 0:
+            return {
+                "success": False,
+                "message": "No faces detected",
+                "processing_time": time.time() - start_time
+            }
+
+        largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
+        with trace_span("encode"):
+            face_vector = self.face_vectors(gray, [largest_face])[0]
+
+        missing_shards = []
+        if person_id is not None:
+            # One person's templates: scored here even when sharded
+            with trace_span("match"):
+                similarity = self._search_index(scope).person_similarity(person_id, face_vector,
+                                                                         self.template_reduce)
+            if similarity is None:
+                raise KeyError(f"{person_id} is not enrolled" + (" in this scope" if scope else ""))
+        else:
+            found = self._matches(face_vector[np.newaxis], 1, scope)
+            missing_shards = found["missing_shards"]
+            person_id, similarity = found["results"][0][0] if found["results"][0] else (None, 0.0)
+
+        processing_time = time.time() - start_time
+        self._count(total_processing_time=processing_time)
+        x, y, w, h = largest_face
+        result = {
+            "success": True,
+            "person_id": person_id,
+            "similarity": similarity,
+            "boundingBox": {"x": int(x), "y": int(y), "width": int(w), "height": int(h)},
+            "processing_time": processing_time
+        }
+        if missing_shards:
+            result["missing_shards"] = missing_shards
+        return result
+
+    def identify_all_faces(self, image: np.ndarray, min_similarity: float = 0.4,
+                           model: Optional[str] = None, scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Identify every face in a frame
+
+        All faces are normalized into one probe matrix and scored against the
+        gallery (or each shard) with a single matrix product.
+
+        Args:
+            image: The image as a numpy array
+            min_similarity: Minimum similarity threshold
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            scope: Partition tags to search within, e.g. {"unit": "A"}
+
+        Returns:
+            Dictionary with one identification per detected face
         """
+        # Update metrics
+        self._count(total_requests=1)
+        start_time = time.time()
+
         try:
-            # Resize images to the same size
-            face1 = cv2.resize(face1, (128, 128))
-            face2 = cv2.resize(face2, (128, 128))
+            quality = self.check_frame_quality(image)
+            if quality is not None and quality["rejected"]:
+                return self._rejected_frame_result(quality, start_time)
 
-            # Convert to grayscale
-            gray1 = cv2.cvtColor(face1, cv2.COLOR_BGR2GRAY)
-            gray2 = cv2.cvtColor(face2, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            faces = self._locate_faces(gray, model, None)
 
-            # Calculate histograms
-            hist1 = cv2.calcHist([gray1], [0], None, [256], [0, 256])
-            hist2 = cv2.calcHist([gray2], [0], None, [256], [0, 256])
+            if len(faces) == 0:
+                return self._with_quality({
+                    "success": False,
+                    "message": "No faces detected",
+                    "processing_time": time.time() - start_time
+                }, quality)
 
-            # Normalize histograms
-            cv2.normalize(hist1, hist1, 0, 1, cv2.NORM_MINMAX)
-            cv2.normalize(hist2, hist2, 0, 1, cv2.NORM_MINMAX)
+            with trace_span("encode"):
+                probes = self.face_vectors(gray, faces)
 
-            # Compare histograms
-            similarity = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
-            distance = 1.0 - similarity
+            found = self._matches(probes, 1, scope)
 
-            # Determine if it's a match
-            match = similarity >= 0.7
+            results = []
+            for (x, y, w, h), ranked in zip(faces, found["results"]):
+                match, similarity = ranked[0] if ranked else (None, 0.0)
+                matched = match is not None and similarity >= min_similarity
+                results.append({
+                    "boundingBox": {
+                        "x": int(x),
+                        "y": int(y),
+                        "width": int(w),
+                        "height": int(h)
+                    },
+                    "person_id": match if matched else None,
+                    "similarity": float(similarity)
+                })
 
-            return {
-                "similarity": float(similarity),
-                "distance": float(distance),
-                "match": match,
-                "metrics": {
-                    "histogram": {
-                        "similarity": float(similarity),
-                        "distance": float(distance)
-                    }
-                }
+            processing_time = time.time() - start_time
+            self._count(total_processing_time=processing_time)
+            if any(face["person_id"] for face in results):
+                self._count(successful_requests=1)
+
+            result = {
+                "success": True,
+                "faces": results,
+                "processing_time": processing_time
             }
+            if found["missing_shards"]:
+                result["missing_shards"] = found["missing_shards"]
+            return self._with_quality(result, quality)
         except Exception as e:
-            logger.error(f"Error comparing faces: {e}")
-            logger.error(traceback.format_exc())
+            logger.error(f"Error identifying faces: {e}")
+            record_exception(e)
+
+            processing_time = time.time() - start_time
+            self._count(total_processing_time=processing_time)
+
             return {
-                "similarity": 0.0,
-                "distance": 1.0,
-                "match": False,
-                "error": str(e)
+                "success": False,
+                "message": f"Error: {str(e)}",
+                "processing_time": processing_time
             }
 
-    def identify_face(self, image: np.ndarray, min_similarity: float = 0.4) -> Dict[str, Any]:
+    def identify_face(self, image: np.ndarray, min_similarity: float = 0.4,
+                      model: Optional[str] = None, roi: Optional[Dict[str, Any]] = None,
+                      top_k: int = 0, scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Identify a face in the database
 
         Args:
             image: The image as a numpy array
             min_similarity: Minimum similarity threshold
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            roi: Previous boundingBox of the subject, searched before the full frame
+            top_k: Also return this many best candidates with their similarities,
+                whether or not they pass min_similarity
+            scope: Partition tags to search within, e.g. {"unit": "A"} or
+                {"site": ["north", "south"]}; the whole gallery when omitted
 
         Returns:
             Dictionary with identification results
         """
         # Update metrics
-        self.total_requests += 1
+        self._count(total_requests=1)
         start_time = time.time()
 
         try:
+            # Skip detection entirely for frames that cannot yield a match
+            quality = self.check_frame_quality(image)
+            if quality is not None and quality["rejected"]:
+                return self._rejected_frame_result(quality, start_time)
+
             # Convert to grayscale
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
             # Detect faces
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            faces = self._locate_faces(gray, model, roi)
 
             # No faces detected
             if len(faces) == 0:
-                return {
+                return self._with_quality({
                     "success": False,
                     "message": "No faces detected",
                     "processing_time": time.time() - start_time
-                }
+                }, quality)
 
             # Use the largest face
             largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
-            x, y, w, h = largest_face
 
             # Extract face ROI and normalize
-            face_roi = gray[y:y+h, x:x+w]
-            face_roi = cv2.resize(face_roi, (100, 100))
-            face_roi = cv2.equalizeHist(face_roi)
+            with trace_span("encode"):
+                face_vector = self.face_vectors(gray, [largest_face])[0]
 
-            # Flatten the face for comparison
-            face_vector = face_roi.flatten().astype(np.float32)
-            face_vector = face_vector / np.linalg.norm(face_vector)
-
-            # Compare with database
+            # Compare with database (cosine similarity against every template at once, reduced per person)
             best_match = None
             best_similarity = 0
+            candidates = []
 
-            for person_id, stored_face in self.face_database.items():
-                # Calculate similarity (cosine similarity)
-                similarity = np.dot(face_vector, stored_face)
-
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = person_id
+            found = self._matches(face_vector[np.newaxis], max(top_k, 1), scope)
+            ranked = found["results"][0]
+            if ranked and ranked[0][1] > best_similarity:
+                best_match, best_similarity = ranked[0]
+            if top_k > 0:
+                candidates = [
+                    {"person_id": person_id, "similarity": similarity}
+                    for person_id, similarity in ranked
+                ]
 
             # Update metrics
             processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
+            self._count(total_processing_time=processing_time)
 
             # Check if we have a good match - using reduced threshold
             if best_match and best_similarity >= min_similarity:
-                self.successful_requests += 1
-                return {
+                self._count(successful_requests=1)
+                result = {
                     "success": True,
                     "person_id": best_match,
                     "similarity": float(best_similarity),
                     "processing_time": processing_time
                 }
             else:
-                return {
+                result = {
                     "success": False,
                     "message": "No match found",
                     "best_similarity": float(best_similarity) if best_match else 0,
                     "processing_time": processing_time
                 }
+            if top_k > 0:
+                result["candidates"] = candidates
+            if found["missing_shards"]:
+                result["missing_shards"] = found["missing_shards"]
+            return self._with_quality(result, quality)
         except Exception as e:
             logger.error(f"Error identifying face: {e}")
-            logger.error(traceback.format_exc())
+            record_exception(e)
 
             # Update metrics
             processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
+            self._count(total_processing_time=processing_time)
 
             return {
                 "success": False,
@@ -312,308 +2591,908 @@ class EnhancedAndroidFaceDetector:
                 "processing_time": processing_time
             }
 
-    def register_face(self, image: np.ndarray, person_id: str) -> Dict[str, Any]:
+    def find_duplicates(self, face_vector: np.ndarray, person_id: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Other enrolled people with a template at least duplicate_threshold similar"""
+        with trace_span("dedup"):
+            # One spare candidate in case the person's own templates rank
+            ranked = self._matches(face_vector[np.newaxis], limit + 1, method="max")["results"][0]
+        return [
+            {"person_id": match, "similarity": similarity}
+            for match, similarity in ranked
+            if similarity >= self.duplicate_threshold and match != person_id
+        ][:limit]
+
+    def register_face(self, image: np.ndarray, person_id: str, model: Optional[str] = None,
+                      tags: Optional[Dict[str, str]] = None, allow_duplicate: bool = False,
+                      replace: bool = False) -> Dict[str, Any]:
         """
         Register a face in the database
 
+        Each registration adds a template to the person, up to max_templates;
+        beyond that the template_eviction policy drops one.
+
         Args:
             image: The image as a numpy array
             person_id: Unique identifier for the person
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            tags: Partition tags such as {"unit": "A", "site": "north"};
+                a re-registration without tags keeps the existing ones
+            allow_duplicate: Enroll even if the reject policy finds the face under another id
+            replace: Discard the person's existing templates instead of adding to them
 
         Returns:
             Dictionary with registration results
         """
         # Update metrics
-        self.total_requests += 1
+        self._count(total_requests=1)
         start_time = time.time()
 
         try:
+            # Skip detection entirely for frames that cannot yield a match
+            quality = self.check_frame_quality(image)
+            if quality is not None and quality["rejected"]:
+                return self._rejected_frame_result(quality, start_time)
+
             # Convert to grayscale
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
             # Detect faces
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            faces = self._detect_face_rects(gray, model)
 
             # No faces detected
             if len(faces) == 0:
-                return {
+                return self._with_quality({
                     "success": False,
                     "message": "No faces detected",
                     "processing_time": time.time() - start_time
+                }, quality)
+
+            # Use the largest face
+            largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
+
+            # Extract face ROI and normalize
+            with trace_span("encode"):
+                face_vector = self.face_vectors(gray, [largest_face])[0]
+
+            # Same face already enrolled under another id?
+            duplicates = []
+            if self.duplicate_policy != "off":
+                duplicates = self.find_duplicates(face_vector, person_id)
+            if duplicates:
+                names = ", ".join(d["person_id"] for d in duplicates)
+                if self.duplicate_policy == "reject" and not allow_duplicate:
+                    self._count(duplicates_rejected=1)
+                    logger.warning(f"Rejected enrollment of {person_id}: same face as {names}")
+                    return self._with_quality({
+                        "success": False,
+                        "message": f"Face already enrolled as {names}",
+                        "duplicates": duplicates,
+                        "processing_time": time.time() - start_time
+                    }, quality)
+                self._count(duplicates_warned=1)
+                logger.warning(f"Enrolling {person_id}, which looks like {names}")
+
+            # Save to database
+            with trace_span("store"):
+                if replace:
+                    self.gallery.enroll(person_id, face_vector, tags=tags)
+                    stored = {"templates": 1, "evicted": []}
+                else:
+                    stored = self.gallery.add_template(person_id, face_vector, self.max_templates,
+                                                       self.template_eviction, tags)
+                    self._count(templates_evicted=len(stored["evicted"]))
+
+            # Update metrics
+            processing_time = time.time() - start_time
+            self._count(total_processing_time=processing_time, successful_requests=1)
+
+            result = {
+                "success": True,
+                "person_id": person_id,
+                "templates": stored["templates"],
+                "evicted_templates": stored["evicted"],
+                "processing_time": processing_time
+            }
+            if duplicates:
+                result["possible_duplicates"] = duplicates
+            return self._with_quality(result, quality)
+        except Exception as e:
+            logger.error(f"Error registering face: {e}")
+            record_exception(e)
+
+            # Update metrics
+            processing_time = time.time() - start_time
+            self._count(total_processing_time=processing_time)
+
+            return {
+                "success": False,
+                "message": f"Error: {str(e)}",
+                "processing_time": processing_time
+            }
+
+    def update_face(self, person_id: str, image: Optional[np.ndarray] = None, model: Optional[str] = None,
+                    tags: Optional[Dict[str, str]] = None, allow_duplicate: bool = False) -> Dict[str, Any]:
+        """
+        Replace an enrolled person's templates, tags, or both
+
+        Args:
+            person_id: An enrolled person
+            image: New face image; its template replaces all existing ones
+            model: "haar" or "lbp"; defaults to the configured detection mode
+            tags: New partition tags; kept as they are when omitted
+            allow_duplicate: Enroll even if the reject policy finds the face under another id
+
+        Returns:
+            Dictionary with update results
+        """
+        vector = self.gallery.faces.get(person_id)
+        if vector is None:
+            return {"success": False, "message": f"{person_id} is not enrolled"}
+        if image is not None:
+            return self.register_face(image, person_id, model, tags, allow_duplicate, replace=True)
+        if tags is None:
+            return {"success": False, "message": "Nothing to update: give an image, tags or both"}
+
+        # Same templates, logged again under the new tags
+        start_time = time.time()
+        self.gallery.enroll(person_id, np.array(vector), tags=tags)
+        return {
+            "success": True,
+            "person_id": person_id,
+            "tags": tags,
+            "processing_time": time.time() - start_time
+        }
+
+    def delete_face(self, person_id: str) -> Dict[str, Any]:
+        """
+        Remove an enrolled person
+
+        They stop matching immediately; their index rows are reclaimed by the
+        next gallery compaction.
+
+        Returns:
+            Dictionary with deletion results
+        """
+        start_time = time.time()
+        if person_id not in self.gallery.faces:
+            return {"success": False, "message": f"{person_id} is not enrolled"}
+        record = self.gallery.remove(person_id)
+        return {
+            "success": True,
+            "person_id": person_id,
+            "gallery_version": record["version"],
+            "processing_time": time.time() - start_time
+        }
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get performance metrics
+
+        Returns:
+            Dictionary with performance metrics
+        """
+        uptime = (datetime.now() - self.start_time).total_seconds()
+        with self._stats_lock:
+            quality_reasons = dict(self.quality_reasons)
+
+        return {
+            "total_requests": self.total_requests,
+            "successful_requests": self.successful_requests,
+            "success_rate": self.successful_requests / max(1, self.total_requests),
+            "average_processing_time": self.total_processing_time / max(1, self.total_requests),
+            "uptime": uptime,
+            "uptime_formatted": self._format_uptime(uptime),
+            "face_database_size": len(self.face_database),
+            "templates": {
+                "total": self.gallery.index.template_count,
+                "max_per_person": self.max_templates,
+                "eviction": self.template_eviction,
+                "reduce": self.template_reduce,
+                "evicted": self.templates_evicted
+            },
+            "detection_mode": self.model_name(),
+            "available_models": [DETECTION_MODELS[m] for m in self.cascades],
+            "eye_check": self.eye_check,
+            "frame_quality": {
+                "mode": self.quality_gate,
+                "checked": self.quality_checked,
+                "flagged": self.quality_flagged,
+                "rejected": self.quality_rejected,
+                "reasons": quality_reasons,
+                "average_check_time": self.quality_check_time / max(1, self.quality_checked)
+            },
+            "roi_hint": {
+                "requests": self.roi_requests,
+                "hits": self.roi_hits,
+                "misses": self.roi_misses,
+                "hit_rate": self.roi_hits / max(1, self.roi_requests),
+                # Net of the crop scans that missed
+                "time_saved": self.roi_time_saved - self.roi_miss_time,
+                "hit_time_saved": self.roi_time_saved,
+                "miss_time_lost": self.roi_miss_time
+            },
+            "gallery_version": self.gallery.version,
+            "gallery_partitions_cached": self.gallery.index.partition_count(),
+            "memory": self.memory_usage(),
+            "duplicates": {
+                "policy": self.duplicate_policy,
+                "threshold": self.duplicate_threshold,
+                "warned": self.duplicates_warned,
+                "rejected": self.duplicates_rejected
+            },
+            "gallery_reloads": self.gallery.reloads,
+            "persistence": self.gallery.writer.get_metrics(),
+            "last_gallery_reload": self.gallery.last_reload,
+            "gallery_shards": self.shards.get_metrics() if self.shards else None,
+            "gallery_tombstones": self.gallery.index.tombstones,
+            "gallery_compactions": self.gallery.compactions,
+            "last_gallery_compaction": self.gallery.last_compaction
+        }
+
+    def _format_uptime(self, seconds: float) -> str:
+        """Format uptime in a human-readable format"""
+        days, remainder = divmod(int(seconds), 86400)
+        hours, remainder = divmod(remainder, 3600)
+        minutes, seconds = divmod(remainder, 60)
+
+        if days > 0:
+            return f"{days}d {hours}h {minutes}m {seconds}s"
+        elif hours > 0:
+            return f"{hours}h {minutes}m {seconds}s"
+        elif minutes > 0:
+            return f"{minutes}m {seconds}s"
+        else:
+            return f"{seconds}s"
+
+    def decode_base64_image(self, base64_string: str) -> np.ndarray:
+        """Decode a base64 string to an image"""
+        try:
+            with trace_span("decode"):
+                # Remove data URL prefix if present
+                if ',' in base64_string:
+                    base64_string = base64_string.split(',')[1]
+
+                # Base64 carries 3 bytes per 4 characters
+                if self.memory_pressure and len(base64_string) * 3 // 4 > self.pressure_max_frame_bytes:
+                    self._count(frames_refused=1)
+                    raise ValueError(f"Frame larger than {self.pressure_max_frame_bytes} bytes "
+                                     f"refused while memory is constrained")
+
+                # Decode base64 string
+                image_data = base64.b64decode(base64_string)
+
+                # Convert to numpy array
+                nparr = np.frombuffer(image_data, np.uint8)
+
+                # Decode image
+                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+            # Count the frame as in flight until release_frames()
+            with self._frames_lock:
+                self.inflight_frames += 1
+                self.inflight_frame_bytes += image.nbytes
+                self.peak_inflight_frame_bytes = max(self.peak_inflight_frame_bytes, self.inflight_frame_bytes)
+            self._local.frames = getattr(self._local, "frames", 0) + 1
+            self._local.frame_bytes = getattr(self._local, "frame_bytes", 0) + image.nbytes
+
+            return image
+        except Exception as e:
+            logger.error(f"Error decoding base64 image: {e}")
+            raise
+
+class EnhancedAndroidWebSocketServer:
+    """Enhanced WebSocket server for Android face recognition"""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 5001, watch_interval: float = 0,
+                 detector_options: Optional[Dict[str, Any]] = None,
+                 trace_sample_rate: float = 0.01, trace_slow_threshold: float = 0.5,
+                 workers: Optional[int] = None, priority_weights: Optional[Dict[str, float]] = None,
+                 batch_port: int = 0, batch_host: str = "127.0.0.1", batch_concurrency: Optional[int] = None,
+                 unix_socket: Optional[str] = None, unix_socket_mode: int = 0o660,
+                 record_path: Optional[str] = None, cpu_threads: Optional[int] = None,
+                 pin_cpus: bool = False, compaction_interval: float = 10.0, memory_profiling: bool = False):
+        """
+        Initialize the server
+
+        Args:
+            host: Interface to listen on
+            port: Port to listen on
+            watch_interval: Seconds between face_db polls for hot reload (0 disables)
+            detector_options: Keyword arguments for EnhancedAndroidFaceDetector
+            trace_sample_rate: Fraction of requests whose trace is logged
+            trace_slow_threshold: Seconds after which a request's trace is always logged
+            workers: Detector worker threads (default: min(4, CPUs / cpu_threads))
+            priority_weights: Worker share per class; see DEFAULT_PRIORITY_WEIGHTS
+            batch_port: Port of the HTTP batch endpoint (0 disables it)
+            batch_host: Interface the batch endpoint listens on
+            batch_concurrency: Batch items in flight per request (default: 2 per worker)
+            unix_socket: Also serve the WebSocket protocol on this Unix domain socket path
+            unix_socket_mode: Permission bits applied to the socket file
+            record_path: Append every inbound client message to this capture file
+            cpu_threads: OpenCV/BLAS threads per worker (default: CPUs / workers)
+            pin_cpus: Bind each worker thread to its own block of CPUs
+            compaction_interval: Seconds between checks for deleted entries to compact away (0 disables)
+            memory_profiling: Accept memory_snapshot requests, which start tracemalloc
+        """
+        self.host = host
+        self.port = port
+        self.watch_interval = watch_interval
+        self.compaction_interval = compaction_interval
+        self.memory_profiling = memory_profiling
+        # Created in start(), on the loop that serves reloads
+        self._reload_lock: Optional[asyncio.Lock] = None
+        self.detector = EnhancedAndroidFaceDetector(**(detector_options or {}))
+        self.recorder = SessionRecorder(record_path) if record_path else None
+        self.tracer = RequestTracer(trace_sample_rate, trace_slow_threshold)
+        self.scheduler = PriorityScheduler(weights=priority_weights,
+                                           governor=CPUGovernor(workers, cpu_threads, pin_cpus))
+        self.unix_socket = unix_socket
+        self.unix_socket_mode = unix_socket_mode
+        self.batch_server = None
+        if batch_port:
+            self.batch_server = BatchHTTPServer(self, batch_host, batch_port,
+                                                batch_concurrency or 2 * self.scheduler.workers)
+        self.clients = set()
+        self.metrics_subscriptions: Dict[Any, asyncio.Task] = {}
+        self.verification_sessions: Dict[str, VerificationSession] = {}
+        self._sessions_lock = threading.Lock()
+        self.verification_stats = {"started": 0, "accept": 0, "reject": 0, "expired": 0, "frames_used": 0}
+        self.start_time = datetime.now()
+
+        # Import websockets here to avoid import errors if not available
+        try:
+            import websockets
+            self.websockets = websockets
+            logger.info("WebSockets module available")
+        except ImportError:
+            logger.error("WebSockets module not available. Please install with: pip install websockets")
+            sys.exit(1)
+
+        # Set up signal handlers for graceful shutdown
+        signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
+
+    def _signal_handler(self, sig, frame):
+        """Handle signals for graceful shutdown"""
+        logger.info(f"Received signal {sig}, shutting down...")
+
+        # Don't lose enrollments still in the write-behind queue
+        self.detector.gallery.close()
+        if self.detector.shards:
+            self.detector.shards.close()
+        if self.recorder:
+            self.recorder.close()
+        sys.exit(0)
+
+    async def reload_gallery(self) -> Dict[str, Any]:
+        """Reload changed gallery entries on a scheduler worker"""
+        # Coalesce concurrent triggers into one scan at a time
+        async with self._reload_lock:
+            return await self.scheduler.run("admin", self.detector.gallery.refresh)
+
+    async def _watch_gallery(self):
+        """Poll face_db for changes made by other processes"""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.reload_gallery()
+            except Exception as e:
+                logger.error(f"Error reloading gallery: {e}")
+
+    async def _compact_gallery(self):
+        """Drop tombstoned entries in the background, as admin work on the worker pool"""
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            if not self.detector.gallery.index.tombstones:
+                continue
+            try:
+                await self.scheduler.run("admin", self.detector.gallery.compact)
+            except Exception as e:
+                logger.error(f"Error compacting gallery: {e}")
+
+    def _schedule_reload(self):
+        """SIGHUP handler: reload the gallery without restarting"""
+        logger.info("Received SIGHUP, reloading gallery")
+        asyncio.ensure_future(self.reload_gallery())
+
+    def _inline_metrics(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Detector metrics for responses that opted in with include_metrics"""
+        if data.get("include_metrics"):
+            return {"metrics": self.detector.get_metrics()}
+        return {}
+
+    def start_verification(self, data: Dict[str, Any]) -> VerificationSession:
+        """Open a multi-frame verification session, dropping idle ones"""
+        session = VerificationSession(
+            person_id=data.get("person_id") or None,
+            threshold=float(data.get("min_similarity", 0.4)),
+            max_frames=int(data.get("max_frames", 10)),
+            min_frames=int(data.get("min_frames", 2)),
+            scope=self._scope(data)
+        )
+        now = time.time()
+        with self._sessions_lock:
+            for session_id, idle in list(self.verification_sessions.items()):
+                if now - idle.last_used > VERIFICATION_SESSION_TTL:
+                    del self.verification_sessions[session_id]
+                    self.verification_stats["expired"] += 1
+            self.verification_sessions[session.session_id] = session
+            self.verification_stats["started"] += 1
+        return session
+
+    def verify_frame(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Score one frame of a session; the session closes once it decides"""
+        with self._sessions_lock:
+            session = self.verification_sessions.get(data.get("session_id", ""))
+        if session is None:
+            return {"success": False, "message": "Unknown or expired verification session"}
+
+        image = self.detector.decode_base64_image(data.get("image", ""))
+        with session.lock:
+            if session.decision is None:
+                frame = self.detector.score_frame(image, session.person_id, data.get("model"),
+                                                  data.get("roi"), session.scope)
+                if frame["success"] and session.person_id is None:
+                    # Lock onto the best match of the first usable frame
+                    session.person_id = frame["person_id"]
+                decision = session.add(frame["similarity"] if frame["success"] else None)
+                if decision is not None:
+                    with self._sessions_lock:
+                        if self.verification_sessions.pop(session.session_id, None) is not None:
+                            self.verification_stats[decision] += 1
+                            self.verification_stats["frames_used"] += session.frames
+            else:
+                frame = None
+
+        result = session.result()
+        result["success"] = True
+        if frame is not None:
+            result["frame"] = frame
+        return result
+
+    def verification_metrics(self) -> Dict[str, Any]:
+        stats = dict(self.verification_stats)
+        decided = stats["accept"] + stats["reject"]
+        stats["active"] = len(self.verification_sessions)
+        stats["average_frames"] = stats["frames_used"] / decided if decided else 0.0
+        return stats
+
+    @staticmethod
+    def _scope(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Partition scope of an identify request, if any"""
+        scope = data.get("scope")
+        if scope is not None and not isinstance(scope, dict):
+            raise ValueError("scope must be an object of partition names to values")
+        return scope
+
+    def server_metrics(self) -> Dict[str, Any]:
+        """Detector metrics plus server, tracing and scheduler state"""
+        metrics = self.detector.get_metrics()
+
+        # Add server metrics
+        server_uptime = (datetime.now() - self.start_time).total_seconds()
+        metrics["server_uptime"] = server_uptime
+        metrics["server_uptime_formatted"] = self.detector._format_uptime(server_uptime)
+        metrics["connected_clients"] = len(self.clients)
+        metrics["metrics_subscribers"] = len(self.metrics_subscriptions)
+        metrics["tracing"] = self.tracer.get_metrics()
+        metrics["scheduler"] = self.scheduler.get_metrics()
+        metrics["verification"] = self.verification_metrics()
+        if self.recorder:
+            metrics["recording"] = self.recorder.get_metrics()
+        if self.batch_server:
+            metrics["batch"] = self.batch_server.get_metrics()
+        return metrics
+
+    async def _push_metrics(self, websocket, interval: float):
+        """Send metrics to one subscriber every interval seconds until cancelled"""
+        try:
+            while True:
+                metrics = await self.scheduler.run("admin", self.server_metrics)
+                await websocket.send(json.dumps({
+                    "type": "metrics",
+                    "subscription": True,
+                    "metrics": metrics
+                }))
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Connection gone; handle_client cleans up the subscription
+            logger.debug(f"Stopped metrics push: {e}")
+
+    def unsubscribe_metrics(self, websocket) -> bool:
+        """Stop pushing metrics to a client; returns whether it was subscribed"""
+        task = self.metrics_subscriptions.pop(websocket, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def handle_message(self, data: Dict[str, Any], websocket=None) -> Dict[str, Any]:
+        """
+        Handle one parsed message
+
+        Detector work runs on the worker pool under the message's priority
+        class, so enrollment bursts and admin calls cannot hold up identify.
+
+        Args:
+            data: The decoded JSON message
+            websocket: The client connection, needed for metrics subscriptions
+
+        Returns:
+            The response to send back
+        """
+        message_type = data.get("type", "")
+
+        if message_type == "subscribe_metrics" and websocket is not None:
+            interval = max(float(data.get("interval", 5)), MIN_METRICS_INTERVAL)
+            self.unsubscribe_metrics(websocket)
+            self.metrics_subscriptions[websocket] = asyncio.ensure_future(
+                self._push_metrics(websocket, interval))
+            return {
+                "type": "metrics_subscribed",
+                "interval": interval
+            }
+
+        if message_type == "unsubscribe_metrics" and websocket is not None:
+            return {
+                "type": "metrics_unsubscribed",
+                "subscribed": self.unsubscribe_metrics(websocket)
+            }
+
+        if message_type == "reload_gallery":
+            result = await self.reload_gallery()
+            return {
+                "type": "gallery_reloaded",
+                "result": result
+            }
+
+        priority = MESSAGE_PRIORITIES.get(message_type, "admin")
+        return await self.scheduler.run(priority, self.process_message, data)
+
+    def process_message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Handle one message synchronously; runs on a worker thread
+
+        Args:
+            data: The decoded JSON message
+
+        Returns:
+            The response to send back
+        """
+        self.detector.check_memory()
+        try:
+            return self._process_message(data)
+        finally:
+            self.detector.release_frames()
+
+    def memory_snapshot(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Start tracemalloc, or report its top allocation sites"""
+        if data.get("stop"):
+            tracemalloc.stop()
+            return {"tracing": False}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._bounded_int(data, "frames", 1, MAX_TRACEMALLOC_FRAMES))
+            return {"tracing": True, "message": "tracemalloc started; send memory_snapshot again for a report"}
+
+        limit = self._bounded_int(data, "limit", 20, MAX_MEMORY_SNAPSHOT_SITES)
+        group_by = data.get("group_by", "lineno")
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise ValueError("group_by must be lineno, filename or traceback")
+        snapshot = tracemalloc.take_snapshot()
+        statistics = snapshot.statistics(group_by)
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing": True,
+            "traced_current": current,
+            "traced_peak": peak,
+            "top": [
+                {
+                    "location": str(stat.traceback),
+                    "size": stat.size,
+                    "count": stat.count
                 }
+                for stat in statistics[:limit]
+            ]
+        }
 
-            # Use the largest face
-            largest_face = max(faces, key=lambda rect: rect[2] * rect[3])
-            x, y, w, h = largest_face
+    @staticmethod
+    def _bounded_int(data: Dict[str, Any], key: str, default: int, maximum: int) -> int:
+        """Read an integer request field between 1 and maximum"""
+        value = data.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= maximum:
+            raise ValueError(f"{key} must be an integer from 1 to {maximum}")
+        return value
 
-            # Extract face ROI and normalize
-            face_roi = gray[y:y+h, x:x+w]
-            face_roi = cv2.resize(face_roi, (100, 100))
-            face_roi = cv2.equalizeHist(face_roi)
+    def _process_message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        message_type = data.get("type", "")
 
-            # Flatten the face for storage
-            face_vector = face_roi.flatten().astype(np.float32)
-            face_vector = face_vector / np.linalg.norm(face_vector)
+        # Handle different message types
+        if message_type == "ping":
+            # Ping message
+            return {
+                "type": "pong",
+                "time": datetime.now().isoformat(),
+                "metrics": self.detector.get_metrics()
+            }
 
-            # Save to database
-            self.face_database[person_id] = face_vector
-            np.save(os.path.join("face_db", f"{person_id}.npy"), face_vector)
+        elif message_type == "detect_faces":
+            # Decode image
+            image = self.detector.decode_base64_image(data.get("image", ""))
 
-            # Update metrics
+            # Get parameters
+            min_confidence = float(data.get("min_confidence", 0.5))
+            model = data.get("model")
+            check_eyes = data.get("check_eyes")
+
+            # Detect faces
+            start_time = time.time()
+            quality = self.detector.check_frame_quality(image)
+            faces = self.detector.detect_faces(image, min_confidence, model, check_eyes, quality,
+                                               data.get("roi"))
             processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
-            self.successful_requests += 1
 
+            # Send response
+            response = {
+                "type": "faces_detected",
+                "faces": faces,
+                "processing_time": processing_time,
+                "model": self.detector.model_name(model),
+                **self._inline_metrics(data)
+            }
+            if quality is not None:
+                response["quality"] = quality
+            return response
+
+        elif message_type == "identify_face":
+            # Decode image
+            image = self.detector.decode_base64_image(data.get("image", ""))
+
+            # Get parameters
+            min_similarity = float(data.get("min_similarity", 0.4))
+
+            # Identify face
+            result = self.detector.identify_face(image, min_similarity, data.get("model"),
+                                                 data.get("roi"), int(data.get("top_k", 0)),
+                                                 self._scope(data))
+
+            # Send response
             return {
-                "success": True,
-                "person_id": person_id,
-                "processing_time": processing_time
+                "type": "face_identified",
+                "result": result,
+                **self._inline_metrics(data)
             }
-        except Exception as e:
-            logger.error(f"Error registering face: {e}")
-            logger.error(traceback.format_exc())
 
-            # Update metrics
-            processing_time = time.time() - start_time
-            self.total_processing_time += processing_time
+        elif message_type == "identify_all_faces":
+            # Decode image
+            image = self.detector.decode_base64_image(data.get("image", ""))
+
+            # Identify everyone in the frame
+            result = self.detector.identify_all_faces(image, float(data.get("min_similarity", 0.4)),
+                                                      data.get("model"), self._scope(data))
 
             return {
-                "success": False,
-                "message": f"Error: {str(e)}",
-                "processing_time": processing_time
+                "type": "faces_identified",
+                "result": result,
+                **self._inline_metrics(data)
             }
 
-    def get_metrics(self) -> Dict[str, Any]:
-        """
-        Get performance metrics
+        elif message_type == "start_verification":
+            # Multi-frame verification of person_id, or of whoever the first frame matches
+            session = self.start_verification(data)
+            return {
+                "type": "verification_started",
+                "result": session.result()
+            }
 
-        Returns:
-            Dictionary with performance metrics
-        """
-        uptime = (datetime.now() - self.start_time).total_seconds()
+        elif message_type == "verify_frame":
+            return {
+                "type": "verification_progress",
+                "result": self.verify_frame(data),
+                **self._inline_metrics(data)
+            }
 
-        return {
-            "total_requests": self.total_requests,
-            "successful_requests": self.successful_requests,
-            "success_rate": self.successful_requests / max(1, self.total_requests),
-            "average_processing_time": self.total_processing_time / max(1, self.total_requests),
-            "uptime": uptime,
-            "uptime_formatted": self._format_uptime(uptime),
-            "face_database_size": len(self.face_database)
-        }
+        elif message_type == "end_verification":
+            with self._sessions_lock:
+                session = self.verification_sessions.pop(data.get("session_id", ""), None)
+            return {
+                "type": "verification_ended",
+                "result": session.result() if session else {"success": False, "message": "Unknown session"}
+            }
 
-    def _format_uptime(self, seconds: float) -> str:
-        """Format uptime in a human-readable format"""
-        days, remainder = divmod(int(seconds), 86400)
-        hours, remainder = divmod(remainder, 3600)
-        minutes, seconds = divmod(remainder, 60)
+        elif message_type == "register_face":
+            # Decode image
+            image = self.detector.decode_base64_image(data.get("image", ""))
 
-        if days > 0:
-            return f"{days}d {hours}h {minutes}m {seconds}s"
-        elif hours > 0:
-            return f"{hours}h {minutes}m {seconds}s"
-        elif minutes > 0:
-            return f"{minutes}m {seconds}s"
-        else:
-            return f"{seconds}s"
+            # Get parameters
+            person_id = data.get("person_id", "")
 
-    def decode_base64_image(self, base64_string: str) -> np.ndarray:
-        """Decode a base64 string to an image"""
-        try:
-            # Remove data URL prefix if present
-            if ',' in base64_string:
-                base64_string = base64_string.split(',')[1]
+            if not person_id:
+                return {
+                    "type": "error",
+                    "message": "Missing person_id parameter"
+                }
 
-            # Decode base64 string
-            image_data = base64.b64decode(base64_string)
+            tags = data.get("tags")
+            if tags is not None and not isinstance(tags, dict):
+                return {
+                    "type": "error",
+                    "message": "tags must be an object of partition names to values"
+                }
 
-            # Convert to numpy array
-            nparr = np.frombuffer(image_data, np.uint8)
+            # Register face
+            result = self.detector.register_face(
+                image, person_id, data.get("model"),
+                {str(key): str(value) for key, value in tags.items()} if tags is not None else None,
+                bool(data.get("allow_duplicate", False)),
+                bool(data.get("replace", False)))
 
-            # Decode image
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # Send response
+            return {
+                "type": "face_registered",
+                "result": result,
+                **self._inline_metrics(data)
+            }
 
-            return image
-        except Exception as e:
-            logger.error(f"Error decoding base64 image: {e}")
-            raise
+        elif message_type in ("update_face", "delete_face"):
+            person_id = data.get("person_id", "")
+            if not person_id:
+                return {
+                    "type": "error",
+                    "message": "Missing person_id parameter"
+                }
 
-class EnhancedAndroidWebSocketServer:
-    """Enhanced WebSocket server for Android face recognition"""
+            if message_type == "delete_face":
+                return {
+                    "type": "face_deleted",
+                    "result": self.detector.delete_face(person_id),
+                    **self._inline_metrics(data)
+                }
 
-    def __init__(self, host: str = "0.0.0.0", port: int = 5001):
-        """Initialize the server"""
-        self.host = host
-        self.port = port
-        self.detector = EnhancedAndroidFaceDetector()
-        self.clients = set()
-        self.start_time = datetime.now()
+            tags = data.get("tags")
+            if tags is not None and not isinstance(tags, dict):
+                return {
+                    "type": "error",
+                    "message": "tags must be an object of partition names to values"
+                }
+            image = self.detector.decode_base64_image(data["image"]) if data.get("image") else None
+            result = self.detector.update_face(
+                person_id, image, data.get("model"),
+                {str(key): str(value) for key, value in tags.items()} if tags is not None else None,
+                bool(data.get("allow_duplicate", False)))
+            return {
+                "type": "face_updated",
+                "result": result,
+                **self._inline_metrics(data)
+            }
 
-        # Import websockets here to avoid import errors if not available
-        try:
-            import websockets
-            self.websockets = websockets
-            logger.info("WebSockets module available")
-        except ImportError:
-            logger.error("WebSockets module not available. Please install with: pip install websockets")
-            sys.exit(1)
+        elif message_type == "compare_faces":
+            # Decode images
+            face1 = self.detector.decode_base64_image(data.get("face1", ""))
+            face2 = self.detector.decode_base64_image(data.get("face2", ""))
 
-        # Set up signal handlers for graceful shutdown
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
+            # Compare faces
+            start_time = time.time()
+            result = self.detector.compare_faces(face1, face2)
+            processing_time = time.time() - start_time
 
-    def _signal_handler(self, sig, frame):
-        """Handle signals for graceful shutdown"""
-        logger.info(f"Received signal {sig}, shutting down...")
-        sys.exit(0)
+            # Send response
+            return {
+                "type": "faces_compared",
+                "result": result,
+                "processing_time": processing_time,
+                **self._inline_metrics(data)
+            }
+
+        elif message_type == "get_gallery_delta":
+            # Delta of enrollments/deletions since the caller's last version
+            since = int(data.get("since", 0))
+            return {
+                "type": "gallery_delta",
+                "delta": self.detector.gallery.delta(since)
+            }
+
+        elif message_type == "get_gallery_snapshot":
+            return {
+                "type": "gallery_snapshot",
+                "snapshot": self.detector.gallery.snapshot()
+            }
+
+        elif message_type == "apply_gallery_delta":
+            # Merge a delta or snapshot pushed by another node
+            result = self.detector.gallery.apply(data.get("delta", {}))
+            return {
+                "type": "gallery_delta_applied",
+                "result": result
+            }
+
+        elif message_type == "memory_snapshot":
+            # tracemalloc slows every allocation, so only operators may switch it on
+            if not self.memory_profiling:
+                return {
+                    "type": "error",
+                    "message": "memory_snapshot is disabled; start the server with --memory-profiling"
+                }
+            try:
+                result = self.memory_snapshot(data)
+            except ValueError as e:
+                return {
+                    "type": "error",
+                    "message": str(e)
+                }
+            return {
+                "type": "memory_snapshot",
+                "result": result
+            }
+
+        elif message_type == "get_metrics":
+            # Send response
+            return {
+                "type": "metrics",
+                "metrics": self.server_metrics()
+            }
+
+        else:
+            # Unknown message type
+            return {
+                "type": "error",
+                "message": f"Unknown message type: {message_type}"
+            }
 
     async def handle_client(self, websocket):
         """Handle a client connection"""
-        client_info = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
+        remote = websocket.remote_address
+        client_info = f"{remote[0]}:{remote[1]}" if isinstance(remote, tuple) else f"unix:{self.unix_socket}"
         logger.info(f"New client connected: {client_info}")
 
         # Add client to set
         self.clients.add(websocket)
+        connection_id = self.recorder.connection_id() if self.recorder else 0
         try:
             async for message in websocket:
+                if self.recorder:
+                    self.recorder.record(connection_id, message)
+
+                # Trace the request; detector stages record spans through the context variable
+                trace = self.tracer.start()
+                token = activate_trace(trace)
                 try:
                     # Parse message
                     data = json.loads(message)
                     message_type = data.get("type", "")
 
-                    # Handle different message types
-                    if message_type == "ping":
-                        # Ping message
-                        await websocket.send(json.dumps({
-                            "type": "pong",
-                            "time": datetime.now().isoformat(),
-                            "metrics": self.detector.get_metrics()
-                        }))
-
-                    elif message_type == "detect_faces":
-                        # Decode image
-                        image = self.detector.decode_base64_image(data.get("image", ""))
-
-                        # Get parameters
-                        min_confidence = float(data.get("min_confidence", 0.5))
-
-                        # Detect faces
-                        start_time = time.time()
-                        faces = self.detector.detect_faces(image, min_confidence)
-                        processing_time = time.time() - start_time
-
-                        # Send response
-                        await websocket.send(json.dumps({
-                            "type": "faces_detected",
-                            "faces": faces,
-                            "processing_time": processing_time,
-                            "model": "enhanced_haar",
-                            "metrics": self.detector.get_metrics()
-                        }))
-
-                    elif message_type == "identify_face":
-                        # Decode image
-                        image = self.detector.decode_base64_image(data.get("image", ""))
-
-                        # Get parameters
-                        min_similarity = float(data.get("min_similarity", 0.4))
-
-                        # Identify face
-                        result = self.detector.identify_face(image, min_similarity)
-
-                        # Send response
-                        await websocket.send(json.dumps({
-                            "type": "face_identified",
-                            "result": result,
-                            "metrics": self.detector.get_metrics()
-                        }))
-
-                    elif message_type == "register_face":
-                        # Decode image
-                        image = self.detector.decode_base64_image(data.get("image", ""))
-
-                        # Get parameters
-                        person_id = data.get("person_id", "")
-
-                        if not person_id:
-                            await websocket.send(json.dumps({
-                                "type": "error",
-                                "message": "Missing person_id parameter"
-                            }))
-                            continue
-
-                        # Register face
-                        result = self.detector.register_face(image, person_id)
-
-                        # Send response
-                        await websocket.send(json.dumps({
-                            "type": "face_registered",
-                            "result": result,
-                            "metrics": self.detector.get_metrics()
-                        }))
-
-                    elif message_type == "compare_faces":
-                        # Decode images
-                        face1 = self.detector.decode_base64_image(data.get("face1", ""))
-                        face2 = self.detector.decode_base64_image(data.get("face2", ""))
-
-                        # Compare faces
-                        start_time = time.time()
-                        result = self.detector.compare_faces(face1, face2)
-                        processing_time = time.time() - start_time
-
-                        # Send response
-                        await websocket.send(json.dumps({
-                            "type": "faces_compared",
-                            "result": result,
-                            "processing_time": processing_time,
-                            "metrics": self.detector.get_metrics()
-                        }))
-
-                    elif message_type == "get_metrics":
-                        # Get metrics
-                        metrics = self.detector.get_metrics()
-
-                        # Add server metrics
-                        server_uptime = (datetime.now() - self.start_time).total_seconds()
-                        metrics["server_uptime"] = server_uptime
-                        metrics["server_uptime_formatted"] = self.detector._format_uptime(server_uptime)
-                        metrics["connected_clients"] = len(self.clients)
-
-                        # Send response
-                        await websocket.send(json.dumps({
-                            "type": "metrics",
-                            "metrics": metrics
-                        }))
-
-                    else:
-                        # Unknown message type
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "message": f"Unknown message type: {message_type}"
-                        }))
+                    # Handle the message
+                    trace.message_type = message_type
+                    trace.set_client_trace_id(data.get("trace_id"))
+                    response = await self.handle_message(data, websocket)
 
-                except json.JSONDecodeError:
+                except json.JSONDecodeError as e:
                     # Invalid JSON
-                    await websocket.send(json.dumps({
+                    trace.fail(e)
+                    response = {
                         "type": "error",
                         "message": "Invalid JSON"
-                    }))
+                    }
 
                 except Exception as e:
-                    # Other errors
-                    logger.error(f"Error handling message: {e}")
-                    logger.error(traceback.format_exc())
-                    await websocket.send(json.dumps({
+                    # Other errors; the traceback goes into the trace record
+                    logger.error(f"Error handling message (trace {trace.trace_id}): {e}")
+                    trace.fail(e)
+                    response = {
                         "type": "error",
                         "message": str(e)
-                    }))
+                    }
+
+                deactivate_trace(token)
+
+                # Send response, echoing the trace id
+                response["trace_id"] = trace.trace_id
+                with trace.span("serialize"):
+                    payload = json.dumps(response)
+                await websocket.send(payload)
+
+                self.tracer.finish(trace, client=client_info)
 
         except Exception as e:
             # Connection closed or other error
@@ -622,19 +3501,65 @@ class EnhancedAndroidWebSocketServer:
         finally:
             # Remove client from set
             self.clients.remove(websocket)
+            self.unsubscribe_metrics(websocket)
             logger.info(f"Client disconnected: {client_info}")
 
+    async def start_unix_listener(self):
+        """Serve the WebSocket protocol on the configured Unix domain socket"""
+        # A socket file left behind by a previous run would make bind() fail;
+        # anything else at that path is not ours to delete
+        try:
+            mode = os.lstat(self.unix_socket).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not S_ISSOCK(mode):
+                raise FileExistsError(f"{self.unix_socket} exists and is not a socket")
+            os.unlink(self.unix_socket)
+
+        # bind() creates the socket file with the umask applied, so it never
+        # exists with wider permissions than requested
+        old_umask = os.umask(0o777 & ~self.unix_socket_mode)
+        try:
+            await self.websockets.unix_serve(
+                self.handle_client,
+                self.unix_socket,
+                max_size=MAX_MESSAGE_SIZE
+            )
+        finally:
+            os.umask(old_umask)
+        logger.info(f"Server listening on unix socket {self.unix_socket} (mode {self.unix_socket_mode:o})")
+
     async def start(self):
         """Start the WebSocket server"""
+        self._reload_lock = asyncio.Lock()
+        self.scheduler.governor.apply()
         server = await self.websockets.serve(
             self.handle_client,
             self.host,
-            self.port
+            self.port,
+            max_size=MAX_MESSAGE_SIZE
         )
 
+        # Same-device clients can skip TCP loopback
+        if self.unix_socket:
+            await self.start_unix_listener()
+
+        # Hot reload triggers: SIGHUP and an optional polling watcher
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self._schedule_reload)
+        if self.watch_interval > 0:
+            asyncio.ensure_future(self._watch_gallery())
+            logger.info(f"Watching face_db every {self.watch_interval}s")
+        if self.compaction_interval > 0:
+            asyncio.ensure_future(self._compact_gallery())
+        if self.batch_server:
+            await self.batch_server.start()
+
         logger.info(f"Server running at ws://{self.host}:{self.port}")
         logger.info(f"Server version: {SERVER_VERSION}")
-        logger.info("Available models: enhanced_haar")
+        logger.info(f"Available models: {', '.join(DETECTION_MODELS[m] for m in self.detector.cascades)}")
 
         # Print server info
         print(f"Server is running at ws://{self.host}:{self.port}")
@@ -642,8 +3567,593 @@ class EnhancedAndroidWebSocketServer:
 
         await server.wait_closed()
 
+class _BodyReader:
+    """Incremental reader over an HTTP request body (Content-Length or chunked)"""
+
+    def __init__(self, reader: asyncio.StreamReader, length: Optional[int], chunked: bool, limit: int):
+        self.reader = reader
+        self.remaining = length
+        self.chunked = chunked
+        self.limit = limit
+        self.buffer = bytearray()
+        self.eof = False
+
+    async def _fill(self) -> bool:
+        """Pull the next piece of the body into the buffer; False at the end"""
+        if self.eof:
+            return False
+        if self.chunked:
+            size = int((await self.reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # Skip trailers up to the blank line
+                while (await self.reader.readline()).strip():
+                    pass
+                self.eof = True
+                return False
+            self.buffer += await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+            return True
+        if not self.remaining:
+            self.eof = True
+            return False
+        data = await self.reader.read(min(self.remaining, 1 << 16))
+        if not data:
+            raise ConnectionError("Request body ended early")
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    async def read_until(self, separator: bytes) -> Optional[bytes]:
+        """
+        Read up to the next separator, which is consumed but not returned
+
+        Returns:
+            The data before the separator, the rest of the body if the
+            separator never comes, or None once the body is exhausted
+        """
+        start = 0
+        while True:
+            index = self.buffer.find(separator, start)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(separator)]
+                return data
+            if len(self.buffer) > self.limit:
+                raise ValueError(f"Batch item larger than {self.limit} bytes")
+            start = max(0, len(self.buffer) - len(separator) + 1)
+            if not await self._fill():
+                if not self.buffer:
+                    return None
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return data
+
+class BatchHTTPServer:
+    """
+    Local HTTP endpoint for offline bulk jobs
+
+    POST /batch with an NDJSON body (one message per line, e.g.
+    {"id": "...", "image": "<base64>", "min_similarity": 0.7}) or a
+    multipart/form-data body of image files. Items run through the detector
+    on the worker pool under the "batch" priority class and results are
+    streamed back as NDJSON in completion order. Only `concurrency` items
+    are read ahead of the results, so memory stays bounded by item size
+    rather than request size.
+    """
+
+    def __init__(self, server: "EnhancedAndroidWebSocketServer", host: str = "127.0.0.1",
+                 port: int = 5002, concurrency: int = 4):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.concurrency = max(1, concurrency)
+        self.metrics = {"jobs": 0, "active_jobs": 0, "items": 0, "errors": 0}
+
+    async def start(self):
+        await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_MESSAGE_SIZE)
+        logger.info(f"Batch endpoint running at http://{self.host}:{self.port}/batch")
+
+    async def _send_status(self, writer: asyncio.StreamWriter, status: str, message: str):
+        body = json.dumps({"type": "error", "message": message}).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one request, then close the connection"""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                return await self._send_status(writer, "400 Bad Request", "Malformed request line")
+            method, target = request_line[0], urlsplit(request_line[1])
+            if target.path != "/batch":
+                return await self._send_status(writer, "404 Not Found", f"No such endpoint: {target.path}")
+            if method != "POST":
+                return await self._send_status(writer, "405 Method Not Allowed", "Use POST")
+
+            chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+            if not chunked and "content-length" not in headers:
+                return await self._send_status(writer, "411 Length Required", "Content-Length or chunked body required")
+
+            content_type = headers.get("content-type", "application/x-ndjson")
+            boundary = None
+            if content_type.startswith("multipart/"):
+                boundary = dict(
+                    part.strip().split("=", 1) for part in content_type.split(";")[1:] if "=" in part
+                ).get("boundary", "").strip('"')
+                if not boundary:
+                    return await self._send_status(writer, "400 Bad Request", "Multipart body without boundary")
+
+            if headers.get("expect", "").lower() == "100-continue":
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+            body = _BodyReader(reader, int(headers.get("content-length") or 0), chunked, MAX_MESSAGE_SIZE)
+            defaults = dict(parse_qsl(target.query))
+            items = self._multipart_items(body, boundary, defaults) if boundary else self._ndjson_items(body, defaults)
+            await self.run_batch(items, writer)
+
+        except Exception as e:
+            logger.error(f"Batch request failed: {e}")
+        finally:
+            writer.close()
+
+    async def _ndjson_items(self, body: _BodyReader, defaults: Dict[str, str]):
+        while True:
+            line = await body.read_until(b"\n")
+            if line is None:
+                return
+            if line.strip():
+                try:
+                    yield {**defaults, **json.loads(line)}
+                except json.JSONDecodeError:
+                    yield {"type": "error", "message": "Invalid JSON"}
+
+    async def _multipart_items(self, body: _BodyReader, boundary: str, defaults: Dict[str, str]):
+        delimiter = b"\r\n--" + boundary.encode()
+        # The first delimiter may start the body without a preceding CRLF
+        body.buffer[:0] = b"\r\n"
+        if await body.read_until(delimiter) is None:
+            return
+        while True:
+            if await body.read_until(b"\r\n") != b"":
+                return  # "--" closes the body
+            part_headers = (await body.read_until(b"\r\n\r\n") or b"").decode("latin-1")
+            content = await body.read_until(delimiter)
+            if content is None:
+                return
+            disposition = next((line for line in part_headers.split("\r\n")
+                                if line.lower().startswith("content-disposition")), "")
+            params = dict(
+                part.strip().split("=", 1) for part in disposition.split(";")[1:] if "=" in part
+            )
+            name = (params.get("filename") or params.get("name") or "").strip('"')
+            yield {**defaults, "id": name, "image": base64.b64encode(content).decode()}
+
+    def _process_item(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        if data.get("type") == "error":
+            return data
+        data.setdefault("type", "identify_face")
+        if data["type"] not in BATCH_MESSAGE_TYPES:
+            return {"type": "error", "message": f"Unsupported batch message type: {data['type']}"}
+        return self.server.process_message(data)
+
+    async def _run_item(self, index: int, data: Dict[str, Any], emit) -> bool:
+        trace = self.server.tracer.start()
+        trace.message_type = f"batch:{data.get('type', 'identify_face')}"
+        token = activate_trace(trace)
+        item_id = data.pop("id", index)
+        try:
+            response = await self.server.scheduler.run("batch", self._process_item, data)
+        except Exception as e:
+            trace.fail(e)
+            response = {"type": "error", "message": str(e)}
+        deactivate_trace(token)
+
+        ok = response.get("type") != "error"
+        await emit({"id": item_id, "index": index, **response, "trace_id": trace.trace_id})
+        self.server.tracer.finish(trace, batch=True)
+        return ok
+
+    async def run_batch(self, items, writer: asyncio.StreamWriter):
+        """Run items with bounded read-ahead, streaming each result as it completes"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        write_lock = asyncio.Lock()
+
+        async def emit(record: Dict[str, Any]):
+            line = json.dumps(record).encode() + b"\n"
+            async with write_lock:
+                writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                await writer.drain()
+
+        slots = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        count = errors = 0
+        start_time = time.time()
+        self.metrics["jobs"] += 1
+        self.metrics["active_jobs"] += 1
+
+        def done(task: asyncio.Task):
+            nonlocal errors
+            pending.discard(task)
+            slots.release()
+            if task.cancelled() or task.exception() is not None or not task.result():
+                errors += 1
+
+        try:
+            index = 0
+            while True:
+                # Wait for a free slot before reading the next item off the socket
+                await slots.acquire()
+                try:
+                    data = await items.__anext__()
+                except StopAsyncIteration:
+                    slots.release()
+                    break
+                task = asyncio.ensure_future(self._run_item(index, data, emit))
+                task.add_done_callback(done)
+                pending.add(task)
+                index += 1
+            count = index
+            if pending:
+                await asyncio.wait(set(pending))
+        finally:
+            self.metrics["active_jobs"] -= 1
+            self.metrics["items"] += count
+            self.metrics["errors"] += errors
+
+        await emit({
+            "type": "batch_complete",
+            "items": count,
+            "errors": errors,
+            "duration": time.time() - start_time
+        })
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {"endpoint": f"http://{self.host}:{self.port}/batch", "concurrency": self.concurrency,
+                **self.metrics}
+
+async def _fetch_from_peer(url: str, message: Dict[str, Any], key: str) -> Dict[str, Any]:
+    """Send one gallery request to a peer server and return the payload"""
+    import websockets
+    async with websockets.connect(url, max_size=MAX_MESSAGE_SIZE) as websocket:
+        await websocket.send(json.dumps(message))
+        response = json.loads(await websocket.recv())
+    if key not in response:
+        raise RuntimeError(response.get("message", f"Unexpected response from {url}"))
+    return response[key]
+
+def sync_gallery(store: FaceGalleryStore, peer: Optional[str] = None, path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Pull changes from another node into the local gallery
+
+    Args:
+        store: The local gallery
+        peer: WebSocket URL of a running peer server
+        path: A snapshot or delta file written by export-snapshot/export-delta
+
+    Returns:
+        Merge counts from FaceGalleryStore.apply
+    """
+    if path:
+        with open(path, "r") as f:
+            return store.apply(json.load(f))
+
+    since = store.peers.get(peer, 0)
+    payload = asyncio.run(_fetch_from_peer(peer, {"type": "get_gallery_delta", "since": since}, "delta"))
+    if payload.get("snapshot_required"):
+        logger.info(f"Peer log no longer reaches version {since}, fetching full snapshot")
+        payload = asyncio.run(_fetch_from_peer(peer, {"type": "get_gallery_snapshot"}, "snapshot"))
+
+    result = store.apply(payload)
+    store.set_peer_cursor(peer, payload["gallery_version"])
+    return result
+
+def _iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union else 0.0
+
+def benchmark_detectors(detector: EnhancedAndroidFaceDetector, images: List[np.ndarray],
+                        rounds: int = 3) -> Dict[str, Any]:
+    """
+    Compare the LBP fast mode against Haar on the same images
+
+    Latency covers face detection plus the eye pass as each mode would run it.
+    Agreement is the fraction of Haar faces that LBP also finds (IoU >= 0.5).
+
+    Returns:
+        Per-model latency and face counts, plus detection agreement
+    """
+    report: Dict[str, Any] = {"images": len(images), "models": {}}
+    detections: Dict[str, List[List[Tuple[int, int, int, int]]]] = {}
+
+    for model in detector.cascades:
+        timings = []
+        found = []
+        for image in images:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            for i in range(rounds):
+                start_time = time.perf_counter()
+                faces = detector._detect_face_rects(gray, model)
+                if model == "haar":
+                    for (x, y, w, h) in faces:
+                        detector._cascade("eye").detectMultiScale(gray[y:y+h, x:x+w])
+                timings.append((time.perf_counter() - start_time) * 1000)
+            found.append([tuple(int(v) for v in face) for face in faces])
+
+        detections[model] = found
+        report["models"][DETECTION_MODELS[model]] = {
+            "median_ms": float(np.median(timings)),
+            "p90_ms": float(np.percentile(timings, 90)),
+            "faces": sum(len(faces) for faces in found)
+        }
+
+    if "lbp" in detections:
+        reference = sum(len(faces) for faces in detections["haar"])
+        matched = 0
+        for haar_faces, lbp_faces in zip(detections["haar"], detections["lbp"]):
+            for face in haar_faces:
+                if any(_iou(face, other) >= 0.5 for other in lbp_faces):
+                    matched += 1
+        report["agreement"] = matched / reference if reference else None
+        report["speedup"] = (report["models"]["enhanced_haar"]["median_ms"] /
+                             max(1e-9, report["models"]["enhanced_lbp"]["median_ms"]))
+    else:
+        report["agreement"] = None
+        report["message"] = "LBP cascade not found; pass --lbp-cascade"
+
+    return report
+
+async def benchmark_transports(sizes: List[Tuple[int, int]], rounds: int = 50,
+                               socket_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Round-trip latency and CPU of TCP loopback vs a Unix domain socket
+
+    Runs a WebSocket server in-process on both transports that answers every
+    frame with a short reply, so only framing and transport are measured.
+    CPU time covers client and server together since both share this process.
+
+    Returns:
+        Per transport and frame size, latency percentiles and CPU ms per frame
+    """
+    import tempfile
+    import websockets
+
+    async def reply(websocket):
+        async for message in websocket:
+            await websocket.send('{"type": "pong"}')
+
+    socket_path = socket_path or os.path.join(tempfile.mkdtemp(), "face.sock")
+    tcp_server = await websockets.serve(reply, "127.0.0.1", 0, max_size=MAX_MESSAGE_SIZE)
+    unix_server = await websockets.unix_serve(reply, socket_path, max_size=MAX_MESSAGE_SIZE)
+    tcp_port = tcp_server.sockets[0].getsockname()[1]
+
+    connections = {
+        "tcp": lambda: websockets.connect(f"ws://127.0.0.1:{tcp_port}", max_size=MAX_MESSAGE_SIZE),
+        "unix": lambda: websockets.unix_connect(socket_path, max_size=MAX_MESSAGE_SIZE)
+    }
+
+    rng = np.random.default_rng(0)
+    results = {}
+    try:
+        for width, height in sizes:
+            # JPEG of smooth noise compresses like a camera frame
+            image = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 2)
+            frame = base64.b64encode(cv2.imencode(".jpg", image)[1]).decode()
+            message = json.dumps({"type": "identify_face", "image": frame})
+
+            for transport, connect in connections.items():
+                async with connect() as websocket:
+                    for _ in range(5):
+                        await websocket.send(message)
+                        await websocket.recv()
+
+                    latencies = []
+                    cpu_start = time.process_time()
+                    for _ in range(rounds):
+                        start_time = time.perf_counter()
+                        await websocket.send(message)
+                        await websocket.recv()
+                        latencies.append((time.perf_counter() - start_time) * 1000)
+                    cpu = (time.process_time() - cpu_start) * 1000 / rounds
+
+                results.setdefault(f"{width}x{height}", {"message_bytes": len(message)})[transport] = {
+                    "p50_ms": float(np.percentile(latencies, 50)),
+                    "p95_ms": float(np.percentile(latencies, 95)),
+                    "cpu_ms_per_frame": cpu
+                }
+    finally:
+        tcp_server.close()
+        unix_server.close()
+        await tcp_server.wait_closed()
+        await unix_server.wait_closed()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+    return results
+
+def dedup_report(store: FaceGalleryStore, threshold: float = 0.95, block_size: int = 1024) -> Dict[str, Any]:
+    """
+    All pairs of enrolled people with templates at least threshold similar
+
+    The similarity matrix is computed one block_size x block_size tile of
+    templates at a time over the upper triangle, so memory stays at one tile
+    however large the gallery is. A pair of people is reported with their
+    most similar templates, and pairs are grouped into clusters of the same face.
+
+    Returns:
+        Pairs sorted by similarity and clusters of two or more ids
+    """
+    start_time = time.time()
+    index = store.index
+    ids, matrix, owner = index.ids, index.matrix, index.owner
+    count = len(owner)
+
+    # Best template pair per pair of people
+    best: Dict[Tuple[int, int], float] = {}
+    for row in range(0, count, block_size):
+        left = matrix[row:row + block_size]
+        for col in range(row, count, block_size):
+            tile = left @ matrix[col:col + block_size].T
+            if col == row:
+                # Each pair once, and never a vector with itself
+                tile = np.triu(tile, k=1)
+            for i, j in zip(*np.nonzero(tile >= threshold)):
+                first, second = int(owner[row + i]), int(owner[col + j])
+                # Templates of the same person are meant to match; deleted people never do
+                if first != second and not (index.deleted[first] or index.deleted[second]):
+                    key = (min(first, second), max(first, second))
+                    best[key] = max(best.get(key, -1.0), float(tile[i, j]))
+    pairs = sorted(((ids[a], ids[b], similarity) for (a, b), similarity in best.items()),
+                   key=lambda pair: -pair[2])
+
+    # Union-find over the pairs
+    parent: Dict[str, str] = {}
+
+    def find(person_id: str) -> str:
+        while parent.setdefault(person_id, person_id) != person_id:
+            parent[person_id] = parent[parent[person_id]]
+            person_id = parent[person_id]
+        return person_id
+
+    for first, second, _ in pairs:
+        parent[find(first)] = find(second)
+    clusters: Dict[str, List[str]] = {}
+    for person_id in parent:
+        clusters.setdefault(find(person_id), []).append(person_id)
+
+    return {
+        "gallery_size": len(index),
+        "templates": index.template_count,
+        "threshold": threshold,
+        "block_size": block_size,
+        "pairs": [{"first": a, "second": b, "similarity": sim} for a, b, sim in pairs],
+        "clusters": sorted((sorted(members) for members in clusters.values()), key=len, reverse=True),
+        "duration": time.time() - start_time
+    }
+
+def gallery_command(argv: List[str]):
+    """Offline tools: gallery export-snapshot, export-delta, import, sync and dedup-report; benchmarks; replay"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="android_face_recognition_server.py")
+    parser.add_argument("--db", default="face_db", help="Face database directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_snapshot = commands.add_parser("export-snapshot", help="Write the full gallery to a file")
+    export_snapshot.add_argument("path")
+
+    export_delta = commands.add_parser("export-delta", help="Write changes since a gallery version to a file")
+    export_delta.add_argument("path")
+    export_delta.add_argument("--since", type=int, default=0)
+
+    import_file = commands.add_parser("import", help="Merge a snapshot or delta file")
+    import_file.add_argument("path")
+
+    sync = commands.add_parser("sync", help="Pull changes from a peer server")
+    sync.add_argument("peer", help="Peer URL, e.g. ws://10.0.0.2:5001")
+
+    benchmark = commands.add_parser("benchmark-detectors", help="Compare LBP fast mode with Haar")
+    benchmark.add_argument("images", nargs="*", help="Image files; synthetic frames if omitted")
+    benchmark.add_argument("--lbp-cascade", help="Path to an LBP cascade XML")
+
+    dedup = commands.add_parser("dedup-report", help="List near-duplicate enrollments")
+    dedup.add_argument("--threshold", type=float, default=0.95)
+    dedup.add_argument("--block-size", type=int, default=1024, help="Rows per similarity tile")
+
+    replay = commands.add_parser("replay", help="Play a recorded session capture against a server")
+    replay.add_argument("capture", help="File written with --record")
+    replay.add_argument("url", help="Server URL, e.g. ws://localhost:5001 or unix:/path/to/socket")
+    replay.add_argument("--speed", default="1", help="Playback rate, e.g. 1, 4 or max")
+    replay.add_argument("--copies", type=int, default=1, help="Concurrent copies of each recorded connection")
+
+    transports = commands.add_parser("benchmark-transport", help="Compare TCP loopback with a Unix socket")
+    transports.add_argument("--sizes", default="320x240,640x480,1280x720",
+                            help="Comma-separated frame sizes, WIDTHxHEIGHT")
+    transports.add_argument("--rounds", type=int, default=50)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        speed = None if args.speed == "max" else float(args.speed)
+        print(json.dumps(asyncio.run(replay_capture(args.capture, args.url, speed, args.copies)), indent=2))
+        return
+
+    if args.command == "benchmark-transport":
+        sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes.split(",")]
+        print(json.dumps(asyncio.run(benchmark_transports(sizes, args.rounds)), indent=2))
+        return
+
+    if args.command == "benchmark-detectors":
+        images = [cv2.imread(path) for path in args.images]
+        images = [image for image in images if image is not None]
+        if not images:
+            # Blurred random noise with no faces in it: measures latency only, not accuracy
+            rng = np.random.default_rng(0)
+            images = [cv2.GaussianBlur(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8), (0, 0), 8)
+                      for _ in range(5)]
+        detector = EnhancedAndroidFaceDetector(lbp_cascade_path=args.lbp_cascade)
+        print(json.dumps(benchmark_detectors(detector, images), indent=2))
+        return
+
+    store = FaceGalleryStore(args.db, durability="sync")
+
+    if args.command in ("export-snapshot", "export-delta"):
+        payload = store.snapshot() if args.command == "export-snapshot" else store.delta(args.since)
+        if payload.get("snapshot_required"):
+            print(f"Version {args.since} is older than the retained log; use export-snapshot")
+            sys.exit(1)
+        with open(args.path, "w") as f:
+            json.dump(payload, f)
+        print(f"Wrote {len(payload['entries'])} entries (gallery version {payload['gallery_version']}) to {args.path}")
+    elif args.command == "import":
+        print(json.dumps(sync_gallery(store, path=args.path)))
+    elif args.command == "sync":
+        print(json.dumps(sync_gallery(store, peer=args.peer)))
+    elif args.command == "dedup-report":
+        print(json.dumps(dedup_report(store, args.threshold, args.block_size), indent=2))
+
+GALLERY_COMMANDS = ("--db", "export-snapshot", "export-delta", "import", "sync", "benchmark-detectors",
+                    "benchmark-transport", "dedup-report", "replay")
+
+def parse_priority_weights(value: str) -> Dict[str, float]:
+    """Parse --priority-weights "name=weight,..." over DEFAULT_PRIORITY_WEIGHTS"""
+    import argparse
+    weights = dict(DEFAULT_PRIORITY_WEIGHTS)
+    for item in value.split(","):
+        name, sep, weight = item.strip().partition("=")
+        if not sep or name not in DEFAULT_PRIORITY_WEIGHTS:
+            raise argparse.ArgumentTypeError(
+                f"expected name=weight with name one of {', '.join(DEFAULT_PRIORITY_WEIGHTS)}, got {item!r}")
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"weight of {name} is not a number: {weight!r}")
+        if not weights[name] > 0 or weights[name] == float("inf"):
+            raise argparse.ArgumentTypeError(f"weight of {name} must be a positive number, got {weight!r}")
+    return weights
+
 def main():
     """Main function"""
+    # Gallery tools run without starting the server
+    if len(sys.argv) > 1 and sys.argv[1] in GALLERY_COMMANDS:
+        gallery_command(sys.argv[1:])
+        return
+
     # Print banner
     print(f"""
     ╔═══════════════════════════════════════════════════╗
@@ -652,11 +4162,101 @@ def main():
     ╚═══════════════════════════════════════════════════╝
     """)
 
-    # Get port from command line arguments
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    # Get port and options from command line arguments
+    import argparse
+    parser = argparse.ArgumentParser(prog="android_face_recognition_server.py")
+    parser.add_argument("port", nargs="?", type=int, default=5001)
+    parser.add_argument("--watch-interval", type=float, default=0,
+                        help="Poll face_db every N seconds and hot-reload changes")
+    parser.add_argument("--compaction-interval", type=float, default=10,
+                        help="Seconds between background compactions of deleted gallery entries (0 disables)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Use the LBP cascade by default (clients may still request haar)")
+    parser.add_argument("--eye-check", choices=["always", "sampled", "off"],
+                        help="Eye verification policy (default: always, or sampled with --fast)")
+    parser.add_argument("--eye-sample-every", type=int, default=4)
+    parser.add_argument("--lbp-cascade", help="Path to an LBP cascade XML")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.01,
+                        help="Fraction of requests whose structured trace is logged")
+    parser.add_argument("--trace-slow-ms", type=float, default=500,
+                        help="Always log traces of requests slower than this")
+    parser.add_argument("--workers", type=int,
+                        help="Detector worker threads (default: min(4, available CPUs / --cpu-threads))")
+    parser.add_argument("--cpu-threads", type=int,
+                        help="OpenCV/BLAS threads per worker (default: available CPUs / --workers)")
+    parser.add_argument("--pin-cpus", action="store_true", help="Bind each worker thread to its own CPUs (Linux)")
+    parser.add_argument("--priority-weights", type=parse_priority_weights, default=dict(DEFAULT_PRIORITY_WEIGHTS),
+                        help="Worker share per message class as name=weight pairs, e.g. interactive=8,batch=1; "
+                             "classes left out keep their default weight")
+    parser.add_argument("--unix-socket", help="Also listen on this Unix domain socket path")
+    parser.add_argument("--unix-socket-mode", type=lambda value: int(value, 8), default=0o660,
+                        help="Octal permissions of the Unix socket (default: 660)")
+    parser.add_argument("--record", metavar="PATH", help="Record inbound client messages for replay")
+    parser.add_argument("--batch-port", type=int, default=0,
+                        help="Serve the HTTP batch endpoint on this port (0 disables it)")
+    parser.add_argument("--batch-host", default="127.0.0.1")
+    parser.add_argument("--batch-concurrency", type=int, help="Batch items in flight per request")
+    parser.add_argument("--durability", choices=["sync", "batch", "none"], default="batch",
+                        help="Enrollment persistence: fsync inline, fsync per write-behind batch, or no fsync")
+    parser.add_argument("--quality-gate", choices=["reject", "flag", "off"], default="flag",
+                        help="Reject, flag or ignore blurred/dark/overexposed frames before detection")
+    parser.add_argument("--duplicate-policy", choices=["warn", "reject", "off"], default="warn",
+                        help="What to do when an enrollment matches a face enrolled under another id")
+    parser.add_argument("--duplicate-threshold", type=float, default=0.95)
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Search the gallery in this many worker processes, each holding a slice (0 disables)")
+    parser.add_argument("--shard-timeout-ms", type=float, default=500,
+                        help="Answer without a shard that has not replied within this time")
+    parser.add_argument("--max-templates", type=int, default=5,
+                        help="Templates kept per person; each registration adds one (1 restores overwrite)")
+    parser.add_argument("--template-eviction", choices=["outlier", "oldest"], default="outlier",
+                        help="Template dropped beyond --max-templates: least like the rest, or oldest")
+    parser.add_argument("--template-reduce", choices=["max", "mean"], default="max",
+                        help="Person score from its template scores")
+    parser.add_argument("--memory-limit-mb", type=float, default=0,
+                        help="Resident memory ceiling; when reached, evict caches, move the gallery to disk "
+                             "and refuse large frames (0 disables it)")
+    parser.add_argument("--pressure-max-frame-mb", type=float, default=1,
+                        help="Largest encoded frame accepted while over the memory ceiling")
+    parser.add_argument("--memory-profiling", action="store_true",
+                        help="Accept memory_snapshot requests, which turn on tracemalloc for every allocation")
+    args = parser.parse_args()
+
+    detector_options = {
+        "detection_mode": "lbp" if args.fast else "haar",
+        "eye_check": args.eye_check or ("sampled" if args.fast else "always"),
+        "eye_sample_every": args.eye_sample_every,
+        "lbp_cascade_path": args.lbp_cascade,
+        "quality_gate": args.quality_gate,
+        "duplicate_policy": args.duplicate_policy,
+        "duplicate_threshold": args.duplicate_threshold,
+        "max_templates": args.max_templates,
+        "shards": args.shards,
+        "shard_timeout": args.shard_timeout_ms / 1000,
+        "template_eviction": args.template_eviction,
+        "template_reduce": args.template_reduce,
+        "memory_limit": int(args.memory_limit_mb * 2**20),
+        "pressure_max_frame_bytes": int(args.pressure_max_frame_mb * 2**20),
+        "durability": args.durability
+    }
 
     # Create and start server
-    server = EnhancedAndroidWebSocketServer(port=port)
+    server = EnhancedAndroidWebSocketServer(port=args.port, watch_interval=args.watch_interval,
+                                            compaction_interval=args.compaction_interval,
+                                            memory_profiling=args.memory_profiling,
+                                            detector_options=detector_options,
+                                            trace_sample_rate=args.trace_sample_rate,
+                                            trace_slow_threshold=args.trace_slow_ms / 1000,
+                                            workers=args.workers,
+                                            cpu_threads=args.cpu_threads,
+                                            pin_cpus=args.pin_cpus,
+                                            unix_socket=args.unix_socket,
+                                            unix_socket_mode=args.unix_socket_mode,
+                                            record_path=args.record,
+                                            batch_port=args.batch_port,
+                                            batch_host=args.batch_host,
+                                            batch_concurrency=args.batch_concurrency,
+                                            priority_weights=args.priority_weights)
 
     # Run server
     asyncio.run(server.start())
@@ -1,10 +1,60 @@
 import os
+import io
+import sys
+import json
+import time
+import hashlib
+import argparse
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image, ImageDraw, ImageFont
-import cairosvg
 
-def generate_logo():
+# Bump when rendering changes so every output is rebuilt once
+PIPELINE_VERSION = 1
+
+# Content hashes of the sources each output was last rendered from
+CACHE_PATH = 'assets/favicon/.asset_cache.json'
+
+LOGO_SVG = 'assets/favicon/nafacial_logo.svg'
+WEB_SVG = 'assets/favicon/web/nafacial_logo.svg'
+ANDROID_SVG = 'assets/favicon/android/nafacial_logo.svg'
+WINDOWS_SVG = 'assets/favicon/windows/nafacial_logo.svg'
+
+# Android launcher icon densities
+MIPMAP_SIZES = {'mdpi': 48, 'hdpi': 72, 'xhdpi': 96, 'xxhdpi': 144, 'xxxhdpi': 192}
+
+def _asset(path, source, sizes, style='plain'):
+    """One output file: a PNG of one size, or an ICO holding several"""
+    return {'path': path, 'source': source, 'sizes': sizes, 'style': style}
+
+# Every derived raster, and the SVG it is rendered from
+ASSETS = [
+    _asset('assets/favicon/nafacial_logo.png', LOGO_SVG, [512]),
+    _asset('assets/favicon/favicon-96x96.png', LOGO_SVG, [96]),
+    _asset('assets/favicon/web/favicon-32x32.png', WEB_SVG, [32]),
+    _asset('assets/favicon/web/favicon.ico', WEB_SVG, [16, 32, 48]),
+    _asset('assets/favicon/android/android-chrome-192x192.png', ANDROID_SVG, [192]),
+    _asset('assets/favicon/android/android-chrome-512x512.png', ANDROID_SVG, [512]),
+    _asset('assets/favicon/windows/app_icon.png', WINDOWS_SVG, [32]),
+    _asset('windows/runner/resources/app_icon.ico', WINDOWS_SVG, [16, 24, 32, 48, 64, 256]),
+    _asset('web/favicon.ico', WEB_SVG, [16, 32, 48]),
+    _asset('web/icons/Icon-192.png', WEB_SVG, [192]),
+    _asset('web/icons/Icon-512.png', WEB_SVG, [512]),
+    _asset('web/icons/Icon-maskable-192.png', WEB_SVG, [192], 'maskable'),
+    _asset('web/icons/Icon-maskable-512.png', WEB_SVG, [512], 'maskable'),
+] + [
+    _asset(f'android/app/src/main/res/mipmap-{density}/{name}.png', ANDROID_SVG, [size], style)
+    for density, size in MIPMAP_SIZES.items()
+    for name, style in (('launcher_icon', 'plain'), ('ic_launcher', 'plain'), ('ic_launcher_round', 'round'))
+] + [
+    # Sizes the original script produced alongside the 512px logo
+    _asset(f'assets/favicon/nafacial_logo_{size}x{size}.png', LOGO_SVG, [size])
+    for size in (192, 96, 48, 32)
+]
+
+def draw_logo(size=512):
+    """Draw the logo with PIL; used when there is no SVG or cairosvg is unavailable"""
     # Create a circular background
-    size = 512
     image = Image.new('RGBA', (size, size), (0, 0, 0, 0))
     draw = ImageDraw.Draw(image)
     
@@ -67,40 +117,179 @@ def generate_logo():
     draw.text((center - text_width / 2, center + face_radius * 1.5), text, 
               fill=(255, 215, 0, 255), font=font)
     
+    return image
+
+def generate_logo():
+    """Draw the 512px logo and its smaller versions with PIL"""
+    image = draw_logo(512)
+
     # Save the image
     os.makedirs('assets/favicon', exist_ok=True)
     image_path = 'assets/favicon/nafacial_logo.png'
     image.save(image_path)
-    
+
     # Create smaller versions for different platforms
     sizes = [192, 96, 48, 32]
     for size in sizes:
         resized = image.resize((size, size), Image.LANCZOS)
         resized.save(f'assets/favicon/nafacial_logo_{size}x{size}.png')
-    
+
     print(f"Logo generated and saved to {image_path}")
     return image_path
 
+def svg_renderer():
+    """'cairosvg' when SVGs can be rasterized here, else 'pil' for the drawn fallback"""
+    if importlib.util.find_spec('cairosvg') is None:
+        return 'pil'
+    try:
+        importlib.import_module('cairosvg')
+    except OSError:
+        # cairosvg installed without the cairo library
+        return 'pil'
+    return 'cairosvg'
+
+def render_svg(source, size):
+    """Render an SVG at size x size, or draw the PIL logo if that is not possible"""
+    try:
+        import cairosvg
+        with open(source, 'rb') as f:
+            png = cairosvg.svg2png(bytestring=f.read(), output_width=size, output_height=size)
+        return Image.open(io.BytesIO(png)).convert('RGBA')
+    except (ImportError, OSError):
+        # OSError: no SVG, or cairosvg installed without the cairo library
+        drawn = draw_logo(max(size, 512))
+        return drawn if drawn.size == (size, size) else drawn.resize((size, size), Image.LANCZOS)
+
+def apply_style(image, style):
+    """Post-process a rendered icon for its platform"""
+    size = image.size[0]
+    if style == 'round':
+        # Circular launcher icon
+        mask = Image.new('L', image.size, 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, size - 1, size - 1), fill=255)
+        rounded = Image.new('RGBA', image.size, (0, 0, 0, 0))
+        rounded.paste(image, (0, 0), mask)
+        return rounded
+    if style == 'maskable':
+        # Keep the logo inside the 80% safe zone on the logo's background colour
+        inner = int(size * 0.8)
+        padded = Image.new('RGBA', image.size, (0, 31, 63, 255))
+        offset = (size - inner) // 2
+        icon = image.resize((inner, inner), Image.LANCZOS)
+        padded.paste(icon, (offset, offset), icon)
+        return padded
+    return image
+
+def render_asset(asset):
+    """Render one output file; runs in a worker process"""
+    start_time = time.perf_counter()
+    sizes = asset['sizes']
+    images = [apply_style(render_svg(asset['source'], size), asset['style']) for size in sizes]
+
+    os.makedirs(os.path.dirname(asset['path']), exist_ok=True)
+    tmp_path = asset['path'] + '.tmp'
+    if asset['path'].endswith('.ico'):
+        images[-1].save(tmp_path, format='ICO', sizes=[(size, size) for size in sizes],
+                        append_images=images[:-1])
+    else:
+        images[0].save(tmp_path, format='PNG', optimize=True)
+    os.replace(tmp_path, asset['path'])
+    return asset['path'], time.perf_counter() - start_time
+
+def asset_hash(asset, renderer):
+    """Hash of everything an output depends on: source content, renderer and recipe"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([PIPELINE_VERSION, renderer, asset['sizes'], asset['style']]).encode())
+    if os.path.exists(asset['source']):
+        with open(asset['source'], 'rb') as f:
+            digest.update(f.read())
+    else:
+        digest.update(b'pil-fallback')
+    return digest.hexdigest()
+
+def build_assets(force=False, workers=None, allow_pil_fallback=False):
+    """
+    Render every asset whose source hash changed, in a process pool
+
+    Without cairosvg, outputs that already exist are left alone rather than
+    replaced by the PIL drawing, unless allow_pil_fallback is set; missing
+    ones are still drawn.
+
+    Returns:
+        Per-asset render times and the numbers of outputs skipped and kept
+    """
+    start_time = time.perf_counter()
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    # A fallback render must not satisfy the cache once cairosvg is available
+    renderer = svg_renderer()
+    hashes = {asset['path']: asset_hash(asset, renderer) for asset in ASSETS}
+    stale = [asset for asset in ASSETS
+             if force or cache.get(asset['path']) != hashes[asset['path']] or not os.path.exists(asset['path'])]
+
+    kept = []
+    if renderer != 'cairosvg':
+        if allow_pil_fallback:
+            print("cairosvg is not available; drawing icons with PIL instead", file=sys.stderr)
+        else:
+            # Never replace committed icons with the placeholder drawing
+            kept = [asset['path'] for asset in stale if os.path.exists(asset['path'])]
+            stale = [asset for asset in stale if asset['path'] not in kept]
+            if kept:
+                print(f"cairosvg is not available; left {len(kept)} existing icons untouched "
+                      f"(--allow-pil-fallback redraws them with PIL)", file=sys.stderr)
+
+    timings = {}
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(render_asset, asset): asset['path'] for asset in stale}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    _, elapsed = future.result()
+                except Exception as e:
+                    print(f"Error rendering {path}: {e}")
+                    continue
+                timings[path] = elapsed
+                cache[path] = hashes[path]
+
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+    return {
+        'rendered': timings,
+        'skipped': len(ASSETS) - len(stale) - len(kept),
+        'kept': len(kept),
+        'failed': len(stale) - len(timings),
+        'total_time': time.perf_counter() - start_time
+    }
+
 def convert_svg_to_png():
     """Convert the existing SVG logo to PNG if it exists"""
-    svg_path = 'assets/favicon/nafacial_logo.svg'
+    svg_path = LOGO_SVG
     if os.path.exists(svg_path):
         png_path = 'assets/favicon/nafacial_logo.png'
-        cairosvg.svg2png(url=svg_path, write_to=png_path, output_width=512, output_height=512)
+        render_svg(svg_path, 512).save(png_path)
         print(f"Converted SVG to PNG: {png_path}")
         return png_path
     return None
 
 if __name__ == "__main__":
-    try:
-        # First try to convert existing SVG
-        png_path = convert_svg_to_png()
-        if not png_path:
-            # If no SVG or conversion failed, generate from scratch
-            png_path = generate_logo()
-        
-        print(f"Logo saved to {png_path}")
-    except Exception as e:
-        print(f"Error generating logo: {e}")
-        # Generate a simple fallback logo if everything else fails
-        generate_logo()
+    parser = argparse.ArgumentParser(description="Render the app icons and favicons from the SVG sources")
+    parser.add_argument('--force', action='store_true', help="Rebuild every asset, even if its source is unchanged")
+    parser.add_argument('--workers', type=int, help="Render processes (default: CPU count)")
+    parser.add_argument('--allow-pil-fallback', action='store_true',
+                        help="Without cairosvg, redraw existing icons with PIL instead of leaving them")
+    args = parser.parse_args()
+
+    report = build_assets(args.force, args.workers, args.allow_pil_fallback)
+    for path, elapsed in sorted(report['rendered'].items(), key=lambda item: -item[1]):
+        print(f"{elapsed * 1000:8.1f} ms  {path}")
+    print(f"Rendered {len(report['rendered'])}, skipped {report['skipped']} unchanged, "
+          f"kept {report['kept']} without cairosvg, failed {report['failed']} in {report['total_time']:.2f}s")
+    sys.exit(1 if report['failed'] else 0)
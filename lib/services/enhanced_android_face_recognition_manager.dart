@@ -49,7 +49,15 @@ class EnhancedAndroidFaceRecognitionManager {
   String _serverScriptPath = "";
   String _runScriptPath = "";
   String _setupScriptPath = "";
-  
+
+  // Modules from python/ that the server imports, installed next to it
+  static const List<String> _sharedModules = [
+    'cpu_governor.py',
+    'persistence_writer.py',
+    'request_tracing.py',
+    'session_capture.py',
+  ];
+
   // Getters
   bool get isServerRunning => _isServerRunning;
   bool get isServerInstalled => _isServerInstalled;
@@ -181,6 +189,12 @@ class EnhancedAndroidFaceRecognitionManager {
       final serverContent = await rootBundle.loadString('assets/python/android_face_recognition_server.py');
       await serverFile.writeAsString(serverContent);
 
+      // Copy the shared modules the server imports
+      for (final module in _sharedModules) {
+        final moduleContent = await rootBundle.loadString('python/$module');
+        await File('${serverDir.path}/$module').writeAsString(moduleContent);
+      }
+
       // Create setup script
       final setupScriptFile = File(_setupScriptPath);
       await setupScriptFile.writeAsString('''
@@ -199,8 +213,8 @@ pip install websockets
 # Create directory structure
 mkdir -p ~/nafacial/python
 
-# Copy server file
-cp ${_serverScriptPath} ~/nafacial/python/
+# Copy server file and the modules it imports
+cp ${serverDir.path}/*.py ~/nafacial/python/
 
 # Create run script
 cat > ~/nafacial/run_server.sh << 'EOF'
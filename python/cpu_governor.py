@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+CPU sizing for the NAFacial facial authentication service.
+Keeps OpenCV and BLAS thread pools within the CPUs the process may use.
+"""
+
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional
+
+import cv2
+
+logger = logging.getLogger("CPUGovernor")
+
+# Thread-count variables honoured by OpenBLAS, MKL and OpenMP builds of numpy
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+def available_cpus() -> List[int]:
+    """CPUs this process may run on; honours taskset and container CPU sets"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def limit_blas_threads(threads: int) -> str:
+    """
+    Cap the BLAS/OpenMP pools numpy uses
+
+    Returns:
+        "threadpoolctl" when the loaded libraries were limited, else
+        "environment" (only libraries loaded later see the variables)
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+        return "threadpoolctl"
+    except ImportError:
+        for variable in BLAS_THREAD_VARIABLES:
+            os.environ[variable] = str(threads)
+        return "environment"
+
+class CPUGovernor:
+    """
+    Thread budget of the service's single compute path
+
+    Requests run one at a time on the event loop, so the native pools get
+    the whole budget: every available CPU unless threads is given. OpenCV
+    counts its own CPUs and BLAS counts the host's, so both are set
+    explicitly here, and with pin the process is bound to the first
+    `threads` CPUs it may use (Linux only).
+    """
+
+    def __init__(self, threads: Optional[int] = None, pin: bool = False):
+        """
+        Args:
+            threads: OpenCV/BLAS threads (default: every available CPU)
+            pin: Bind the process to `threads` CPUs
+        """
+        cpus = available_cpus()
+        self.threads = max(1, min(threads or len(cpus), len(cpus)))
+        self.cpus = cpus[:self.threads] if pin else cpus
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+        if self.pin:
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                logger.warning(f"Could not pin to CPUs {self.cpus}: {e}")
+                self.pin = False
+        elif pin:
+            logger.warning("CPU pinning is not supported on this platform")
+
+        cv2.setNumThreads(self.threads)
+        self.blas_limit = limit_blas_threads(self.threads)
+        self.start_time = time.perf_counter()
+        self.jobs = 0
+        self.busy = 0.0
+        self.cpu = 0.0
+
+    @contextmanager
+    def measure(self):
+        """Charge the wall and CPU time of the enclosed request to the compute path"""
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        try:
+            yield
+        finally:
+            self.jobs += 1
+            self.busy += time.perf_counter() - started
+            self.cpu += time.process_time() - cpu_started
+
+    def get_metrics(self) -> Dict[str, Any]:
+        uptime = max(time.perf_counter() - self.start_time, 1e-9)
+        return {
+            "cpus": len(self.cpus),
+            "threads": self.threads,
+            "opencv_threads": cv2.getNumThreads(),
+            "blas_limit": self.blas_limit,
+            "pinned": self.pin,
+            "jobs": self.jobs,
+            "utilisation": self.busy / uptime,
+            # Process CPU time over busy time: how many cores a request kept busy on average
+            "parallelism": self.cpu / self.busy if self.busy else 0.0
+        }
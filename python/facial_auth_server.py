@@ -1,70 +1,156 @@
-%USERPROFILE%\.vscode-augment-cacheimport asyncio
+import asyncio
 import websockets
 import json
 import base64
 import numpy as np
 import cv2
+from cpu_governor import CPUGovernor
 from facial_auth_service import FacialAuthService
+from request_tracing import RequestTracer, activate_trace, deactivate_trace, trace_span
+from session_capture import SessionRecorder
 
 class FacialAuthServer:
-    def __init__(self, host="localhost", port=8765):
+    def __init__(self, host="localhost", port=8765, accuracy_tier="high", durability="batch",
+                 trace_sample_rate=0.01, trace_slow_threshold=0.5, record_path=None, cpu_threads=None,
+                 pin_cpus=False, **service_options):
         self.host = host
         self.port = port
-        self.service = FacialAuthService()
-        
-    async def handle_client(self, websocket, path):
+        # Before the service benchmarks its backends, so they run with the final thread counts
+        self.governor = CPUGovernor(cpu_threads, pin_cpus)
+        self.service = FacialAuthService(accuracy_tier=accuracy_tier, durability=durability,
+                                         **service_options)
+        self.tracer = RequestTracer(trace_sample_rate, trace_slow_threshold)
+        # Opt-in capture of inbound messages for session_capture.py replay
+        self.recorder = SessionRecorder(record_path) if record_path else None
+
+    def _decode_image(self, data):
+        """Decode the base64 image of a request"""
+        with trace_span('decode'):
+            image_data = data['image'].split(',')[1] if ',' in data['image'] else data['image']
+            image_bytes = base64.b64decode(image_data)
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+    async def handle_message(self, data):
+        """Handle one parsed command and return the response"""
+        command = data.get('command')
+
+        if command == 'verify_face':
+            # Decode base64 image
+            image = self._decode_image(data)
+
+            # Verify face
+            return await self.service.verify_face(
+                image,
+                data.get('user_id')
+            )
+
+        elif command == 'register_face':
+            # Decode base64 image
+            image = self._decode_image(data)
+
+            # Register face; adds a template unless replace is set
+            return await self.service.register_face(
+                image,
+                data.get('user_id'),
+                bool(data.get('replace', False))
+            )
+
+        elif command == 'update_face':
+            # Replace the user's templates with the face in this image
+            image = self._decode_image(data)
+            return await self.service.update_face(
+                image,
+                data.get('user_id')
+            )
+
+        elif command == 'delete_face':
+            return await self.service.delete_face(data.get('user_id'))
+
+        elif command == 'identify_face':
+            # Decode base64 image
+            image = self._decode_image(data)
+
+            # Identify face, optionally with the k closest candidates
+            return await self.service.identify_face(
+                image,
+                int(data.get('top_k', 0))
+            )
+
+        elif command == 'encode_faces':
+            # Several frames in one request are detected and encoded together
+            images = [self._decode_image({'image': image}) for image in data.get('images', [])]
+            faces = self.service.extract_faces(images, all_faces=data.get('all_faces', True))
+            return {
+                'success': True,
+                'encoding': self.service.backend.encoding,
+                'frames': [
+                    [{'location': face['location'], 'encoding': face['encoding'].tolist()} for face in frame]
+                    for frame in faces
+                ]
+            }
+
+        elif command == 'get_metrics':
+            metrics = self.service.get_metrics()
+            metrics['tracing'] = self.tracer.get_metrics()
+            metrics['cpu'] = self.governor.get_metrics()
+            if self.recorder:
+                metrics['recording'] = self.recorder.get_metrics()
+            return {
+                'success': True,
+                'metrics': metrics
+            }
+
+        else:
+            return {
+                'success': False,
+                'message': f'Unknown command: {command}'
+            }
+
+    async def handle_client(self, websocket, path=None):
         """Handle WebSocket client connection"""
+        connection_id = self.recorder.connection_id() if self.recorder else 0
         try:
             async for message in websocket:
+                if self.recorder:
+                    self.recorder.record(connection_id, message)
+
+                # Trace the request; service stages record spans through the context variable
+                trace = self.tracer.start()
+                token = activate_trace(trace)
                 try:
                     data = json.loads(message)
-                    command = data.get('command')
-                    
-                    if command == 'verify_face':
-                        # Decode base64 image
-                        image_data = data['image'].split(',')[1] if ',' in data['image'] else data['image']
-                        image_bytes = base64.b64decode(image_data)
-                        nparr = np.frombuffer(image_bytes, np.uint8)
-                        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        
-                        # Verify face
-                        result = await self.service.verify_face(
-                            image,
-                            data.get('user_id')
-                        )
-                        
-                        await websocket.send(json.dumps(result))
-                        
-                    elif command == 'register_face':
-                        # Decode base64 image
-                        image_data = data['image'].split(',')[1] if ',' in data['image'] else data['image']
-                        image_bytes = base64.b64decode(image_data)
-                        nparr = np.frombuffer(image_bytes, np.uint8)
-                        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        
-                        # Register face
-                        result = await self.service.register_face(
-                            image,
-                            data.get('user_id')
-                        )
-                        
-                        await websocket.send(json.dumps(result))
-                    
-                    else:
-                        await websocket.send(json.dumps({
-                            'success': False,
-                            'message': f'Unknown command: {command}'
-                        }))
-                        
-                except json.JSONDecodeError:
-                    await websocket.send(json.dumps({
+                    trace.message_type = data.get('command') or ''
+                    trace.set_client_trace_id(data.get('trace_id'))
+                    with self.governor.measure():
+                        response = await self.handle_message(data)
+
+                except json.JSONDecodeError as e:
+                    trace.fail(e)
+                    response = {
                         'success': False,
                         'message': 'Invalid JSON'
-                    }))
-                    
+                    }
+
+                except Exception as e:
+                    trace.fail(e)
+                    response = {
+                        'success': False,
+                        'message': str(e)
+                    }
+                deactivate_trace(token)
+
+                # Echo the trace id so clients can correlate slow requests with the log
+                response['trace_id'] = trace.trace_id
+                with trace.span('serialize'):
+                    payload = json.dumps(response)
+                await websocket.send(payload)
+
+                self.tracer.finish(trace)
+
         except websockets.exceptions.ConnectionClosed:
             pass
-            
+
     async def start(self):
         """Start the WebSocket server"""
         server = await websockets.serve(
@@ -72,10 +158,55 @@ class FacialAuthServer:
             self.host,
             self.port
         )
-        
+
         print(f"Server running at ws://{self.host}:{self.port}")
         await server.wait_closed()
 
 if __name__ == "__main__":
-    server = FacialAuthServer()
-    asyncio.run(server.start())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accuracy-tier", choices=["low", "medium", "high"], default="high",
+                        help="Lowest acceptable detector/encoder tier; the fastest qualifying backend is used")
+    parser.add_argument("--durability", choices=["sync", "batch", "none"], default="batch",
+                        help="Registration persistence: fsync inline, fsync per write-behind batch, or no fsync")
+    parser.add_argument("--detection-scale", type=float, default=1.0,
+                        help="Resize frames by this factor before face detection, e.g. 0.25 for 12 MP photos")
+    parser.add_argument("--upsample", type=int, default=1,
+                        help="number_of_times_to_upsample for the face_recognition detector")
+    parser.add_argument("--detection-model", choices=["hog", "cnn"], default="hog",
+                        help="face_recognition detector model")
+    parser.add_argument("--max-templates", type=int, default=5,
+                        help="Encodings kept per user; each registration adds one (1 restores overwrite)")
+    parser.add_argument("--template-eviction", choices=["outlier", "oldest"], default="outlier",
+                        help="Encoding dropped beyond --max-templates: farthest from the rest, or oldest")
+    parser.add_argument("--template-reduce", choices=["max", "mean"], default="max",
+                        help="User score from its encodings: closest, or mean distance")
+    parser.add_argument("--compaction-delay", type=float, default=5,
+                        help="Seconds after a deletion before the gallery matrix is rebuilt without it")
+    parser.add_argument("--cpu-threads", type=int, help="OpenCV/BLAS threads (default: every available CPU)")
+    parser.add_argument("--pin-cpus", action="store_true", help="Bind the process to --cpu-threads CPUs (Linux)")
+    parser.add_argument("--record", metavar="PATH", help="Record inbound client messages for replay")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.01,
+                        help="Fraction of requests whose structured trace is logged")
+    parser.add_argument("--trace-slow-ms", type=float, default=500,
+                        help="Always log traces of requests slower than this")
+    args = parser.parse_args()
+
+    server = FacialAuthServer(accuracy_tier=args.accuracy_tier, durability=args.durability,
+                              trace_sample_rate=args.trace_sample_rate,
+                              trace_slow_threshold=args.trace_slow_ms / 1000,
+                              detection_scale=args.detection_scale, upsample=args.upsample,
+                              detection_model=args.detection_model, max_templates=args.max_templates,
+                              template_eviction=args.template_eviction, template_reduce=args.template_reduce,
+                              compaction_delay=args.compaction_delay,
+                              record_path=args.record,
+                              cpu_threads=args.cpu_threads, pin_cpus=args.pin_cpus)
+    try:
+        asyncio.run(server.start())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Flush registrations still in the write-behind queue
+        server.service.close()
+        if server.recorder:
+            server.recorder.close()
\ No newline at end of file
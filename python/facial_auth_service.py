@@ -5,17 +5,22 @@ This service provides advanced face recognition and authentication capabilities
 using multiple state-of-the-art models and techniques.
 """
 
+import io
 import os
 import json
 import base64
 import asyncio
 import logging
-import traceback
+import time
+from abc import ABC, abstractmethod
 from typing import Dict, List, Any, Optional, Tuple
 import numpy as np
 import cv2
 from PIL import Image
 
+from persistence_writer import PersistenceWriter
+from request_tracing import record_exception, trace_span
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -52,29 +57,458 @@ except ImportError:
     FACE_RECOGNITION_AVAILABLE = False
     logger.warning("face_recognition is not available, some features will be disabled")
 
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, via a linear-time np.argpartition"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    candidates = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+# Accuracy tiers, lowest to highest
+ACCURACY_TIERS = ["low", "medium", "high"]
+
+class FaceBackend(ABC):
+    """
+    Common detector/encoder interface over the available face libraries
+
+    Subclasses declare an accuracy tier and an encoding family; encodings from
+    different families cannot be compared with each other.
+    """
+
+    name = ""
+    tier = "low"
+    encoding = ""
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    @abstractmethod
+    def detect(self, image: np.ndarray, rgb_image: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """Return face locations as (top, right, bottom, left)"""
+
+    @abstractmethod
+    def encode(self, image: np.ndarray, rgb_image: np.ndarray, location: Tuple[int, int, int, int]) -> np.ndarray:
+        """Return the encoding of the face at location"""
+
+    def detect_many(self, images: List[np.ndarray], rgb_images: List[np.ndarray]) -> List[List[Tuple[int, int, int, int]]]:
+        """Face locations for several frames; backends that can batch override this"""
+        return [self.detect(image, rgb_image) for image, rgb_image in zip(images, rgb_images)]
+
+    def encode_many(self, image: np.ndarray, rgb_image: np.ndarray,
+                    locations: List[Tuple[int, int, int, int]]) -> List[np.ndarray]:
+        """Encodings of several faces in one frame; backends that can batch override this"""
+        return [self.encode(image, rgb_image, location) for location in locations]
+
+    @staticmethod
+    def _pixel_encoding(face_image: np.ndarray) -> np.ndarray:
+        # We don't have face encodings without face_recognition, so we'll use a simple feature vector
+        # This is not as accurate as face_recognition encodings
+        face_image_small = cv2.resize(face_image, (128, 128))
+        face_image_gray = cv2.cvtColor(face_image_small, cv2.COLOR_BGR2GRAY)
+        return face_image_gray.flatten() / 255.0  # Normalize
+
+class FaceRecognitionBackend(FaceBackend):
+    """face_recognition (dlib) HOG detector with 128-d encodings"""
+
+    name = "face_recognition_hog"
+    tier = "high"
+    encoding = "dlib128"
+
+    @classmethod
+    def available(cls) -> bool:
+        return FACE_RECOGNITION_AVAILABLE
+
+    def __init__(self, upsample: int = 1, model: str = "hog"):
+        """
+        Args:
+            upsample: number_of_times_to_upsample for face_locations; each step
+                finds smaller faces at roughly 4x the detection cost
+            model: "hog" (CPU) or "cnn" (dlib CNN, much slower without CUDA)
+        """
+        if model not in ("hog", "cnn"):
+            raise ValueError(f"Unknown face_recognition model: {model}")
+        self.upsample = upsample
+        self.model = model
+
+    def detect(self, image, rgb_image):
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=self.upsample,
+                                               model=self.model)
+
+    def detect_many(self, images, rgb_images):
+        # The CNN detector can run equally sized frames as one batch
+        if self.model == "cnn" and len(rgb_images) > 1 and len({rgb.shape for rgb in rgb_images}) == 1:
+            return face_recognition.batch_face_locations(rgb_images, number_of_times_to_upsample=self.upsample,
+                                                         batch_size=len(rgb_images))
+        return super().detect_many(images, rgb_images)
+
+    def encode(self, image, rgb_image, location):
+        return face_recognition.face_encodings(rgb_image, [location])[0]
+
+    def encode_many(self, image, rgb_image, locations):
+        return face_recognition.face_encodings(rgb_image, locations)
+
+class MediaPipeBackend(FaceBackend):
+    """MediaPipe face detection with a pixel feature vector"""
+
+    name = "mediapipe"
+    tier = "medium"
+    encoding = "pixels128"
+
+    @classmethod
+    def available(cls) -> bool:
+        return MEDIAPIPE_AVAILABLE
+
+    def __init__(self):
+        self.face_detector = mp_face_detection.FaceDetection(min_detection_confidence=0.5)
+
+    def detect(self, image, rgb_image):
+        results = self.face_detector.process(rgb_image)
+        if not results.detections:
+            return []
+
+        height, width, _ = image.shape
+        locations = []
+        for detection in results.detections:
+            bbox = detection.location_data.relative_bounding_box
+            x = int(bbox.xmin * width)
+            y = int(bbox.ymin * height)
+            w = int(bbox.width * width)
+            h = int(bbox.height * height)
+            locations.append((y, x + w, y + h, x))
+        return locations
+
+    def encode(self, image, rgb_image, location):
+        top, right, bottom, left = location
+        return self._pixel_encoding(image[top:bottom, left:right])
+
+class HaarBackend(FaceBackend):
+    """OpenCV Haar cascade with a pixel feature vector"""
+
+    name = "haar"
+    tier = "low"
+    encoding = "pixels128"
+
+    def __init__(self):
+        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+    def detect(self, image, rgb_image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        faces = self.face_cascade.detectMultiScale(gray, 1.1, 4)
+        return [(int(y), int(x + w), int(y + h), int(x)) for (x, y, w, h) in faces]
+
+    def encode(self, image, rgb_image, location):
+        top, right, bottom, left = location
+        return self._pixel_encoding(image[top:bottom, left:right])
+
+# Backends in the historical preference order (used when benchmarking is off)
+FACE_BACKENDS = [FaceRecognitionBackend, MediaPipeBackend, HaarBackend]
+
+def benchmark_backend(backend: FaceBackend, frames: List[np.ndarray], rounds: int = 2) -> Dict[str, Any]:
+    """
+    Time detection plus one encoding per synthetic frame
+
+    Encoding always runs on a fixed central box so backends are compared on
+    the same amount of work whether or not they find a face in the frame.
+
+    Returns:
+        Median and mean milliseconds per frame
+    """
+    timings = []
+    for i in range(rounds + 1):
+        for image in frames:
+            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            height, width = image.shape[:2]
+            box = (height // 4, width * 3 // 4, height * 3 // 4, width // 4)
+
+            start_time = time.perf_counter()
+            backend.detect(image, rgb_image)
+            backend.encode(image, rgb_image, box)
+            elapsed = time.perf_counter() - start_time
+
+            # First round warms up lazy model loading
+            if i > 0:
+                timings.append(elapsed * 1000)
+
+    return {
+        "median_ms": float(np.median(timings)),
+        "mean_ms": float(np.mean(timings)),
+        "samples": len(timings)
+    }
+
+def synthetic_frames(count: int = 3, size: Tuple[int, int] = (480, 640)) -> List[np.ndarray]:
+    """Camera-sized frames with a rough face-like blob over a smooth textured background"""
+    rng = np.random.default_rng(0)
+    height, width = size
+    frames = []
+    for i in range(count):
+        # Blurred noise looks more like a real scene than white noise, which is a
+        # pathological worst case for cascade detectors
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (0, 0), 8)
+        center = (width // 2 + 20 * i, height // 2)
+        cv2.ellipse(image, center, (width // 8, height // 5), 0, 0, 360, (150, 180, 220), -1)
+        cv2.circle(image, (center[0] - width // 20, center[1] - height // 20), 8, (40, 40, 40), -1)
+        cv2.circle(image, (center[0] + width // 20, center[1] - height // 20), 8, (40, 40, 40), -1)
+        frames.append(image)
+    return frames
+
 class FacialAuthService:
     """Advanced facial authentication service"""
 
-    def __init__(self):
-        """Initialize the service"""
+    def __init__(self, accuracy_tier: str = "high", auto_select_backend: bool = True,
+                 durability: str = "batch", detection_scale: float = 1.0, upsample: int = 1,
+                 detection_model: str = "hog", max_templates: int = 5, template_eviction: str = "outlier",
+                 template_reduce: str = "max", compaction_delay: float = 5.0):
+        """
+        Initialize the service
+
+        Args:
+            accuracy_tier: Lowest acceptable backend tier ("low", "medium" or "high").
+                If no installed backend reaches it, the best installed tier is used.
+            auto_select_backend: Benchmark qualifying backends at startup and use the
+                fastest; otherwise use the first one in FACE_BACKENDS order
+            durability: Persistence mode for registrations: "sync", "batch" or "none"
+            detection_scale: Factor frames are resized by before face detection;
+                boxes are mapped back and encodings use the full-resolution frame
+            upsample: number_of_times_to_upsample for the face_recognition detector
+            detection_model: face_recognition detector, "hog" or "cnn"
+            max_templates: Encodings kept per user; registering beyond it evicts one
+            template_eviction: Which encoding goes: "outlier" (farthest from the rest) or "oldest"
+            template_reduce: User score from its encodings: "max" (closest) or "mean"
+            compaction_delay: Seconds after a deletion before the gallery matrix is rebuilt without it
+        """
+        if not 0 < detection_scale <= 1:
+            raise ValueError("detection_scale must be in (0, 1]")
+        if template_eviction not in ("outlier", "oldest"):
+            raise ValueError(f"Unknown template eviction policy: {template_eviction}")
+        if template_reduce not in ("max", "mean"):
+            raise ValueError(f"Unknown template reduction: {template_reduce}")
+        self.detection_scale = detection_scale
+        self.upsample = upsample
+        self.detection_model = detection_model
+        self.max_templates = max(1, max_templates)
+        self.template_eviction = template_eviction
+        self.template_reduce = template_reduce
+
         # Create directories for storing face data
         self.data_dir = os.path.join(os.path.dirname(__file__), "face_data")
         os.makedirs(self.data_dir, exist_ok=True)
 
+        # Registration writes go through a write-behind queue
+        self.writer = PersistenceWriter(durability)
+        self._encoding_cache: Dict[str, np.ndarray] = {}
+        # user ids, every template stacked, each user's first row and the tombstone mask
+        self._gallery_cache: Optional[Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]] = None
+        # Bumped whenever the face database changes, so a stale background rebuild is discarded
+        self._gallery_generation = 0
+        self.compaction_delay = compaction_delay
+        self._compaction_task: Optional[asyncio.Task] = None
+        self.compactions = 0
+
         # Initialize face detection models
         if MEDIAPIPE_AVAILABLE:
-            self.face_detector = mp_face_detection.FaceDetection(min_detection_confidence=0.5)
             self.face_mesh = mp_face_mesh.FaceMesh(
                 static_image_mode=True,
                 max_num_faces=1,
                 min_detection_confidence=0.5
             )
 
+        # Pick the detector/encoder backend
+        self.backend, self.backend_selection = self._select_backend(accuracy_tier, auto_select_backend)
+
         # Load existing face data
         self.face_database = self._load_face_database()
 
         logger.info(f"Initialized facial authentication service with {len(self.face_database)} users")
 
+    def _select_backend(self, accuracy_tier: str, auto_select: bool) -> Tuple[FaceBackend, Dict[str, Any]]:
+        """
+        Choose the fastest installed backend that meets the accuracy tier
+
+        Returns:
+            The backend instance and a report of the decision and timings
+        """
+        if accuracy_tier not in ACCURACY_TIERS:
+            raise ValueError(f"Unknown accuracy tier: {accuracy_tier}")
+
+        installed = [backend_class for backend_class in FACE_BACKENDS if backend_class.available()]
+        best_tier = max(ACCURACY_TIERS.index(b.tier) for b in installed)
+        required = min(ACCURACY_TIERS.index(accuracy_tier), best_tier)
+        candidates = [b for b in installed if ACCURACY_TIERS.index(b.tier) >= required]
+
+        selection = {
+            "requested_tier": accuracy_tier,
+            "effective_tier": ACCURACY_TIERS[required],
+            "candidates": [b.name for b in candidates],
+            "benchmarks": {}
+        }
+
+        if not auto_select or len(candidates) == 1:
+            backend = self._create_backend(candidates[0])
+            selection["backend"] = backend.name
+            selection["reason"] = "only candidate" if len(candidates) == 1 else "fixed preference order"
+            logger.info(f"Using face backend {backend.name} ({selection['reason']})")
+            return backend, selection
+
+        frames = synthetic_frames()
+        best_backend = None
+        best_time = float("inf")
+        for backend_class in candidates:
+            try:
+                backend = self._create_backend(backend_class)
+                result = benchmark_backend(backend, frames)
+            except Exception as e:
+                logger.warning(f"Benchmark failed for {backend_class.name}: {e}")
+                selection["benchmarks"][backend_class.name] = {"error": str(e)}
+                continue
+
+            selection["benchmarks"][backend_class.name] = result
+            logger.info(f"Backend {backend_class.name}: {result['median_ms']:.1f} ms/frame")
+            if result["median_ms"] < best_time:
+                best_backend = backend
+                best_time = result["median_ms"]
+
+        if best_backend is None:
+            best_backend = self._create_backend(candidates[-1])
+            selection["reason"] = "all benchmarks failed"
+        else:
+            selection["reason"] = "fastest benchmarked"
+
+        selection["backend"] = best_backend.name
+        logger.info(f"Selected face backend {best_backend.name} for tier {selection['effective_tier']}")
+        return best_backend, selection
+
+    def _create_backend(self, backend_class) -> FaceBackend:
+        if backend_class is FaceRecognitionBackend:
+            return backend_class(upsample=self.upsample, model=self.detection_model)
+        return backend_class()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get service metrics
+
+        Returns:
+            Dictionary with the backend decision and gallery size
+        """
+        return {
+            "backend": self.backend.name,
+            "backend_selection": self.backend_selection,
+            "detection": {
+                "scale": self.detection_scale,
+                "upsample": self.upsample,
+                "model": self.detection_model
+            },
+            "face_database_size": len(self.face_database),
+            "tombstones": int(self._gallery_cache[3].sum()) if self._gallery_cache else 0,
+            "compactions": self.compactions,
+            "templates": {
+                "max_per_user": self.max_templates,
+                "eviction": self.template_eviction,
+                "reduce": self.template_reduce
+            },
+            "persistence": self.writer.get_metrics()
+        }
+
+    def close(self):
+        """Flush pending writes; call on shutdown"""
+        self.writer.close()
+
+    def _get_encoding(self, user_id: str, user_data: Dict[str, Any]) -> np.ndarray:
+        """Registered encoding for a user, from memory when possible"""
+        encoding = self._encoding_cache.get(user_id)
+        if encoding is None:
+            encoding = np.load(user_data["face_encoding_path"])
+            self._encoding_cache[user_id] = encoding
+        return encoding
+
+    def _gallery_matrix(self) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every template of every compatible registration in one matrix
+
+        Returns:
+            User ids, the templates grouped by user, the first row of each
+            user, and which users are tombstoned
+        """
+        if self._gallery_cache is None:
+            self._gallery_cache = self._build_gallery_matrix(self.face_database)
+        return self._gallery_cache
+
+    def _build_gallery_matrix(self, face_database: Dict[str, Any]) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """Stack the templates of face_database; may run on a worker thread given a copy"""
+        user_ids, encodings = [], []
+        for user_id, user_data in face_database.items():
+            if not self._encoding_compatible(user_data):
+                continue
+            try:
+                encodings.append(np.atleast_2d(self._get_encoding(user_id, user_data)))
+                user_ids.append(user_id)
+            except Exception as e:
+                logger.error(f"Error loading encoding of user {user_id}: {e}")
+        matrix = np.concatenate(encodings) if encodings else np.empty((0, 0))
+        starts = np.cumsum([0] + [len(templates) for templates in encodings[:-1]]).astype(np.intp)
+        return user_ids, matrix, starts, np.zeros(len(user_ids), dtype=bool)
+
+    def _reduce_distances(self, distances: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        """Per-user distance from per-template distances: closest template, or their mean"""
+        if len(starts) == len(distances):
+            return distances
+        if self.template_reduce == "mean":
+            counts = np.diff(np.append(starts, len(distances)))
+            return np.add.reduceat(distances, starts) / counts
+        return np.minimum.reduceat(distances, starts)
+
+    def _template_distances(self, templates: np.ndarray, face_encoding: np.ndarray) -> np.ndarray:
+        """Distance from a probe to each of several templates"""
+        if self.backend.encoding == FaceRecognitionBackend.encoding:
+            # Use face_recognition for comparison
+            return face_recognition.face_distance(templates, face_encoding)
+        # Fallback to simple comparison
+        return np.linalg.norm(templates - face_encoding, axis=1)
+
+    def _gallery_distances(self, face_image: np.ndarray, face_encoding: np.ndarray) -> Tuple[List[str], np.ndarray]:
+        """Distance from a probe to every compatible registration"""
+        if self.backend.encoding == FaceRecognitionBackend.encoding or not DEEPFACE_AVAILABLE:
+            user_ids, matrix, starts, deleted = self._gallery_matrix()
+            if not user_ids:
+                return [], np.empty(0)
+            # All templates in one pass, then one segment reduction per user
+            distances = self._reduce_distances(self._template_distances(matrix, face_encoding), starts)
+            if deleted.any():
+                distances = np.where(deleted, np.inf, distances)
+            return user_ids, distances
+
+        # Use DeepFace for comparison; it reads the registered images from disk
+        self.writer.flush()
+        temp_path = os.path.join(self.data_dir, "temp.jpg")
+        cv2.imwrite(temp_path, face_image)
+        user_ids, distances = [], []
+        try:
+            for user_id, user_data in self.face_database.items():
+                if not self._encoding_compatible(user_data):
+                    continue
+                try:
+                    verification = DeepFace.verify(
+                        temp_path,
+                        user_data["face_image_path"],
+                        model_name="VGG-Face",
+                        distance_metric="cosine"
+                    )
+                except Exception as e:
+                    logger.error(f"Error comparing with user {user_id}: {e}")
+                    continue
+                user_ids.append(user_id)
+                distances.append(verification.get("distance", 1.0))
+        finally:
+            os.remove(temp_path)
+        return user_ids, np.asarray(distances, dtype=np.float64)
+
+    def _encoding_compatible(self, user_data: Dict[str, Any]) -> bool:
+        """Whether a stored encoding came from the current backend's encoding family"""
+        # Entries registered before backends were recorded are assumed compatible
+        return user_data.get("encoding", self.backend.encoding) == self.backend.encoding
+
     def _load_face_database(self) -> Dict[str, Any]:
         """Load face database from disk"""
         database_path = os.path.join(self.data_dir, "face_database.json")
@@ -88,23 +522,79 @@ class FacialAuthService:
 
         return {}
 
+    def _tombstone(self, user_id: str):
+        """Hide a user from identify at once and rebuild the gallery matrix without them later"""
+        self._gallery_generation += 1
+        if self._gallery_cache is not None:
+            user_ids, _, _, deleted = self._gallery_cache
+            if user_id in user_ids:
+                deleted[user_ids.index(user_id)] = True
+        if self._compaction_task is None or self._compaction_task.done():
+            self._compaction_task = asyncio.ensure_future(self._compact_later())
+
+    async def _compact_later(self):
+        """Background compaction: rebuild the gallery matrix off the event loop and swap it in"""
+        await asyncio.sleep(self.compaction_delay)
+        while self._gallery_cache is not None and self._gallery_cache[3].any():
+            generation = self._gallery_generation
+            rebuilt = await asyncio.to_thread(self._build_gallery_matrix, dict(self.face_database))
+            # A registration or deletion meanwhile makes the rebuild stale; try again
+            if generation == self._gallery_generation:
+                self._gallery_cache = rebuilt
+                self.compactions += 1
+
+    def _add_template(self, user_id: str, face_encoding: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+        """
+        A user's templates with face_encoding added, evicting beyond max_templates
+
+        The new encoding is always kept. With "outlier" eviction the existing
+        template farthest, on average, from the rest of the set goes first;
+        "oldest" drops in registration order.
+
+        Returns:
+            Templates to store ((dim,) for one) and evicted positions in the previous set
+        """
+        user_data = self.face_database.get(user_id)
+        templates = []
+        if user_data is not None and self._encoding_compatible(user_data):
+            try:
+                templates = list(np.atleast_2d(self._get_encoding(user_id, user_data)))
+            except Exception as e:
+                logger.error(f"Error loading encoding of user {user_id}: {e}")
+        positions = list(range(len(templates)))
+        evicted = []
+        while templates and len(templates) + 1 > self.max_templates:
+            if self.template_eviction == "oldest":
+                weakest = 0
+            else:
+                candidates = np.vstack(templates + [face_encoding])
+                # Summed distance of each existing template to the others; its own distance is 0
+                spread = [np.linalg.norm(candidates - template, axis=1).sum() for template in templates]
+                weakest = int(np.argmax(spread))
+            templates.pop(weakest)
+            evicted.append(positions.pop(weakest))
+        templates.append(face_encoding)
+        return (templates[0] if len(templates) == 1 else np.stack(templates)), evicted
+
     def _save_face_database(self):
-        """Save face database to disk"""
+        """Queue a rewrite of the face database; bursts collapse into one write"""
         database_path = os.path.join(self.data_dir, "face_database.json")
 
-        try:
-            with open(database_path, "w") as f:
-                json.dump(self.face_database, f, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving face database: {e}")
+        # Serialize a shallow copy in the writer thread, and only the latest one
+        snapshot = dict(self.face_database)
+        self.writer.write(database_path, lambda: json.dumps(snapshot, indent=2).encode("utf-8"))
 
-    async def register_face(self, image: np.ndarray, user_id: str) -> Dict[str, Any]:
+    async def register_face(self, image: np.ndarray, user_id: str, replace: bool = False) -> Dict[str, Any]:
         """
         Register a face for a user
 
+        Each registration adds an encoding to the user's templates, up to
+        max_templates; the stored face image is the latest one.
+
         Args:
             image: The face image
             user_id: The user ID
+            replace: Discard the user's existing templates instead of adding to them
 
         Returns:
             Result of the registration
@@ -121,16 +611,30 @@ class FacialAuthService:
 
             # Save face image
             face_image_path = os.path.join(self.data_dir, f"{user_id}.jpg")
-            cv2.imwrite(face_image_path, face_image)
-
-            # Save face encoding
+            encoded, face_jpeg = cv2.imencode(".jpg", face_image)
+            if not encoded:
+                raise ValueError("Could not encode face image")
+            self.writer.write(face_image_path, face_jpeg.tobytes())
+
+            # Save face encodings
+            if replace:
+                templates, evicted = face_encoding, []
+            else:
+                templates, evicted = self._add_template(user_id, face_encoding)
             face_encoding_path = os.path.join(self.data_dir, f"{user_id}.npy")
-            np.save(face_encoding_path, face_encoding)
+            buffer = io.BytesIO()
+            np.save(buffer, templates)
+            self.writer.write(face_encoding_path, buffer.getvalue())
+            self._encoding_cache[user_id] = templates
+            self._gallery_cache = None
+            self._gallery_generation += 1
 
             # Update database
             self.face_database[user_id] = {
                 "face_image_path": face_image_path,
                 "face_encoding_path": face_encoding_path,
+                "encoding": self.backend.encoding,
+                "templates": len(np.atleast_2d(templates)),
                 "registration_time": asyncio.get_event_loop().time()
             }
 
@@ -140,17 +644,70 @@ class FacialAuthService:
             return {
                 "success": True,
                 "message": "Face registered successfully",
-                "user_id": user_id
+                "user_id": user_id,
+                "templates": len(np.atleast_2d(templates)),
+                "evicted_templates": evicted
             }
 
         except Exception as e:
             logger.error(f"Error registering face: {e}")
-            logger.error(traceback.format_exc())
+            record_exception(e)
             return {
                 "success": False,
                 "message": f"Error registering face: {str(e)}"
             }
 
+    async def update_face(self, image: np.ndarray, user_id: str) -> Dict[str, Any]:
+        """
+        Replace a registered user's face and templates
+
+        Args:
+            image: The new face image
+            user_id: A registered user ID
+
+        Returns:
+            Result of the registration
+        """
+        if user_id not in self.face_database:
+            return {
+                "success": False,
+                "message": "User not registered"
+            }
+        return await self.register_face(image, user_id, replace=True)
+
+    async def delete_face(self, user_id: str) -> Dict[str, Any]:
+        """
+        Remove a registered user
+
+        Identify stops matching them at once; the gallery matrix is rebuilt
+        without them in the background after compaction_delay.
+
+        Args:
+            user_id: The user ID
+
+        Returns:
+            Result of the deletion
+        """
+        user_data = self.face_database.pop(user_id, None)
+        if user_data is None:
+            return {
+                "success": False,
+                "message": "User not registered"
+            }
+
+        self._tombstone(user_id)
+        self._encoding_cache.pop(user_id, None)
+        for key in ("face_encoding_path", "face_image_path"):
+            if user_data.get(key):
+                self.writer.delete(user_data[key])
+        self._save_face_database()
+
+        return {
+            "success": True,
+            "message": "Face deleted successfully",
+            "user_id": user_id
+        }
+
     async def verify_face(self, image: np.ndarray, user_id: str) -> Dict[str, Any]:
         """
         Verify a face against a registered user
@@ -170,6 +727,12 @@ class FacialAuthService:
                     "message": "User not registered"
                 }
 
+            if not self._encoding_compatible(self.face_database[user_id]):
+                return {
+                    "success": False,
+                    "message": f"User was registered with a different encoder than {self.backend.name}"
+                }
+
             # Extract face and encoding from the image
             face_image, face_encoding = await self._extract_face_and_encoding(image)
 
@@ -179,39 +742,43 @@ class FacialAuthService:
                     "message": "No face detected in the image"
                 }
 
-            # Load registered face encoding
-            registered_encoding_path = self.face_database[user_id]["face_encoding_path"]
-            registered_encoding = np.load(registered_encoding_path)
+            # Load registered face encodings
+            registered_templates = np.atleast_2d(self._get_encoding(user_id, self.face_database[user_id]))
+            template_starts = np.zeros(1, dtype=np.intp)
 
             # Compare face encodings
-            if FACE_RECOGNITION_AVAILABLE:
-                # Use face_recognition for comparison
-                distance = face_recognition.face_distance([registered_encoding], face_encoding)[0]
-                match = distance <= 0.7  # Increased threshold (lower similarity required)
-                confidence = 1.0 - distance
-            elif DEEPFACE_AVAILABLE:
-                # Use DeepFace for comparison
-                registered_image_path = self.face_database[user_id]["face_image_path"]
-                temp_path = os.path.join(self.data_dir, "temp.jpg")
-                cv2.imwrite(temp_path, face_image)
-
-                verification = DeepFace.verify(
-                    temp_path,
-                    registered_image_path,
-                    model_name="VGG-Face",
-                    distance_metric="cosine"
-                )
-
-                os.remove(temp_path)
-
-                distance = verification.get("distance", 1.0)
-                match = verification.get("verified", False)
-                confidence = 1.0 - distance
-            else:
-                # Fallback to simple comparison
-                distance = np.linalg.norm(registered_encoding - face_encoding)
-                match = distance <= 0.8  # Increased threshold for easier matching
-                confidence = 1.0 - min(distance, 1.0)
+            with trace_span("match"):
+                if self.backend.encoding == FaceRecognitionBackend.encoding:
+                    # Use face_recognition for comparison
+                    distance = self._reduce_distances(
+                        self._template_distances(registered_templates, face_encoding), template_starts)[0]
+                    match = distance <= 0.7  # Increased threshold (lower similarity required)
+                    confidence = 1.0 - distance
+                elif DEEPFACE_AVAILABLE:
+                    # Use DeepFace for comparison; it reads the registered image from disk
+                    self.writer.flush()
+                    registered_image_path = self.face_database[user_id]["face_image_path"]
+                    temp_path = os.path.join(self.data_dir, "temp.jpg")
+                    cv2.imwrite(temp_path, face_image)
+
+                    verification = DeepFace.verify(
+                        temp_path,
+                        registered_image_path,
+                        model_name="VGG-Face",
+                        distance_metric="cosine"
+                    )
+
+                    os.remove(temp_path)
+
+                    distance = verification.get("distance", 1.0)
+                    match = verification.get("verified", False)
+                    confidence = 1.0 - distance
+                else:
+                    # Fallback to simple comparison
+                    distance = self._reduce_distances(
+                        self._template_distances(registered_templates, face_encoding), template_starts)[0]
+                    match = distance <= 0.8  # Increased threshold for easier matching
+                    confidence = 1.0 - min(distance, 1.0)
 
             return {
                 "success": True,
@@ -223,18 +790,19 @@ class FacialAuthService:
 
         except Exception as e:
             logger.error(f"Error verifying face: {e}")
-            logger.error(traceback.format_exc())
+            record_exception(e)
             return {
                 "success": False,
                 "message": f"Error verifying face: {str(e)}"
             }
 
-    async def identify_face(self, image: np.ndarray) -> Dict[str, Any]:
+    async def identify_face(self, image: np.ndarray, top_k: int = 0) -> Dict[str, Any]:
         """
         Identify a face against all registered users
 
         Args:
             image: The face image
+            top_k: Also return this many best candidates, matched or not
 
         Returns:
             Result of the identification
@@ -249,160 +817,125 @@ class FacialAuthService:
                     "message": "No face detected in the image"
                 }
 
-            # Compare with all registered faces
-            best_match = None
-            best_confidence = 0.0
-            best_distance = float('inf')
-
-            for user_id, user_data in self.face_database.items():
-                try:
-                    # Load registered face encoding
-                    registered_encoding_path = user_data["face_encoding_path"]
-                    registered_encoding = np.load(registered_encoding_path)
-
-                    # Compare face encodings
-                    if FACE_RECOGNITION_AVAILABLE:
-                        # Use face_recognition for comparison
-                        distance = face_recognition.face_distance([registered_encoding], face_encoding)[0]
-                        confidence = 1.0 - distance
-                    elif DEEPFACE_AVAILABLE:
-                        # Use DeepFace for comparison
-                        registered_image_path = user_data["face_image_path"]
-                        temp_path = os.path.join(self.data_dir, "temp.jpg")
-                        cv2.imwrite(temp_path, face_image)
-
-                        verification = DeepFace.verify(
-                            temp_path,
-                            registered_image_path,
-                            model_name="VGG-Face",
-                            distance_metric="cosine"
-                        )
-
-                        os.remove(temp_path)
-
-                        distance = verification.get("distance", 1.0)
-                        confidence = 1.0 - distance
-                    else:
-                        # Fallback to simple comparison
-                        distance = np.linalg.norm(registered_encoding - face_encoding)
-                        confidence = 1.0 - min(distance, 1.0)
-
-                    # Update best match
-                    if confidence > best_confidence:
-                        best_match = user_id
-                        best_confidence = confidence
-                        best_distance = distance
-
-                except Exception as e:
-                    logger.error(f"Error comparing with user {user_id}: {e}")
-                    continue
+            # Compare with all registered faces in one pass
+            with trace_span("match"):
+                user_ids, distances = self._gallery_distances(face_image, face_encoding)
+                if self.backend.encoding == FaceRecognitionBackend.encoding or DEEPFACE_AVAILABLE:
+                    confidences = 1.0 - distances
+                else:
+                    confidences = 1.0 - np.minimum(distances, 1.0)
+                ranked = top_k_indices(confidences, max(top_k, 1))
+
+            candidates = [
+                {
+                    "user_id": user_ids[i],
+                    "confidence": float(confidences[i]),
+                    "distance": float(distances[i])
+                }
+                for i in ranked
+                # Tombstoned users rank last with an infinite distance
+                if np.isfinite(distances[i])
+            ]
 
             # Determine if it's a match
-            match = best_confidence >= 0.6  # Reduced threshold for easier identification
+            match = bool(candidates) and candidates[0]["confidence"] >= 0.6  # Reduced threshold for easier identification
 
             if match:
-                return {
+                result = {
                     "success": True,
                     "match": True,
-                    "user_id": best_match,
-                    "confidence": float(best_confidence),
-                    "distance": float(best_distance)
+                    **candidates[0]
                 }
             else:
-                return {
+                result = {
                     "success": True,
                     "match": False,
                     "message": "No matching user found"
                 }
+            if top_k > 0:
+                result["candidates"] = candidates[:top_k]
+            return result
 
         except Exception as e:
             logger.error(f"Error identifying face: {e}")
-            logger.error(traceback.format_exc())
+            record_exception(e)
             return {
                 "success": False,
                 "message": f"Error identifying face: {str(e)}"
             }
 
-    async def _extract_face_and_encoding(self, image: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    def _detect_locations(self, images: List[np.ndarray],
+                          rgb_images: List[np.ndarray]) -> List[List[Tuple[int, int, int, int]]]:
+        """Detect on downscaled frames and map the boxes back to full resolution"""
+        scale = self.detection_scale
+        if scale == 1.0:
+            return self.backend.detect_many(images, rgb_images)
+
+        small_images = [cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                        for image in images]
+        small_rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in small_images]
+        results = []
+        for image, locations in zip(images, self.backend.detect_many(small_images, small_rgb)):
+            height, width = image.shape[:2]
+            results.append([
+                (max(0, int(top / scale)), min(width, int(right / scale)),
+                 min(height, int(bottom / scale)), max(0, int(left / scale)))
+                for top, right, bottom, left in locations
+            ])
+        return results
+
+    def extract_faces(self, images: List[np.ndarray], all_faces: bool = True) -> List[List[Dict[str, Any]]]:
         """
-        Extract face and encoding from an image
+        Detect and encode the faces in several frames at once
+
+        Detection runs on all frames before any encoding, so backends can batch
+        both steps; all faces of a frame are encoded in one call.
 
         Args:
-            image: The image
+            images: BGR frames
+            all_faces: Encode every detected face, or only the first of each frame
 
         Returns:
-            Tuple of (face_image, face_encoding)
+            Per frame, a list of {"location", "face_image", "encoding"}
         """
         # Convert to RGB for face_recognition
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Detect face
-        if FACE_RECOGNITION_AVAILABLE:
-            # Use face_recognition for detection
-            face_locations = face_recognition.face_locations(rgb_image)
+        rgb_images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
+
+        # Detect faces with the selected backend
+        with trace_span("detect"):
+            all_locations = self._detect_locations(images, rgb_images)
+
+        results = []
+        with trace_span("encode"):
+            for image, rgb_image, locations in zip(images, rgb_images, all_locations):
+                locations = [tuple(int(v) for v in location) for location in locations]
+                if not all_faces:
+                    locations = locations[:1]
+                encodings = self.backend.encode_many(image, rgb_image, locations) if locations else []
+                results.append([
+                    {
+                        "location": (top, right, bottom, left),
+                        "face_image": image[top:bottom, left:right],
+                        "encoding": encoding
+                    }
+                    for (top, right, bottom, left), encoding in zip(locations, encodings)
+                ])
+        return results
 
-            if not face_locations:
-                return None, None
-
-            # Get the largest face
-            top, right, bottom, left = face_locations[0]
-
-            # Extract face image
-            face_image = image[top:bottom, left:right]
-
-            # Get face encoding
-            face_encoding = face_recognition.face_encodings(rgb_image, [face_locations[0]])[0]
-
-            return face_image, face_encoding
-
-        elif MEDIAPIPE_AVAILABLE:
-            # Use MediaPipe for detection
-            results = self.face_detector.process(rgb_image)
-
-            if not results.detections:
-                return None, None
-
-            # Get the first detection
-            detection = results.detections[0]
-
-            # Get bounding box
-            height, width, _ = image.shape
-            bbox = detection.location_data.relative_bounding_box
-            x = int(bbox.xmin * width)
-            y = int(bbox.ymin * height)
-            w = int(bbox.width * width)
-            h = int(bbox.height * height)
-
-            # Extract face image
-            face_image = image[y:y+h, x:x+w]
-
-            # We don't have face encodings with MediaPipe, so we'll use a simple feature vector
-            # This is not as accurate as face_recognition encodings
-            # In a real implementation, you would use a proper face recognition model
-            face_image_small = cv2.resize(face_image, (128, 128))
-            face_image_gray = cv2.cvtColor(face_image_small, cv2.COLOR_BGR2GRAY)
-            face_encoding = face_image_gray.flatten() / 255.0  # Normalize
-
-            return face_image, face_encoding
-
-        else:
-            # Fallback to Haar cascade
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-
-            if len(faces) == 0:
-                return None, None
+    async def _extract_face_and_encoding(self, image: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Extract face and encoding from an image
 
-            # Get the largest face
-            x, y, w, h = faces[0]
+        Args:
+            image: The image
 
-            # Extract face image
-            face_image = image[y:y+h, x:x+w]
+        Returns:
+            Tuple of (face_image, face_encoding)
+        """
+        faces = self.extract_faces([image], all_faces=False)[0]
 
-            # Create a simple feature vector
-            face_image_small = cv2.resize(face_image, (128, 128))
-            face_image_gray = cv2.cvtColor(face_image_small, cv2.COLOR_BGR2GRAY)
-            face_encoding = face_image_gray.flatten() / 255.0  # Normalize
+        if not faces:
+            return None, None
 
-            return face_image, face_encoding
+        # Use the first detection
+        return faces[0]["face_image"], faces[0]["encoding"]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Write-behind persistence for the NAFacial facial authentication service.
+Keeps face image, encoding and database writes off the event loop.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
+logger = logging.getLogger("PersistenceWriter")
+
+class PersistenceWriter:
+    """
+    Write-behind queue for face data files
+
+    Writes are queued per path, so a newer write (or delete) of the same file
+    replaces the pending contents (keeping its callbacks), appends extend
+    them, and a background thread flushes everything queued within
+    batch_interval together, with one fsync per file and per directory.
+    Durability modes:
+
+        "sync"  - write and fsync in the caller, like a plain np.save
+        "batch" - write behind, fsync once per batch (default)
+        "none"  - write behind, leave flushing to the OS
+    """
+
+    def __init__(self, durability: str = "batch", batch_interval: float = 0.05):
+        if durability not in ("sync", "batch", "none"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self.batch_interval = batch_interval
+
+        # path -> [kind, data, callbacks]; kind is "write", "append" or "delete"
+        self._pending: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._in_flight: set = set()    # paths of the batch being flushed
+        self._closing = False
+        self._cond = threading.Condition()
+
+        # Metrics
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.errors = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+
+        self._thread = None
+        if durability != "sync":
+            self._thread = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+            self._thread.start()
+
+    def write(self, path: str, data: Any, callback: Optional[Any] = None):
+        """Replace a file's contents; data is bytes or a callable producing bytes at flush time"""
+        self._submit(path, "write", data, callback)
+
+    def append(self, path: str, data: bytes, callback: Optional[Any] = None):
+        """Append bytes to a file; callback receives the file's end offset"""
+        self._submit(path, "append", data, callback)
+
+    def delete(self, path: str, callback: Optional[Any] = None):
+        """Remove a file, cancelling any pending write to it"""
+        self._submit(path, "delete", None, callback)
+
+    def _submit(self, path: str, kind: str, data: Any, callback: Optional[Any]):
+        callbacks = [callback] if callback else []
+        if self.durability == "sync":
+            self._flush_batch(OrderedDict([(path, [kind, data, callbacks])]))
+            return
+
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("Persistence writer is closed")
+            job = self._pending.get(path)
+            if job is None:
+                self._pending[path] = [kind, data, callbacks]
+            elif kind == "append" and job[0] == "append":
+                job[1] += data
+                job[2].extend(callbacks)
+            else:
+                # Merge into the pending job: appending after a write or delete
+                # extends the new contents, a write or delete supersedes them;
+                # either way every queued callback still fires
+                self.coalesced += 1
+                if kind == "append":
+                    job[1] = self._extend(job[1], data) if job[0] == "write" else data
+                    job[0] = "write"
+                else:
+                    job[0], job[1] = kind, data
+                job[2].extend(callbacks)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _extend(data: Any, extra: bytes) -> Any:
+        """Pending write contents followed by appended bytes"""
+        if callable(data):
+            return lambda produce=data: produce() + extra
+        return data + extra
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending and self._closing:
+                    return
+                # Let a burst accumulate so it shares one fsync
+                deadline = time.monotonic() + self.batch_interval
+                while not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, OrderedDict()
+                self._in_flight = set(batch)
+
+            self._flush_batch(batch)
+
+            with self._cond:
+                self._in_flight = set()
+                self._cond.notify_all()
+
+    def _flush_batch(self, batch: "OrderedDict[str, List[Any]]"):
+        """Write, fsync and acknowledge one batch"""
+        start_time = time.perf_counter()
+        fsync = self.durability != "none"
+        directories = set()
+        done = []
+
+        # Replacements and deletions go first and are made durable before any
+        # append, so a log record never reaches the disk ahead of the file it names
+        replaced = [(path, job) for path, job in batch.items() if job[0] != "append"]
+        appended = [(path, job) for path, job in batch.items() if job[0] == "append"]
+        for jobs in (replaced, appended):
+            for path, (kind, data, callbacks) in jobs:
+                try:
+                    result = None
+                    if kind == "delete":
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    elif kind == "append":
+                        with open(path, "ab") as f:
+                            f.write(data)
+                            f.flush()
+                            if fsync:
+                                os.fsync(f.fileno())
+                            result = f.tell()
+                    else:
+                        # Write to a temp file and rename, so readers never see a torn file
+                        tmp_path = path + ".tmp"
+                        with open(tmp_path, "wb") as f:
+                            f.write(data() if callable(data) else data)
+                            f.flush()
+                            if fsync:
+                                os.fsync(f.fileno())
+                            # Appends merged into this write expect the end offset
+                            result = f.tell()
+                        os.replace(tmp_path, path)
+                    directories.add(os.path.dirname(path) or ".")
+                    done.append((callbacks, result))
+                    self.writes += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Error persisting {path}: {e}")
+
+            # Make the renames and deletions themselves durable
+            if fsync and hasattr(os, "O_DIRECTORY"):
+                for directory in directories:
+                    try:
+                        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    except OSError:
+                        pass
+            directories.clear()
+
+        for callbacks, result in done:
+            for callback in callbacks:
+                try:
+                    callback(result)
+                except Exception as e:
+                    logger.error(f"Error in persistence callback: {e}")
+
+        elapsed = time.perf_counter() - start_time
+        self.flushes += 1
+        self.total_flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+        self.last_flush_time = elapsed
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def pending(self, path: str) -> bool:
+        """Whether a write, append or delete of path is queued or being flushed"""
+        with self._cond:
+            return path in self._pending or path in self._in_flight
+
+    def flush(self):
+        """Block until everything queued so far is on disk"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._in_flight:
+                self._cond.wait()
+
+    def close(self):
+        """Flush outstanding writes and stop the writer thread"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "durability": self.durability,
+            "queue_depth": self.queue_depth(),
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "average_flush_time": self.total_flush_time / max(1, self.flushes),
+            "max_flush_time": self.max_flush_time,
+            "last_flush_time": self.last_flush_time
+        }
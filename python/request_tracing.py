@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Per-request tracing for the NAFacial facial authentication server.
+Records stage spans for every request and logs a structured JSON line for
+a sampled fraction of requests plus every slow or failed one.
+"""
+
+import json
+import time
+import uuid
+import random
+import logging
+import traceback
+import contextvars
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger("FacialAuthService")
+
+# Trace of the request being handled, so service stages can record spans
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+# Structured trace records go to their own logger as bare JSON lines
+trace_logger = logging.getLogger("FacialAuthServer.trace")
+_trace_handler = logging.StreamHandler()
+_trace_handler.setFormatter(logging.Formatter("%(message)s"))
+trace_logger.addHandler(_trace_handler)
+trace_logger.propagate = False
+
+class _Span:
+    """Adds the time spent inside a with-block to a named span"""
+
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: "RequestTrace", name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = self.trace.spans
+        spans[self.name] = spans.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+class _NullSpan:
+    """Span used when no request is being traced"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def activate_trace(trace: "RequestTrace") -> contextvars.Token:
+    """Make trace current for the request being handled"""
+    return _current_trace.set(trace)
+
+def deactivate_trace(token: contextvars.Token):
+    _current_trace.reset(token)
+
+def current_trace() -> Optional["RequestTrace"]:
+    """Trace of the request being handled, or None"""
+    return _current_trace.get()
+
+def trace_span(name: str):
+    """Time a stage of the current request, e.g. with trace_span("detect"):"""
+    trace = _current_trace.get()
+    return _Span(trace, name) if trace is not None else _NULL_SPAN
+
+class RequestTrace:
+    """Per-request trace id and accumulated stage timings"""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.message_type = ""
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.error_traceback: Optional[str] = None
+
+    def set_client_trace_id(self, trace_id: Any):
+        """Adopt a trace id supplied by the client"""
+        if isinstance(trace_id, str) and trace_id:
+            self.trace_id = trace_id[:64]
+
+    def span(self, name: str) -> _Span:
+        return _Span(self, name)
+
+    def fail(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+        self.error_traceback = traceback.format_exc()
+
+def record_exception(error: BaseException):
+    """Attach the traceback to the current trace, or log it when nothing is being traced"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fail(error)
+    else:
+        logger.error(traceback.format_exc())
+
+class RequestTracer:
+    """
+    Decides which request traces are worth logging
+
+    Spans are always timed (a few perf_counter calls), but a record is only
+    serialized for a sampled fraction of requests plus every slow or failed
+    one, so tracing is close to free under load yet never misses an outlier.
+    """
+
+    def __init__(self, sample_rate: float = 0.01, slow_threshold: float = 0.5):
+        """
+        Args:
+            sample_rate: Fraction of ordinary requests to log (0 to 1)
+            slow_threshold: Requests taking at least this many seconds are always logged
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traced = 0
+        self.emitted = 0
+        self.slow = 0
+        self.errors = 0
+
+    def start(self) -> RequestTrace:
+        return RequestTrace()
+
+    def finish(self, trace: RequestTrace, **fields):
+        """Close a trace and log it if it is sampled, slow or failed"""
+        duration = time.perf_counter() - trace.start
+        slow = duration >= self.slow_threshold
+        self.traced += 1
+        if slow:
+            self.slow += 1
+        if trace.error:
+            self.errors += 1
+
+        if not (slow or trace.error or random.random() < self.sample_rate):
+            return
+
+        self.emitted += 1
+        record = {
+            "trace_id": trace.trace_id,
+            "type": trace.message_type,
+            "time": datetime.now().isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "slow": slow,
+            "status": "error" if trace.error else "ok",
+            "spans": {name: round(value * 1000, 3) for name, value in trace.spans.items()}
+        }
+        record.update(fields)
+        if trace.error:
+            record["error"] = trace.error
+            record["traceback"] = trace.error_traceback
+        trace_logger.info(json.dumps(record))
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_threshold": self.slow_threshold,
+            "traced": self.traced,
+            "emitted": self.emitted,
+            "slow": self.slow,
+            "errors": self.errors
+        }
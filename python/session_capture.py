@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Session record and replay for the NAFacial facial authentication server.
+Captures inbound client messages and plays them back for load testing.
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+import asyncio
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+
+import numpy as np
+
+from persistence_writer import PersistenceWriter
+
+logger = logging.getLogger("SessionCapture")
+
+# Session capture files: a magic line, then one framed record per inbound message
+CAPTURE_MAGIC = b"NAFCAP1\n"
+_CAPTURE_RECORD = struct.Struct("<dIBI")   # timestamp, connection id, flags, payload length
+_CAPTURE_ZLIB = 1
+_CAPTURE_BINARY = 2
+
+class SessionRecorder:
+    """
+    Opt-in recorder of inbound client messages for later replay
+
+    Records are appended through a write-behind queue without fsync, so
+    recording never blocks the event loop on disk. Each payload is zlib
+    compressed when that makes it smaller; base64 frames shrink by about a
+    quarter.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = PersistenceWriter("none")
+        self.records = 0
+        self.bytes_written = 0
+        self._connections = 0
+        # Added to time.time(); an appended run resumes the clock where the last one stopped
+        self._clock_offset = 0.0
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.writer.append(path, CAPTURE_MAGIC)
+        else:
+            # Continue after the previous runs, so their connections stay
+            # distinct on replay and the downtime in between is not replayed
+            self._connections, last_timestamp = _scan_capture(path)
+            if last_timestamp is not None:
+                self._clock_offset = last_timestamp - time.time()
+        logger.info(f"Recording client sessions to {path}")
+
+    def connection_id(self) -> int:
+        """Id for a new client connection"""
+        self._connections += 1
+        return self._connections
+
+    def record(self, connection_id: int, message):
+        """Append one inbound message (str or bytes)"""
+        flags = 0
+        if isinstance(message, str):
+            payload = message.encode("utf-8")
+        else:
+            payload = bytes(message)
+            flags |= _CAPTURE_BINARY
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= _CAPTURE_ZLIB
+        data = _CAPTURE_RECORD.pack(time.time() + self._clock_offset, connection_id, flags, len(payload)) + payload
+        self.writer.append(self.path, data)
+        self.records += 1
+        self.bytes_written += len(data)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "records": self.records,
+            "bytes": self.bytes_written,
+            "queue_depth": self.writer.queue_depth()
+        }
+
+    def close(self):
+        self.writer.close()
+
+def _scan_capture(path: str) -> Tuple[int, Optional[float]]:
+    """
+    Highest connection id and last timestamp in an existing capture
+
+    Only record headers are read. A record cut short by a crash is truncated
+    away, since anything appended after it could not be read back.
+    """
+    last_id, last_timestamp = 0, None
+    with open(path, "r+b") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a session capture")
+        size = os.fstat(f.fileno()).st_size
+        end = f.tell()
+        while True:
+            header = f.read(_CAPTURE_RECORD.size)
+            if len(header) < _CAPTURE_RECORD.size:
+                break
+            timestamp, connection_id, _, length = _CAPTURE_RECORD.unpack(header)
+            if f.tell() + length > size:
+                break
+            f.seek(length, os.SEEK_CUR)
+            end = f.tell()
+            last_id, last_timestamp = max(last_id, connection_id), timestamp
+        if end < size:
+            logger.warning(f"Dropping a truncated record at the end of {path}")
+            f.truncate(end)
+    return last_id, last_timestamp
+
+def read_capture(path: str):
+    """Yield (timestamp, connection_id, message) from a capture file, streaming"""
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a session capture")
+        while True:
+            header = f.read(_CAPTURE_RECORD.size)
+            if len(header) < _CAPTURE_RECORD.size:
+                return   # end of file, or a record still being appended
+            timestamp, connection_id, flags, length = _CAPTURE_RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if flags & _CAPTURE_ZLIB:
+                payload = zlib.decompress(payload)
+            yield timestamp, connection_id, payload if flags & _CAPTURE_BINARY else payload.decode("utf-8")
+
+# Messages that open server pushes, whose extra responses would break request/response pairing
+REPLAY_SKIPPED_TYPES = ("subscribe_metrics",)
+
+async def replay_capture(path: str, url: str, speed: Optional[float] = 1.0, copies: int = 1,
+                         queue_size: int = 64) -> Dict[str, Any]:
+    """
+    Play a capture back against a server and measure latency per message type
+
+    Every recorded connection gets its own WebSocket, times `copies` for
+    extra load. Messages keep their recorded spacing divided by `speed`
+    (None replays as fast as the server answers). The file is streamed, with
+    at most `queue_size` messages read ahead per connection.
+
+    Args:
+        path: Capture file written by SessionRecorder
+        url: ws:// URL, or unix:/path/to/socket
+        speed: Playback rate relative to the recording, or None for maximum speed
+        copies: Concurrent copies of each recorded connection
+
+    Returns:
+        Per message type: count, errors and latency percentiles in ms
+    """
+    import websockets
+
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    failures: List[str] = []
+    queues: Dict[Tuple[int, int], asyncio.Queue] = {}
+    workers = []
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    def connect():
+        if url.startswith("unix:"):
+            return websockets.unix_connect(url[len("unix:"):], max_size=None)
+        return websockets.connect(url, max_size=None)
+
+    async def run_connection(queue: asyncio.Queue):
+        try:
+            async with connect() as websocket:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    due, message_type, message = item
+                    if due > loop.time():
+                        await asyncio.sleep(due - loop.time())
+                    sent = loop.time()
+                    await websocket.send(message)
+                    while True:
+                        response = json.loads(await websocket.recv())
+                        # Pushes from a subscription made outside the capture
+                        if not response.get("subscription"):
+                            break
+                    latencies.setdefault(message_type, []).append((loop.time() - sent) * 1000)
+                    if response.get("type") == "error" or response.get("success") is False:
+                        errors[message_type] = errors.get(message_type, 0) + 1
+        except Exception as e:
+            failures.append(str(e))
+            # Keep draining so the reader never blocks on a dead connection
+            while await queue.get() is not None:
+                pass
+
+    first = None
+    for timestamp, connection_id, message in read_capture(path):
+        try:
+            data = json.loads(message)
+            message_type = data.get("type") or data.get("command") or "unknown"
+        except (ValueError, AttributeError):
+            message_type = "invalid"
+        if message_type in REPLAY_SKIPPED_TYPES:
+            continue
+        if first is None:
+            first = timestamp
+        due = start + (timestamp - first) / speed if speed else start
+
+        for copy in range(copies):
+            queue = queues.get((connection_id, copy))
+            if queue is None:
+                queue = queues[(connection_id, copy)] = asyncio.Queue(queue_size)
+                workers.append(asyncio.ensure_future(run_connection(queue)))
+            await queue.put((due, message_type, message))
+
+    for queue in queues.values():
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    duration = loop.time() - start
+
+    report = {}
+    for message_type, samples in sorted(latencies.items()):
+        values = np.asarray(samples)
+        report[message_type] = {
+            "count": len(samples),
+            "errors": errors.get(message_type, 0),
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)),
+            "max_ms": float(values.max())
+        }
+    return {
+        "connections": len(queues),
+        "failed_connections": len(failures),
+        "messages": sum(len(samples) for samples in latencies.values()),
+        "duration": duration,
+        "speed": speed or "max",
+        "types": report
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Play a recorded session capture against a server")
+    parser.add_argument("capture", help="File written with --record")
+    parser.add_argument("url", help="Server URL, e.g. ws://localhost:8765 or unix:/path/to/socket")
+    parser.add_argument("--speed", default="1", help="Playback rate, e.g. 1, 4 or max")
+    parser.add_argument("--copies", type=int, default=1, help="Concurrent copies of each recorded connection")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    print(json.dumps(asyncio.run(replay_capture(args.capture, args.url, speed, args.copies)), indent=2))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the Android server's gallery store persistence.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "assets", "python"))
+
+from android_face_recognition_server import FaceGalleryStore
+
+class SyncDurabilityTest(unittest.TestCase):
+    def test_sync_enroll_returns(self):
+        """With durability "sync" the writer runs callbacks inline, under the store lock"""
+        with tempfile.TemporaryDirectory() as db_dir:
+            store = FaceGalleryStore(db_dir, durability="sync")
+            vector = np.ones(128, dtype=np.float32) / np.sqrt(128)
+            enroll = threading.Thread(target=store.enroll, args=("alice", vector), daemon=True)
+            enroll.start()
+            enroll.join(timeout=10)
+            self.assertFalse(enroll.is_alive(), "sync enroll deadlocked")
+
+            self.assertTrue(os.path.exists(os.path.join(db_dir, "alice.npy")))
+            with open(store.log_path) as f:
+                self.assertIn('"alice"', f.read())
+            self.assertEqual(store.index.ids, ["alice"])
+            store.close()
+
+if __name__ == "__main__":
+    unittest.main()